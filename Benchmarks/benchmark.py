@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Scale benchmark of the four housekeeping processes, run end to end against synthetic sites
+(fake_tableau_server.py for the REST API, repository_fixture.py for the postgreSQL repository).
+
+Every process runs in its own python process (so that its peak memory is its own), through the
+process_server function of its GUI, with Outlook replaced by a recorder (no email is displayed).
+Recorded per process and site size: wall time, REST requests (per endpoint), repository queries
+and rows read, emails prepared, errors in the log, peak RSS and the time of every phase (see phase).
+
+to launch: -> python benchmark.py [--objects 1000 10000 100000] [--save baselines/main.json] [--compare baselines/main.json]
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime
+
+import site_model
+import fake_tableau_server
+import repository_fixture
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+#Process -> (directory, GUI module, process module)
+PROCESSES = {'empty_projects': ('Empty Projects', 'empty_projects_GUI', 'empty_projects'),
+             'extract_refresh_delete': ('Extract refresh', 'refresh_extract_failed_GUI', 'refresh_extract_failed'),
+             'failed_subscriptions_delete': ('Subscriptions', 'subscriptions_failed_GUI', 'subscriptions_failed'),
+             'find_and_remove': ('Unlicense users', 'unlicensed_users_GUI', 'unlicensed_users')}
+#Metrics compared with the baseline: a value higher than the baseline by more than the tolerance is a regression
+COMPARED = ('wall_time', 'requests', 'repository_queries', 'repository_rows', 'peak_rss_mb')
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of the current python process in MB (None if it cannot be read).
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / (1024.0 * 1024.0)
+        except (ImportError, AttributeError):
+            return None
+
+
+def _patch_outlook():
+    """
+    Replaces Outlook by a recorder, so that the emails of the processes are counted instead of displayed.
+    Where pywin32 is not installed (benchmark outside Windows) the win32com module is replaced as well.
+    Returns the list the emails are appended to.
+    """
+    emails = []
+
+    class Message:
+        def Display(self):
+            emails.append(self)
+
+    class Outlook:
+        def CreateItem(self, item_type):
+            return Message()
+
+    try:
+        import win32com.client as client
+    except ImportError:
+        client = types.ModuleType('win32com.client')
+        sys.modules['win32com'] = types.ModuleType('win32com')
+        sys.modules['win32com'].client = client
+        sys.modules['win32com.client'] = client
+    client.Dispatch = lambda name: Outlook()
+    return emails
+
+
+def _count_rows(module, counter):
+    """
+    Wraps postgresql_batches of a process module to count the repository rows read.
+    """
+    batches = module.postgresql_batches
+
+    def postgresql_batches(*args, **kwargs):
+        for batch in batches(*args, **kwargs):
+            counter['rows'] += len(batch)
+            yield batch
+    module.postgresql_batches = postgresql_batches
+
+
+def run_process(process, server_url, pg_host, readonly_pw):
+    """
+    Runs one process end to end against the fake server (in the current python process) and returns its metrics.
+
+    'process'       key of PROCESSES
+    'server_url'    address of the fake Tableau server
+    'pg_host'       host of the postgreSQL repository loaded with the fixture
+    'readonly_pw'   password of the readonly user
+    """
+    emails = _patch_outlook()
+    directory, gui_name, module_name = PROCESSES[process]
+    sys.path.insert(0, os.path.join(ROOT, directory))
+    gui = importlib.import_module(gui_name)
+    module = importlib.import_module(module_name)
+    gui.server_dict['server1'] = {'server': server_url, 'postgreSQL': pg_host, 'info': 'benchmark', 'iam': '', 'snapshot_max_age': 0}
+    gui.args = argparse.Namespace(servers=['server1'], recursive=False, history=False, incremental=False)
+    rows = {'rows': 0}
+    _count_rows(module, rows)
+
+    log = module.RunLog()
+    start = time.perf_counter()
+    result = gui.process_server(0, 'admin', 'benchmark', readonly_pw, log)
+    log += result[0] if isinstance(result, tuple) else result
+    log += module.send_digests()
+    wall_time = time.perf_counter() - start
+    module.close_connection_pools()
+    peak = peak_rss_mb()
+
+    return {'wall_time': round(wall_time, 3),
+            'client_requests': sum([timing['count'] for timing in module.http_timings.values()]),
+            'repository_queries': sum([stats['queries'] for stats in module.connection_pools_stats.values()]),
+            'repository_rows': rows['rows'],
+            'emails': len(emails),
+            'errors': str(log).count('ERROR'),
+            'peak_rss_mb': round(peak, 1) if peak is not None else None,
+            'phases': {name: round(timing['total'], 3) for name, timing in module.phase_timings.items()}}
+
+
+def measure(server, process, pg_host, readonly_pw):
+    """
+    Runs a process in a new python process and returns its metrics, with the requests served by the fake server.
+    """
+    server.reset_stats()
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(os.path.join(work_dir, 'logs'))
+    env = dict(os.environ, TABLEAU_SNAPSHOT_DIR=os.path.join(work_dir, 'snapshots'), TABLEAU_WATERMARK_DIR=os.path.join(work_dir, 'watermarks'))
+    command = [sys.executable, os.path.abspath(__file__), '--child', process, '--server', server.url, '--pg-host', pg_host, '--readonly-pw', readonly_pw]
+    try:
+        completed = subprocess.run(command, cwd=work_dir, env=env, capture_output=True, text=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if completed.returncode != 0:
+        raise RuntimeError('{0} failed:\n{1}'.format(process, completed.stderr[-2000:]))
+    metrics = json.loads(completed.stdout.strip().splitlines()[-1])
+    with server.lock:
+        stats = dict(server.stats)
+    metrics['requests'] = sum([stat['requests'] for stat in stats.values()])
+    metrics['response_bytes'] = sum([stat['bytes'] for stat in stats.values()])
+    metrics['requests_per_endpoint'] = {endpoint: stat['requests'] for endpoint, stat in sorted(stats.items())}
+    return metrics
+
+
+def run_suite(sizes, processes, pg_host, pg_dsn, readonly_pw, latency=0.0, seed=0, load_fixture=True):
+    """
+    Runs every process against a synthetic site of every size.
+
+    'sizes'         numbers of objects of the sites, e.g. [1000, 10000, 100000]
+    'processes'     keys of PROCESSES
+    'pg_dsn'        connection string used to load the fixture in the repository (admin user)
+    'load_fixture'  load the fixture of each size first (False if the repository is already loaded, one size only)
+    Returns {size: {process: metrics}}
+    """
+    results = {}
+    for objects in sizes:
+        site = site_model.build_site(objects, seed)
+        if load_fixture:
+            repository_fixture.load(site, pg_dsn)
+        server = fake_tableau_server.start(site, latency=latency)
+        try:
+            results[str(objects)] = {}
+            for process in processes:
+                metrics = measure(server, process, pg_host, readonly_pw)
+                results[str(objects)][process] = metrics
+                print('{0:>8} objects  {1:<28} {2:>9.2f}s {3:>8} requests {4:>9} rows {5:>8} MB'.format(
+                    objects, process, metrics['wall_time'], metrics['requests'], metrics['repository_rows'], metrics['peak_rss_mb']))
+        finally:
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns the regressions of the results against a baseline: the metrics of COMPARED higher than
+    in the baseline by more than 'tolerance' (0.2 = 20%), for the sizes and processes in both.
+    """
+    regressions = []
+    for objects, processes in results.items():
+        for process, metrics in processes.items():
+            base = baseline['results'].get(objects, {}).get(process)
+            if base is None:
+                continue
+            for metric in COMPARED:
+                if base.get(metric) and metrics.get(metric) is not None and metrics[metric] > base[metric] * (1 + tolerance):
+                    regressions.append('{0} objects, {1}: {2} {3} -> {4}'.format(objects, process, metric, base[metric], metrics[metric]))
+    return regressions
+
+
+def save(results, path, settings):
+    """
+    Stores the results as a baseline (JSON), with the settings of the run and the machine.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'created': datetime.now().isoformat(), 'python': platform.python_version(), 'platform': platform.platform(),
+                   'settings': settings, 'results': results}, file, indent=2)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scale benchmark of the housekeeping processes against synthetic sites.')
+    parser.add_argument('--objects', type=int, nargs='+', default=[1000, 10000, 100000], help='sizes of the sites')
+    parser.add_argument('--processes', nargs='+', choices=list(PROCESSES), default=list(PROCESSES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every REST response')
+    parser.add_argument('--pg-host', default='localhost', help='host of the repository (port 8060, database workgroup)')
+    parser.add_argument('--pg-dsn', default='host=localhost port=8060 dbname=workgroup user=postgres', help='connection string used to load the fixture')
+    parser.add_argument('--readonly-pw', default='readonly', help='password of the readonly user')
+    parser.add_argument('--no-load', action='store_true', help='do not load the fixture (repository already loaded, one size only)')
+    parser.add_argument('--output', default=datetime.now().strftime(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'run_%m%d_%H%M%S.json')))
+    parser.add_argument('--save', help='also store the results as this baseline')
+    parser.add_argument('--compare', help='baseline to compare the results with, exits with 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed increase over the baseline (0.2 = 20%%)')
+    parser.add_argument('--child', choices=list(PROCESSES), help=argparse.SUPPRESS)
+    parser.add_argument('--server', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_process(args.child, args.server, args.pg_host, args.readonly_pw)))
+        sys.exit(0)
+
+    settings = {'objects': args.objects, 'seed': args.seed, 'latency': args.latency}
+    results = run_suite(args.objects, args.processes, args.pg_host, args.pg_dsn, args.readonly_pw, args.latency, args.seed, not args.no_load)
+    print('Results written to {0}'.format(save(results, args.output, settings)))
+    if args.save is not None:
+        print('Baseline written to {0}'.format(save(results, args.save, settings)))
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print('REGRESSIONS:\n- ' + '\n- '.join(regressions))
+            sys.exit(1)
+        print('No regression against {0}'.format(args.compare))
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in of the Tableau Server REST API, answering the calls made by the four
+housekeeping processes for a synthetic site (see site_model.py).
+
+to launch: -> python fake_tableau_server.py --objects 10000 --latency 0.02 [--port 8000]
+then use http://127.0.0.1:<port> as 'server' in the server_dict of the GUIs.
+"""
+
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape, quoteattr
+
+import site_model
+
+XMLNS = 'http://tableau.com/api'
+LISTINGS = {'projects': 'project', 'workbooks': 'workbook', 'datasources': 'datasource', 'views': 'view',
+            'users': 'user', 'jobs': 'backgroundJob'}
+
+
+def _xml(tag, value):
+    """
+    Renders an object of a JSON response as the XML element it stands for (the reverse of
+    _json_to_element in the processes): values become attributes, objects child elements
+    and lists repeated child elements.
+    """
+    attributes = ''.join(' {0}={1}'.format(key, quoteattr(str(val).lower() if isinstance(val, bool) else str(val)))
+                         for key, val in value.items() if val is not None and not isinstance(val, (dict, list)))
+    children = []
+    for key, val in value.items():
+        for v in (val if isinstance(val, list) else [val]):
+            if isinstance(v, dict):
+                children.append(_xml(key, v))
+            elif isinstance(val, list):
+                children.append('<{0}>{1}</{0}>'.format(key, escape(str(v))))
+    if not children:
+        return '<{0}{1}/>'.format(tag, attributes)
+    return '<{0}{1}>{2}</{0}>'.format(tag, attributes, ''.join(children))
+
+
+def _timestamp(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ') if value is not None else None
+
+
+def index_site(site):
+    """
+    Builds the REST objects of the site once: the listings (in the JSON shape of the REST API)
+    and the maps used by the single object endpoints.
+    """
+    users = {u['id']: u for u in site['users']}
+    names = {su['id']: su['name'] for su in site['system_users']}
+    projects = {p['id']: p for p in site['projects']}
+    workbooks = {w['id']: w for w in site['workbooks']}
+    groups = {g['id']: g for g in site['groups']}
+
+    listings = {}
+    listings['project'] = [{'id': p['luid'], 'name': p['name'],
+                            'parentProjectId': projects[p['parent_project_id']]['luid'] if p['parent_project_id'] else None,
+                            'owner': {'id': users[p['owner_id']]['luid']}} for p in site['projects']]
+    for obj in ('workbook', 'datasource'):
+        listings[obj] = [{'id': o['luid'], 'name': o['name'], 'contentUrl': o['repository_url'],
+                          'project': {'id': projects[o['project_id']]['luid'], 'name': projects[o['project_id']]['name']},
+                          'owner': {'id': users[o['owner_id']]['luid']}} for o in site[obj + 's']]
+    listings['view'] = [{'id': v['luid'], 'name': v['name'], 'contentUrl': v['repository_url'],
+                         'workbook': {'id': workbooks[v['workbook_id']]['luid']},
+                         'owner': {'id': users[v['owner_id']]['luid']},
+                         'project': {'id': projects[workbooks[v['workbook_id']]['project_id']]['luid']}} for v in site['views']]
+    listings['user'] = [{'id': u['luid'], 'name': names[u['system_user_id']], 'siteRole': u['site_role']} for u in site['users']]
+    listings['backgroundJob'] = [{'id': site_model.luid('job', bt['id']),
+                                  'status': 'Failed' if bt['finish_code'] == 1 else 'Success',
+                                  'createdAt': _timestamp(bt['created_at']), 'startedAt': _timestamp(bt['started_at']),
+                                  'endedAt': _timestamp(bt['completed_at']),
+                                  'jobType': 'refresh_extracts' if bt['job_name'] == 'Refresh Extracts' else 'increment_extracts',
+                                  'priority': 50} for bt in site['_background_tasks']]
+
+    permissions = {}
+    for p in site['projects']:
+        grantees = [{'user': {'id': users[uid]['luid']}, 'capabilities': {'capability': [{'name': 'ProjectLeader', 'mode': 'Allow'}]}}
+                    for uid in p['leader_user_ids']]
+        grantees += [{'group': {'id': groups[gid]['luid']}, 'capabilities': {'capability': [{'name': 'ProjectLeader', 'mode': 'Allow'}]}}
+                     for gid in p['leader_group_ids']]
+        grantees.append({'user': {'id': users[p['owner_id']]['luid']}, 'capabilities': {'capability': [{'name': 'Read', 'mode': 'Allow'}]}})
+        permissions[p['luid']] = {'project': {'id': p['luid'], 'name': p['name']}, 'granteeCapabilities': grantees}
+
+    views_by_workbook = {}
+    for view, rest_view in zip(site['views'], listings['view']):
+        views_by_workbook.setdefault(workbooks[view['workbook_id']]['luid'], []).append(rest_view)
+    members = {}
+    for gu in site['group_users']:
+        members.setdefault(groups[gu['group_id']]['luid'], []).append(listings['user'][gu['user_id'] - 1])
+
+    return {'listings': listings,
+            'users_by_luid': {u['id']: u for u in listings['user']},
+            'permissions': permissions,
+            'views_by_workbook': views_by_workbook,
+            'group_members': members,
+            'tasks': {t['luid'] for t in site['tasks']}}
+
+
+def _filter_jobs(jobs, filter_expression):
+    """
+    Applies the ?filter= expression of the jobs listing (eq/in on jobType and status, gte/lte on createdAt).
+    """
+    for field, operator, value in re.findall(r'(\w+):(\w+):(\[[^\]]*\]|[^,]*)', filter_expression):
+        if operator == 'in':
+            values = set(value.strip('[]').split(','))
+            jobs = [job for job in jobs if job.get(field) in values]
+        elif operator == 'eq':
+            jobs = [job for job in jobs if job.get(field) == value]
+        elif operator == 'gte':
+            jobs = [job for job in jobs if (job.get(field) or '') >= value]
+        elif operator == 'lte':
+            jobs = [job for job in jobs if (job.get(field) or '') <= value]
+    return jobs
+
+
+class FakeTableauServer(ThreadingHTTPServer):
+    """
+    HTTP server answering the REST calls of the processes for one synthetic site.
+
+    'site'          site returned by site_model.build_site
+    'latency'       seconds added to every response
+    'jitter'        random seconds (0 to jitter) added on top of the latency
+    'error_rate'    share of the GET requests answered with a 503 (to exercise the retries)
+    The requests served are counted per endpoint (see stats), GET /_stats returns them and DELETE /_stats resets them.
+    """
+    daemon_threads = True
+
+    def __init__(self, site, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__((host, port), RequestHandler)
+        self.site = site
+        self.rest = index_site(site)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens = set()
+        self.deleted = set()
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.url = 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def count(self, endpoint, size):
+        with self.lock:
+            stat = self.stats.setdefault(endpoint, {'requests': 0, 'bytes': 0})
+            stat['requests'] += 1
+            stat['bytes'] += size
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def _send(self, code, body=None, endpoint=None, content_type=None):
+        payload = b''
+        if body is not None:
+            payload = body.encode('utf-8')
+        headers = {}
+        if len(payload) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload, 5)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(code)
+        if payload:
+            self.send_header('Content-Type', content_type or ('application/json' if self._json() else 'application/xml'))
+        for key, val in headers.items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        if endpoint is not None:
+            self.server.count(endpoint, len(payload))
+
+    def _json(self):
+        return 'application/json' in self.headers.get('Accept', '')
+
+    def _response(self, code, value, endpoint):
+        if self._json():
+            self._send(code, json.dumps(value), endpoint)
+        else:
+            self._send(code, '<?xml version="1.0" encoding="UTF-8"?>' + _xml('tsResponse', dict(value, xmlns=XMLNS)), endpoint)
+
+    def _error(self, code, summary, detail, endpoint):
+        if self._json():
+            self._send(code, json.dumps({'error': {'code': str(code * 1000), 'summary': summary, 'detail': detail}}), endpoint)
+        else:
+            self._send(code, '<?xml version="1.0" encoding="UTF-8"?><tsResponse xmlns="{0}"><error code="{1}"><summary>{2}</summary><detail>{3}</detail></error></tsResponse>'.format(
+                XMLNS, code * 1000, escape(summary), escape(detail)), endpoint)
+
+    def _page(self, items, obj, query, endpoint):
+        page_size = int(query.get('pageSize', ['100'])[0])
+        page_number = int(query.get('pageNumber', ['1'])[0])
+        page = items[(page_number - 1) * page_size:page_number * page_size]
+        self._response(200, {'pagination': {'pageNumber': page_number, 'pageSize': page_size, 'totalAvailable': len(items)},
+                             obj + 's': {obj: page}}, endpoint)
+
+    def _route(self, method):
+        """
+        Returns the path of the request without the api version, or None after answering
+        the request itself (stats, latency, authentication and injected errors).
+        """
+        url = urlsplit(self.path)
+        if url.path == '/_stats':
+            if method == 'DELETE':
+                self.server.reset_stats()
+            with self.server.lock:
+                self._send(200, json.dumps(self.server.stats), content_type='application/json')
+            return None, None
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        path = re.sub(r'^/api/[0-9.]+', '', url.path).rstrip('/')
+        endpoint = '{0} {1}'.format(method, re.sub(r'/[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}', '/{id}', path))
+        if path != '/auth/signin' and self.headers.get('X-Tableau-Auth') not in self.server.tokens:
+            self._error(401, 'Unauthorized', 'Invalid authentication credentials were provided.', endpoint)
+            return None, None
+        if method == 'GET' and random.random() < self.server.error_rate:
+            self._error(503, 'Service Unavailable', 'Injected error.', endpoint)
+            return None, None
+        return path, (endpoint, parse_qs(url.query))
+
+    def do_POST(self):
+        path, route = self._route('POST')
+        if path is None:
+            return
+        endpoint, query = route
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path == '/auth/signin':
+            token = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.tokens.add(token)
+            self._response(200, {'credentials': {'token': token,
+                                                 'site': {'id': self.server.site['site']['id'], 'contentUrl': ''},
+                                                 'user': {'id': self.server.site['admin']['luid']}}}, endpoint)
+        elif path == '/auth/signout':
+            with self.server.lock:
+                self.server.tokens.discard(self.headers.get('X-Tableau-Auth'))
+            self._send(204, endpoint=endpoint)
+        else:
+            self._error(404, 'Resource Not Found', path, endpoint)
+
+    def do_DELETE(self):
+        path, route = self._route('DELETE')
+        if path is None:
+            return
+        endpoint, query = route
+        match = re.match(r'^/sites/[^/]+/(tasks/extractRefreshes|users|subscriptions)/([^/]+)$', path)
+        rest = self.server.rest
+        if match is None:
+            self._error(404, 'Resource Not Found', path, endpoint)
+            return
+        known = rest['tasks'] if match.group(1) != 'users' else rest['users_by_luid']
+        with self.server.lock:
+            found = match.group(2) in known and match.group(2) not in self.server.deleted
+            self.server.deleted.add(match.group(2))
+        if found:
+            self._send(204, endpoint=endpoint)
+        else:
+            self._error(404, 'Resource Not Found', match.group(2), endpoint)
+
+    def do_GET(self):
+        path, route = self._route('GET')
+        if path is None:
+            return
+        endpoint, query = route
+        rest = self.server.rest
+        parts = path.split('/')[1:]
+        # /sites/{site}/<listing>
+        if len(parts) == 3 and parts[0] == 'sites' and parts[2] in LISTINGS:
+            obj = LISTINGS[parts[2]]
+            items = rest['listings'][obj]
+            if obj == 'backgroundJob' and 'filter' in query:
+                items = _filter_jobs(items, query['filter'][0])
+            self._page(items, obj, query, endpoint)
+        # /sites/{site}/users/{user}/workbooks
+        elif len(parts) == 5 and parts[2] == 'users' and parts[4] == 'workbooks':
+            self._page(rest['listings']['workbook'], 'workbook', query, endpoint)
+        # /sites/{site}/users/{user}
+        elif len(parts) == 4 and parts[2] == 'users':
+            user = rest['users_by_luid'].get(parts[3])
+            if user is None:
+                self._error(404, 'Resource Not Found', parts[3], endpoint)
+            else:
+                self._response(200, {'user': user}, endpoint)
+        # /sites/{site}/projects/{project}/permissions
+        elif len(parts) == 5 and parts[2] == 'projects' and parts[4] == 'permissions':
+            if parts[3] not in rest['permissions']:
+                self._error(404, 'Resource Not Found', parts[3], endpoint)
+            else:
+                self._response(200, {'permissions': rest['permissions'][parts[3]]}, endpoint)
+        # /sites/{site}/workbooks/{workbook}/views
+        elif len(parts) == 5 and parts[2] == 'workbooks' and parts[4] == 'views':
+            self._response(200, {'views': {'view': rest['views_by_workbook'].get(parts[3], [])}}, endpoint)
+        # /sites/{site}/groups/{group}/users
+        elif len(parts) == 5 and parts[2] == 'groups' and parts[4] == 'users':
+            self._page(rest['group_members'].get(parts[3], []), 'user', query, endpoint)
+        else:
+            self._error(404, 'Resource Not Found', path, endpoint)
+
+
+def start(site, port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+    """
+    Starts the server in a background thread and returns it (its address is server.url,
+    server.shutdown() stops it).
+    """
+    server = FakeTableauServer(site, port=port, latency=latency, jitter=jitter, error_rate=error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in of the Tableau REST API for a synthetic site.')
+    parser.add_argument('--objects', type=int, default=1000, help='projects + workbooks + datasources + views of the site')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic site')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added on top of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of the GET requests answered with a 503')
+    args = parser.parse_args()
+
+    server = FakeTableauServer(site_model.build_site(args.objects, args.seed), port=args.port,
+                               latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    print('Fake Tableau server for {0} objects on {1} (admin user: admin, any password)'.format(args.objects, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded stand-in of the Tableau repository (workgroup database) for a synthetic site (see site_model.py):
+the tables read by the processes, with the same ids, luids and names as the fake REST server.
+
+to write a SQL file (for psql):  -> python repository_fixture.py --objects 10000 --sql fixtures/workgroup_10000.sql
+to load a local PostgreSQL:      -> python repository_fixture.py --objects 10000 --dsn "host=localhost port=8060 dbname=workgroup user=postgres"
+
+The processes connect to port 8060, database workgroup, as user readonly (see get_connection):
+the tables are granted to readonly when that role exists.
+"""
+
+import argparse
+import io
+import os
+
+import site_model
+
+#Columns of the tables read by the processes (name, type), in the order they are written
+SCHEMA = {
+    'system_users': [('id', 'integer primary key'), ('name', 'text'), ('email', 'text'), ('friendly_name', 'text')],
+    'users': [('id', 'integer primary key'), ('luid', 'uuid'), ('system_user_id', 'integer'), ('site_id', 'integer'), ('site_role', 'text')],
+    '_users': [('id', 'integer primary key'), ('name', 'text'), ('system_user_id', 'integer'), ('licensing_role_name', 'text')],
+    'groups': [('id', 'integer primary key'), ('luid', 'uuid'), ('name', 'text')],
+    'group_users': [('id', 'integer primary key'), ('group_id', 'integer'), ('user_id', 'integer')],
+    'projects': [('id', 'integer primary key'), ('luid', 'uuid'), ('name', 'text'), ('parent_project_id', 'integer'), ('owner_id', 'integer')],
+    'workbooks': [('id', 'integer primary key'), ('luid', 'uuid'), ('name', 'text'), ('repository_url', 'text'), ('project_id', 'integer'), ('owner_id', 'integer')],
+    'datasources': [('id', 'integer primary key'), ('luid', 'uuid'), ('name', 'text'), ('repository_url', 'text'), ('project_id', 'integer'), ('owner_id', 'integer')],
+    'views': [('id', 'integer primary key'), ('luid', 'uuid'), ('name', 'text'), ('repository_url', 'text'), ('workbook_id', 'integer'), ('owner_id', 'integer')],
+    'subscriptions': [('id', 'integer primary key'), ('target_id', 'integer'), ('target_type', 'text'), ('user_id', 'integer')],
+    'tasks': [('id', 'integer primary key'), ('luid', 'uuid'), ('type', 'text'), ('obj_id', 'integer'), ('obj_type', 'text'), ('consecutive_failure_count', 'integer')],
+    '_background_tasks': [('id', 'integer primary key'), ('args', 'text'), ('title', 'text'), ('created_at', 'timestamp'), ('started_at', 'timestamp'),
+                          ('completed_at', 'timestamp'), ('job_type', 'text'), ('job_name', 'text'), ('notes', 'text'), ('finish_code', 'integer')],
+}
+#Indexes matching the lookups of the processes
+INDEXES = ['create index on tasks (type, consecutive_failure_count)',
+           'create index on _background_tasks (job_name)',
+           'create index on workbooks (luid)',
+           'create index on views (luid)']
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_data(site, table):
+    """
+    Returns the rows of a table in the text format of COPY ... FROM stdin.
+    """
+    columns = [column for column, column_type in SCHEMA[table]]
+    return ''.join('\t'.join(_copy_value(row.get(column)) for column in columns) + '\n' for row in site[table])
+
+
+def schema_sql():
+    """
+    Returns the statements creating the tables (dropped first when they exist).
+    """
+    statements = []
+    for table, columns in SCHEMA.items():
+        statements.append('drop table if exists {0}'.format(table))
+        statements.append('create table {0} ({1})'.format(table, ', '.join('{0} {1}'.format(column, column_type) for column, column_type in columns)))
+    return statements
+
+
+def write_sql(site, path):
+    """
+    Writes the whole fixture (schema, data, indexes and grants) as a SQL file for psql.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        for statement in schema_sql():
+            file.write(statement + ';\n')
+        for table, columns in SCHEMA.items():
+            file.write('copy {0} ({1}) from stdin;\n'.format(table, ', '.join(column for column, column_type in columns)))
+            file.write(copy_data(site, table))
+            file.write('\\.\n')
+        for statement in INDEXES:
+            file.write(statement + ';\n')
+        file.write("do $$ begin if exists (select 1 from pg_roles where rolname = 'readonly') then grant select on all tables in schema public to readonly; end if; end $$;\n")
+    return path
+
+
+def load(site, dsn):
+    """
+    Creates the fixture in a PostgreSQL database (psycopg2 connection string 'dsn').
+    Returns the number of rows loaded per table.
+    """
+    import psycopg2
+    connection = psycopg2.connect(dsn)
+    rows = {}
+    try:
+        cursor = connection.cursor()
+        for statement in schema_sql():
+            cursor.execute(statement)
+        for table, columns in SCHEMA.items():
+            cursor.copy_expert('copy {0} ({1}) from stdin'.format(table, ', '.join(column for column, column_type in columns)), io.StringIO(copy_data(site, table)))
+            rows[table] = len(site[table])
+        for statement in INDEXES:
+            cursor.execute(statement)
+        cursor.execute("select 1 from pg_roles where rolname = 'readonly'")
+        if cursor.fetchone() is not None:
+            cursor.execute('grant select on all tables in schema public to readonly')
+        connection.commit()
+    finally:
+        connection.close()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Seeded stand-in of the Tableau repository for a synthetic site.')
+    parser.add_argument('--objects', type=int, default=1000, help='projects + workbooks + datasources + views of the site')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic site (same as the fake server)')
+    parser.add_argument('--history-days', type=int, default=14, help='days of extract refresh history in _background_tasks')
+    parser.add_argument('--sql', help='path of the SQL file to write')
+    parser.add_argument('--dsn', help='PostgreSQL connection string of the database to load')
+    args = parser.parse_args()
+    if args.sql is None and args.dsn is None:
+        parser.error('Please specify --sql and/or --dsn.')
+
+    site = site_model.build_site(args.objects, args.seed, args.history_days)
+    if args.sql is not None:
+        print('Fixture written to {0}'.format(write_sql(site, args.sql)))
+    if args.dsn is not None:
+        rows = load(site, args.dsn)
+        print('Fixture loaded: ' + ', '.join('{0} {1}'.format(table, count) for table, count in rows.items()))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Tableau site shared by the fake REST server and the repository fixture,
+so that the ids, names and owners answered by both are the same.
+
+The site is generated from its size and a seed only: the same arguments always give the same site.
+"""
+
+import random
+import uuid
+from datetime import datetime, timedelta
+
+#Namespace of the luids of the synthetic objects
+LUID_NAMESPACE = uuid.UUID('6f0d8c52-3f4e-4a51-9d0e-0c1b5a7e2f10')
+#Day the background tasks history ends on (fixed, so that the site does not change from one day to the next)
+HISTORY_END = datetime(2024, 1, 31, 6, 0, 0)
+
+
+def luid(kind, number):
+    """
+    Returns the luid (REST id) of an object of the site.
+
+    'kind'      table of the object: project, workbook, datasource, view, user, group, task, job, site
+    'number'    repository id of the object
+    """
+    return str(uuid.uuid5(LUID_NAMESPACE, '{0}-{1}'.format(kind, number)))
+
+
+def build_site(objects=1000, seed=0, history_days=14):
+    """
+    Generates a site of about 'objects' projects, workbooks, datasources and views.
+
+    'objects'       number of projects + workbooks + datasources + views
+    'seed'          seed of the random generator
+    'history_days'  days of extract refresh history in _background_tasks
+    Returns a dictionary table name -> list of rows (dictionaries), named and shaped as the tables
+    of the Tableau repository read by the processes, plus 'site' (id, name) and 'admin' (the signed in user).
+    """
+    rng = random.Random(seed)
+    n_projects = max(4, objects // 20)
+    n_workbooks = max(2, objects * 3 // 10)
+    n_datasources = max(2, objects * 3 // 20)
+    n_views = max(2, objects - n_projects - n_workbooks - n_datasources)
+    n_users = max(10, objects // 10)
+    n_groups = max(2, objects // 500)
+
+    site = {'site': {'id': luid('site', 1), 'name': 'Default', 'contentUrl': ''}}
+
+    # users: every 20th user is unlicensed, user 1 is the administrator used to sign in
+    system_users, users, _users = [], [], []
+    for i in range(1, n_users + 1):
+        name = 'admin' if i == 1 else 'user{0:06d}'.format(i)
+        role = 'Unlicensed' if i % 20 == 0 else ('ServerAdministrator' if i == 1 else 'Explorer')
+        system_users.append({'id': i, 'name': name, 'email': name, 'friendly_name': name.title()})
+        users.append({'id': i, 'luid': luid('user', i), 'system_user_id': i, 'site_id': 1, 'site_role': role})
+        _users.append({'id': i, 'name': name, 'system_user_id': i, 'licensing_role_name': role})
+    site['system_users'] = system_users
+    site['users'] = users
+    site['_users'] = _users
+    site['admin'] = users[0]
+    licensed = [u['id'] for u in users if u['site_role'] != 'Unlicensed']
+    all_users = [u['id'] for u in users]
+
+    groups, group_users = [], []
+    for i in range(1, n_groups + 1):
+        groups.append({'id': i, 'luid': luid('group', i), 'name': 'group{0:04d}'.format(i)})
+        for member in rng.sample(licensed, min(len(licensed), 5)):
+            group_users.append({'id': len(group_users) + 1, 'group_id': i, 'user_id': member})
+    site['groups'] = groups
+    site['group_users'] = group_users
+
+    # projects: the first quarter are top-level, the others are subprojects of an earlier project;
+    # the last tenth has no content (empty projects), as well as the last tenth of the top-level
+    # projects, which have no subproject either (the empty projects found without --recursive)
+    projects = []
+    n_top = max(2, n_projects // 4)
+    empty_top = set(range(n_top - max(1, n_top // 10) + 1, n_top + 1))
+    parents = []
+    for i in range(1, n_projects + 1):
+        parent = None if i <= n_top else rng.choice(parents)
+        if i not in empty_top:
+            parents.append(i)
+        leaders = rng.sample(licensed, rng.randint(1 if i in empty_top else 0, 2))
+        projects.append({'id': i, 'luid': luid('project', i), 'name': 'Project {0:05d}'.format(i),
+                         'parent_project_id': parent, 'owner_id': rng.choice(all_users),
+                         'leader_user_ids': leaders,
+                         'leader_group_ids': [rng.randint(1, n_groups)] if rng.random() < 0.3 else []})
+    site['projects'] = projects
+    with_content = [p['id'] for p in projects[:max(1, n_projects - n_projects // 10)] if p['id'] not in empty_top]
+
+    workbooks = []
+    for i in range(1, n_workbooks + 1):
+        workbooks.append({'id': i, 'luid': luid('workbook', i), 'name': 'Workbook {0:06d}'.format(i),
+                          'repository_url': 'Workbook{0:06d}'.format(i),
+                          'project_id': rng.choice(with_content), 'owner_id': rng.choice(all_users)})
+    site['workbooks'] = workbooks
+
+    datasources = []
+    for i in range(1, n_datasources + 1):
+        datasources.append({'id': i, 'luid': luid('datasource', i), 'name': 'Datasource {0:06d}'.format(i),
+                            'repository_url': 'Datasource{0:06d}'.format(i),
+                            'project_id': rng.choice(with_content), 'owner_id': rng.choice(all_users)})
+    site['datasources'] = datasources
+
+    views = []
+    for i in range(1, n_views + 1):
+        workbook = workbooks[(i - 1) % n_workbooks]
+        views.append({'id': i, 'luid': luid('view', i), 'name': 'View {0:06d}'.format(i),
+                      'repository_url': '{0}/sheets/View{1:06d}'.format(workbook['repository_url'], i),
+                      'workbook_id': workbook['id'], 'owner_id': workbook['owner_id']})
+    site['views'] = views
+
+    # extract refresh tasks on one workbook/datasource out of 5, a quarter of them failing;
+    # subscriptions on one view out of 10, a fifth of them failing
+    tasks = []
+    for obj_type, rows in (('Workbook', workbooks), ('Datasource', datasources)):
+        for row in rows[::5]:
+            failures = rng.randint(5, 20) if rng.random() < 0.25 else rng.choice([0, 0, 0, 1, 2])
+            tasks.append({'id': len(tasks) + 1, 'luid': luid('task', len(tasks) + 1),
+                          'type': rng.choice(['RefreshExtractTask', 'IncrementExtractTask']),
+                          'obj_id': row['id'], 'obj_type': obj_type, 'obj_name': row['name'],
+                          'consecutive_failure_count': failures})
+    subscriptions = []
+    for view in views[::10]:
+        subscriptions.append({'id': len(subscriptions) + 1, 'target_id': view['id'], 'target_type': 'View',
+                              'user_id': rng.choice(licensed)})
+        tasks.append({'id': len(tasks) + 1, 'luid': luid('task', len(tasks) + 1), 'type': 'SingleSubscriptionTask',
+                      'obj_id': len(subscriptions), 'obj_type': 'Subscription', 'obj_name': view['name'],
+                      'consecutive_failure_count': rng.randint(5, 15) if rng.random() < 0.2 else 0})
+    site['tasks'] = tasks
+    site['subscriptions'] = subscriptions
+
+    # one refresh a day per extract task, the last 'consecutive_failure_count' ones failed
+    background_tasks = []
+    start = HISTORY_END - timedelta(days=history_days - 1)
+    for task in tasks:
+        if task['type'] == 'SingleSubscriptionTask':
+            continue
+        job_name = 'Refresh Extracts' if task['type'] == 'RefreshExtractTask' else 'Increment Extracts'
+        for day in range(history_days):
+            created_at = start + timedelta(days=day, minutes=rng.randint(0, 120))
+            failed = history_days - day <= task['consecutive_failure_count']
+            background_tasks.append({'id': len(background_tasks) + 1,
+                                     'args': '---\n- {0}\n- {1}\n- {2}'.format(task['obj_type'], task['obj_id'], task['obj_name']),
+                                     'title': task['obj_name'], 'created_at': created_at,
+                                     'started_at': created_at + timedelta(seconds=30),
+                                     'completed_at': created_at + timedelta(seconds=rng.randint(60, 900)),
+                                     'job_type': 'RefreshExtracts', 'job_name': job_name,
+                                     'notes': 'Extract refresh failed' if failed else None,
+                                     'finish_code': 1 if failed else 0})
+    site['_background_tasks'] = background_tasks
+    return site
@@ -6,40 +6,165 @@ Created on Tue Mar 23 09:24:25 2021
 """
 
 import requests # Contains methods used to make HTTP requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import random
 import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+import io
 import math
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
 import win32com.client as client
 import pandas as pd
 import os
+import re
+import json
 import psycopg2
+import psycopg2.pool
+import threading
+import time
+import bisect
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 def setup():
-    global verifySsl, VERSION, xmlns
+    global verifySsl, VERSION, xmlns, RESPONSE_FORMAT, PAGE_WORKERS, SNAPSHOT_DIR, POOL_SIZE, HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF, LATENCY_BUCKETS
     
     verifySsl = False
     #Tableau Server version nr.
     VERSION = '3.4'
     xmlns = {'t': 'http://tableau.com/api'}
+    #Format of the REST responses: 'xml' or 'json'
+    RESPONSE_FORMAT = os.environ.get('TABLEAU_RESPONSE_FORMAT', 'xml').lower()
+    #Number of pages requested at the same time when listing objects
+    PAGE_WORKERS = 4
+    #Folder of the object listings shared by the housekeeping processes
+    SNAPSHOT_DIR = os.environ.get('TABLEAU_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'snapshots'))
+    #Maximum number of connections kept open to each postgreSQL repository
+    POOL_SIZE = 4
+    #Connections kept alive to each Tableau server by the session of new_session
+    HTTP_POOL_SIZE = 16
+    #Number of retries of a GET request (connection error, 429 or 5xx), waiting about HTTP_BACKOFF * 2^attempt seconds in between
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF = 0.5
+    #Upper bounds in seconds of the latency histograms of metrics_summary (the last bucket counts the slower calls)
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+#Names of the users per server (user id -> name), filled by load_user_names and user_id2name
+user_names = {}
+#Project leaders per server (project id -> (users, groups)) and cache hit/miss counters, filled by get_project_leader
+project_leaders = {}
+project_leaders_stats = {}
+#Connection pools to the postgreSQL repositories (host -> pool) and their usage, shared by every query of the run
+connection_pools = {}
+connection_pools_stats = {}
+connection_pools_lock = threading.Lock()
+#Time of the REST requests per endpoint ('GET /sites/{id}/workbooks' -> count, total and max seconds, histogram), filled by _record_timing
+http_timings = {}
+http_timings_lock = threading.Lock()
+#Time of the phases of the processes (function or step -> count, total and max seconds, histogram), filled by phase
+phase_timings = {}
+phase_timings_lock = threading.Lock()
+#Time of the repository queries per table read (table -> count, rows, total and max seconds, histogram), filled by postgresql_batches
+query_timings = {}
+query_timings_lock = threading.Lock()
+#Findings waiting to be emailed (recipient -> findings with the role of the recipient), filled by queue_digest and emptied by send_digests
+digests = {}
+digests_lock = threading.Lock()
 
 
 #Configurations for different ECB Tableau servers
 
+class RunLog:
+    """
+    Log of a run, written to disk as it grows.
+
+    Every text added with += is one record (time, server, level, text) of the JSON Lines file
+    logs/run_<start>.jsonl, appended in batches of 'buffer_size' records. The readable report,
+    the text of all the records, is rendered once at the end by render().
+    """
+    def __init__(self, server=None, path=None, buffer_size=50, lock=None):
+        self.server = server
+        self.path = path or datetime.now().strftime("logs/run_%m%d_%H%M%S.jsonl")
+        self.buffer_size = buffer_size
+        self.lock = lock or threading.Lock()
+        self.texts = []
+        self.buffer = []
+
+    def __iadd__(self, text):
+        if isinstance(text, RunLog):
+            # log of a server processed by a worker: its records are already in the file
+            text.flush()
+            self.texts.extend(text.texts)
+            return self
+        if text == '':
+            return self
+        self.texts.append(text)
+        level = 'error' if 'ERROR' in text else 'warning' if 'WARNING' in text else 'info'
+        self.buffer.append({'time': datetime.now().isoformat(), 'server': self.server, 'level': level, 'text': text})
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return self
+
+    def __str__(self):
+        return ''.join(self.texts)
+
+    def child(self, server):
+        """
+        Returns the log of one server of the run, written to the same file.
+        """
+        return RunLog(server, self.path, self.buffer_size, self.lock)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(''.join(json.dumps(record) + '\n' for record in self.buffer))
+        self.buffer = []
+
+    def render(self, logfile_name=None):
+        """
+        Writes the readable report of the run (logs/log_<start>.txt by default) and returns its path.
+        """
+        self.flush()
+        if logfile_name == None:
+            logfile_name = self.path.replace('run_', 'log_')[:-len('.jsonl')] + '.txt'
+        with open(logfile_name, 'w', encoding='utf-8') as file:
+            file.write(str(self))
+        return logfile_name
+
+
 class ApiCallError(Exception):
     pass
 
 class UserDefinedFieldError(Exception):
     pass
 
-def _encode_for_display(text):
-    """
-    Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+class ProcessStopped(Exception):
+    pass
 
-    Returns an ASCII-encoded version of the text.
-    Unicode characters are converted to ASCII placeholders (for example, "?").
+def log_file(log):
     """
-    return text.encode('ascii', errors="backslashreplace").decode('utf-8')
+    Writes the log, opens it and stops the process after an error.
+    The log of a server processed by a worker (see RunLog.child) is not written here, as the servers run
+    at the same time: ProcessStopped ends the server, its log is merged with the others and written once by the GUI.
+    """
+    if isinstance(log, RunLog) and log.server is not None:
+        raise ProcessStopped('see the errors above')
+    if isinstance(log, RunLog):
+        logfile_name = log.render()
+    else:
+        logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
+        file = open(logfile_name, "w", encoding="utf-8") 
+        file.write(log)
+        file.close()
+    os.system(logfile_name.replace('/', '\\'))
+    error()
+    return
 
 
 def _check_status(server_response, success_code):
@@ -51,7 +176,20 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        if RESPONSE_FORMAT == 'json':
+            try:
+                error = server_response.json().get('error', {})
+            except (ValueError, AttributeError):
+                # not an error of the REST API (e.g. the HTML page of a proxy): report the status and the body
+                raise ApiCallError('HTTP {0}: {1}'.format(server_response.status_code, server_response.text[:500]))
+            raise ApiCallError('{0}: {1} - {2}'.format(error.get('code', 'unknown code'), error.get('summary', 'unknown summary'), error.get('detail', 'unknown detail')))
+        try:
+            parsed_response = ET.fromstring(server_response.text)
+        except ET.ParseError:
+            parsed_response = None
+        if parsed_response is None or parsed_response.find('t:error', namespaces=xmlns) is None:
+            # not an error of the REST API (e.g. the HTML page of a proxy): report the status and the body
+            raise ApiCallError('HTTP {0}: {1}'.format(server_response.status_code, server_response.text[:500]))
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -66,6 +204,169 @@ def _check_status(server_response, success_code):
         raise ApiCallError(error_message)
     return
 
+def _headers(auth_token=None):
+    """
+    Returns the headers of a REST call: the authentication token, and the Accept header in JSON mode.
+    """
+    headers = {}
+    if auth_token != None:
+        headers['x-tableau-auth'] = auth_token
+    if RESPONSE_FORMAT == 'json':
+        headers['Accept'] = 'application/json'
+    return headers
+
+
+def _json_to_element(tag, value):
+    """
+    Converts an object of a JSON response into the element of the XML response it stands for:
+    values become attributes, objects become child elements and lists become repeated child elements.
+    """
+    element = ET.Element('{{{0}}}{1}'.format(xmlns['t'], tag))
+    for key, val in value.items():
+        for v in (val if isinstance(val, list) else [val]):
+            if isinstance(v, dict):
+                element.append(_json_to_element(key, v))
+            elif isinstance(val, list):
+                ET.SubElement(element, '{{{0}}}{1}'.format(xmlns['t'], key)).text = str(v)
+            elif isinstance(v, bool):
+                element.set(key, str(v).lower())
+            else:
+                element.set(key, str(v))
+    return element
+
+
+def _parse_response(server_response):
+    """
+    Parses the response of a REST call, XML or JSON (see RESPONSE_FORMAT), into an XML element,
+    so that the objects are read the same way in both modes.
+    """
+    if RESPONSE_FORMAT == 'json':
+        return _json_to_element('tsResponse', server_response.json())
+    return ET.fromstring(server_response.content)
+
+
+class JitterRetry(Retry):
+    """
+    Retry policy of urllib3 adding a random jitter to the backoff, so that the workers of a run do not all retry at the same time.
+    """
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, backoff)
+
+
+def _endpoint(request):
+    """
+    Returns the endpoint of a request: method and path, without the api version, the ids and the query.
+    """
+    path = urlsplit(request.url).path
+    path = re.sub(r'^/api/[0-9.]+', '', path)
+    path = re.sub(r'/[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|/[0-9]+(?=/|$)', '/{id}', path)
+    return '{0} {1}'.format(request.method, path)
+
+
+def _add_timing(timings, lock, name, elapsed, **counters):
+    """
+    Adds one call to the timings of 'name': count, total and max seconds, calls per bucket of LATENCY_BUCKETS
+    and the 'counters' (e.g. rows=10) summed over the calls.
+    """
+    with lock:
+        timing = timings.setdefault(name, dict({'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}, **{counter: 0 for counter in counters}))
+        timing['count'] += 1
+        timing['total'] += elapsed
+        timing['max'] = max(timing['max'], elapsed)
+        timing['buckets'][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        for counter, value in counters.items():
+            timing[counter] += value
+    return
+
+
+@contextmanager
+def phase(name):
+    """
+    Span of a phase of the process, its time is added to phase_timings (see metrics_summary).
+    Used around a step ("with phase('...'):") or as decorator of a function ("@phase('get_all')").
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_timing(phase_timings, phase_timings_lock, name, time.perf_counter() - start)
+
+
+def _record_timing(server_response, *args, **kwargs):
+    """
+    Response hook of the sessions, records the time of the request in http_timings.
+    """
+    _add_timing(http_timings, http_timings_lock, _endpoint(server_response.request), server_response.elapsed.total_seconds())
+    return server_response
+
+
+def new_session():
+    """
+    Creates the session used for all the REST calls to a server: up to HTTP_POOL_SIZE keep-alive connections
+    (one TLS handshake per connection instead of one per call), gzip responses, GET requests retried with
+    backoff and jitter, and the time of every request recorded per endpoint (see metrics_summary).
+    """
+    session = requests.Session()
+    session.trust_env = False
+    retry = JitterRetry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.hooks['response'].append(_record_timing)
+    return session
+
+
+def _timings_table(title, timings, lock, counters=()):
+    """
+    Returns the log lines of a table of timings, longest total first: count, 'counters', total, average
+    and max seconds, and the number of calls per bucket of LATENCY_BUCKETS.
+    """
+    with lock:
+        rows = sorted([(name, dict(timing, buckets=list(timing['buckets']))) for name, timing in timings.items()], key=lambda row: -row[1]['total'])
+    header = ['count'] + list(counters) + ['total', 'average', 'max'] + ['<={0}s'.format(bound) for bound in LATENCY_BUCKETS] + ['>{0}s'.format(LATENCY_BUCKETS[-1])]
+    width = max([len(title)] + [len(name) for name, timing in rows])
+    text = '\n\n{0:<{1}} '.format(title, width) + ' '.join(['{0:>8}'.format(column) for column in header])
+    for name, timing in rows:
+        values = [timing['count']] + [timing[counter] for counter in counters]
+        values += ['{0:.3f}s'.format(seconds) for seconds in (timing['total'], timing['total'] / timing['count'], timing['max'])] + timing['buckets']
+        text += '\n{0:<{1}} '.format(name, width) + ' '.join(['{0:>8}'.format(value) for value in values])
+    return text
+
+
+def metrics_summary():
+    """
+    Returns the summary tables written at the end of the log: the phases of the processes (the spans of
+    the servers processed at the same time add up), the REST requests per endpoint and the repository queries per table.
+    """
+    return (_timings_table('Phases', phase_timings, phase_timings_lock)
+            + _timings_table('REST requests', http_timings, http_timings_lock)
+            + _timings_table('Repository queries', query_timings, query_timings_lock, ('rows',)))
+
+
+def write_metrics(path=None):
+    """
+    Writes the metrics of the run (see metrics_summary, plus the connection pools) as a JSON file and returns its path.
+
+    'path'          logs/metrics_<time>.json by default
+    """
+    if path == None:
+        path = datetime.now().strftime("logs/metrics_%m%d_%H%M%S.json")
+    metrics = {'latency_buckets': list(LATENCY_BUCKETS)}
+    for name, timings, lock in (('phases', phase_timings, phase_timings_lock), ('http', http_timings, http_timings_lock), ('queries', query_timings, query_timings_lock)):
+        with lock:
+            metrics[name] = json.loads(json.dumps(timings))
+    with connection_pools_lock:
+        metrics['connection_pools'] = {host: {'queries': stats['queries'], 'connections': len(stats['connections'])} for host, stats in connection_pools_stats.items()}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(metrics, file, indent=2)
+    return path
+
+
+@phase('sign_in')
 def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
@@ -88,15 +389,12 @@ def sign_in(session, server, username, password, site=""):
     xml_request = ET.tostring(xml_request)
 
     # Make the request to server
-    server_response = session.post(url, data=xml_request, verify=verifySsl) 
+    server_response = session.post(url, data=xml_request, headers=_headers(), verify=verifySsl) 
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
     # Reads and parses the response
     try:
-        parsed_response = ET.fromstring(server_response)
+        parsed_response = _parse_response(server_response)
     except Exception as err:
         print("There was an error parsing the server response. This error may be linked to incorrect credentials.")
         raise
@@ -116,11 +414,11 @@ def sign_out(session, server, auth_token):
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
     
-    server_response = session.post(url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
+    server_response = session.post(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 204)
     return
 
-def get_empty_projects(session, server, auth_token, site_id, user_id, page_size, page_num):
+def get_empty_projects(session, server, auth_token, site_id, user_id, page_size, page_num, snapshot_max_age=0, recursive=False):
     
     """
     return the list of empty projects and hierarchy
@@ -130,28 +428,118 @@ def get_empty_projects(session, server, auth_token, site_id, user_id, page_size,
     'site_id'       ID of the site that the user is signed into
     'user_id'       ID of user with access to workbook
     'proj_name'     name of project from which one wants to find the objects
+    'snapshot_max_age'  age in hours under which the listings saved by a previous process are reused
+    'recursive'     see find_empty_projects
     """
 
     # retrieve all objects
-    all_projects = get_all(session, server, auth_token, user_id, site_id, page_size, page_num, 'project')
-    all_workbooks = get_all(session, server, auth_token, user_id, site_id, page_size, page_num, 'workbook')
-    all_datasources = get_all(session, server, auth_token, user_id, site_id, page_size, page_num, 'datasource')
+    inventory = get_inventory(session, server, auth_token, user_id, site_id, page_size, page_num, ('project', 'workbook', 'datasource'), PAGE_WORKERS, snapshot_max_age)
+    all_projects = inventory['project']
+    all_workbooks = inventory['workbook']
+    all_datasources = inventory['datasource']
     
     # find empty_projects
-    empty_projects = []
-    for proj in all_projects:
-        workbooks_in_project = [wb.get('name') for wb in all_workbooks if wb.find('.//t:project', namespaces=xmlns).get('id') == proj.get('id')]
-        datasources_in_project = [ds.get('name') for ds in all_datasources if ds.find('.//t:project', namespaces=xmlns).get('id') == proj.get('id')]
-        subprojects_in_project = [pj.get('name') for pj in all_projects if pj.get('parentProjectId') ==  proj.get('id')]
-        
-        if len(workbooks_in_project) + len(datasources_in_project) + len(subprojects_in_project) == 0:
-            if proj.get('parentProjectId') == None:
-                empty_projects.append(proj)
+    empty_projects = find_empty_projects(all_projects, all_workbooks, all_datasources, recursive)
         
     return empty_projects, all_projects
+
+
+def find_empty_projects(all_projects, all_workbooks, all_datasources, recursive=False):
+    """
+    Finds the empty projects, counting the content of every project with one sweep over each listing
+
+    'all_projects'      project elements returned by get_all
+    'all_workbooks'     workbook elements returned by get_all
+    'all_datasources'   datasource elements returned by get_all
+    'recursive'         False: top-level projects without workbooks, datasources and subprojects
+                        True: projects whose whole subtree contains no workbook or datasource
+                        (only the highest project of every empty subtree is returned)
+    """
+    # number of workbooks and datasources per project id
+    content = Counter()
+    for obj in all_workbooks + all_datasources:
+        project = obj.find('t:project', namespaces=xmlns)
+        if project is not None:
+            content[project.get('id')] += 1
+
+    # subprojects per project id (top-level projects are under None)
+    children = {}
+    for proj in all_projects:
+        children.setdefault(proj.get('parentProjectId'), []).append(proj)
+
+    if not recursive:
+        return [proj for proj in all_projects if proj.get('parentProjectId') == None and content[proj.get('id')] == 0 and proj.get('id') not in children]
+
+    # visit parents before children, then decide from the leaves upwards
+    project_ids = set(proj.get('id') for proj in all_projects)
+    stack = [proj for proj in all_projects if proj.get('parentProjectId') not in project_ids]
+    order = []
+    visited = set()
+    while stack:
+        proj = stack.pop()
+        if proj.get('id') in visited:
+            continue
+        visited.add(proj.get('id'))
+        order.append(proj)
+        stack.extend(children.get(proj.get('id'), []))
+
+    empty = {}
+    for proj in reversed(order):
+        empty[proj.get('id')] = content[proj.get('id')] == 0 and all(empty.get(sub.get('id'), False) for sub in children.get(proj.get('id'), []))
+
+    return [proj for proj in all_projects if empty.get(proj.get('id')) and not empty.get(proj.get('parentProjectId'))]
     
 
-def get_all(session, server, auth_token, user_id, site_id, page_size, page_num, obj):
+def _parse_items(content, obj):
+    """
+    Parses a listing page incrementally, straight from the bytes of the response.
+
+    'content'       raw body of the server response
+    'obj'           object listed: workbook, datasource, project, view, user
+    Returns the items of the listing, each one detached from the page as soon as it is read,
+    and the total number of items available.
+    """
+    item_tag = '{{{0}}}{1}'.format(xmlns['t'], obj)
+    list_tag = item_tag + 's'
+    pagination_tag = '{{{0}}}pagination'.format(xmlns['t'])
+    items = []
+    total_items = None
+    parents = []
+    for event, element in ET.iterparse(io.BytesIO(content), events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag == item_tag and len(parents) > 0 and parents[-1].tag == list_tag:
+            items.append(element)
+            parents[-1].remove(element)
+        elif element.tag == pagination_tag:
+            total_items = int(element.get('totalAvailable'))
+    return items, total_items
+
+
+def _get_page(session, url, auth_token, page_size, page_num, obj):
+    """
+    Gets one page of objects from ECB/ESCB Tableau server.
+
+    'url'           listing address of the object, without paging parameters (filters allowed)
+    'auth_token'    authentication token that grants user access to API calls
+    'obj'           object to be retrieved: workbook, datasource, project, view
+    Returns the items in the page and the total number of items available.
+    """
+    paged_url = url + ("&" if "?" in url else "?") + "pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+    server_response = session.get(paged_url, headers=_headers(auth_token), verify=verifySsl)
+    _check_status(server_response, 200)
+    if RESPONSE_FORMAT == 'json':
+        xml_response = _parse_response(server_response)
+        items = xml_response.findall('t:{0}s/t:{0}'.format(obj), namespaces=xmlns)
+        return items, int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
+    return _parse_items(server_response.content, obj)
+
+
+@phase('get_all')
+def get_all(session, server, auth_token, user_id, site_id, page_size, page_num, obj, max_workers=1):
     """
     Gets all_objects from ECB/ESCB Tableau server.
 
@@ -159,7 +547,8 @@ def get_all(session, server, auth_token, user_id, site_id, page_size, page_num,
     'auth_token'    authentication token that grants user access to API calls
     'user_id'       ID of user with access to workbook
     'site_id'       ID of the site that the user is signed into
-    'obj'           object to be retrieved: workbook, datasource, project, 
+    'obj'           object to be retrieved: workbook, datasource, project
+    'max_workers'   number of pages requested at the same time (1 = one page after the other)
     """
     
     if obj == 'workbook':
@@ -167,31 +556,123 @@ def get_all(session, server, auth_token, user_id, site_id, page_size, page_num,
     else:
         url = server + "/api/{0}/sites/{1}/".format(VERSION, site_id) + obj + 's'
 
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-
-    server_response = session.get(url,data=None,  headers={'x-tableau-auth': auth_token}, verify=verifySsl) #, verify=verifySsl
-    _check_status(server_response, 200) #Function defined above
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    
-    items = xml_response.findall('.//t:' + obj, namespaces=xmlns) #Search XML for workbook data
-    
-    # Used to determine if more requests are required to find all workbooks on server
-    total_items = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
+    # The first page tells how many requests are required to find all objects on server
+    items, total_items = _get_page(session, url, auth_token, page_size, page_num, obj)
     max_page = int(math.ceil(total_items / page_size))
-    
-    # Continue querying if more workbooks exist on the server
-    for page in range(2, max_page + 1):
-        page_num+=1
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-
-        server_response = session.get(paged_url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
-        _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        #Search XML server response (xml_response) for relevant data - workbooks
-        items.extend(xml_response.findall('.//t:' + obj, namespaces=xmlns))
+    pages = range(page_num + 1, page_num + max_page)
+
+    if max_workers > 1 and len(pages) > 1:
+        # map() returns the pages in the order they were requested, so the items
+        # are reassembled exactly as in the sequential crawl
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda page: _get_page(session, url, auth_token, page_size, page, obj)[0], pages))
+    else:
+        results = [_get_page(session, url, auth_token, page_size, page, obj)[0] for page in pages]
+
+    for page_items in results:
+        items.extend(page_items)
     
     return items
 
+
+@phase('get_inventory')
+def get_inventory(session, server, auth_token, user_id, site_id, page_size, page_num, objs, max_workers=1, snapshot_max_age=0):
+    """
+    Gets the listings of several objects from ECB/ESCB Tableau server at the same time.
+
+    'objs'              objects to be retrieved, e.g. ('project', 'workbook', 'datasource')
+    'max_workers'       number of pages requested at the same time for each listing
+    'snapshot_max_age'  age in hours under which a listing saved by a previous process is reused
+                        (0 = always query the server)
+    Returns a dictionary with the list of items for every object.
+    """
+    inventory = {}
+    if snapshot_max_age > 0:
+        for obj in objs:
+            items = load_snapshot(server, site_id, user_id, obj, snapshot_max_age)
+            if items is not None:
+                inventory[obj] = items
+    missing = [obj for obj in objs if obj not in inventory]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {obj: executor.submit(get_all, session, server, auth_token, user_id, site_id, page_size, page_num, obj, max_workers) for obj in missing}
+        for obj, future in futures.items():
+            inventory[obj] = future.result()
+            if snapshot_max_age > 0:
+                save_snapshot(server, site_id, user_id, obj, inventory[obj])
+    return inventory
+
+
+def _snapshot_file(server, site_id, user_id, obj):
+    """
+    Returns the path of the snapshot file of an object listing, one file per server, site, user and object:
+    the listings hold what the signed in user sees on the site (the workbooks are even listed per user).
+    """
+    key = re.sub('[^0-9A-Za-z]+', '_', '{0}_{1}_{2}'.format(server, site_id, user_id)).strip('_')
+    return os.path.join(SNAPSHOT_DIR, '{0}_{1}s.xml'.format(key, obj))
+
+
+def save_snapshot(server, site_id, user_id, obj, items):
+    """
+    Stores an object listing on local disk, so that the other housekeeping processes
+    can reuse it instead of crawling the server again.
+
+    'server'        specified server address
+    'site_id'       ID of the site that the user is signed into
+    'user_id'       ID of the signed in user
+    'obj'           object of the listing: workbook, datasource, project, view
+    'items'         XML elements returned by get_all
+    """
+    snapshot = ET.Element('snapshot', server=server, site=site_id, user=user_id, obj=obj, created=datetime.now().isoformat())
+    snapshot.extend(items)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    snapshot_file = _snapshot_file(server, site_id, user_id, obj)
+    # Write to a temporary file first, so a process reading the snapshot never sees half of it
+    ET.ElementTree(snapshot).write(snapshot_file + '.tmp', encoding='utf-8')
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+    return
+
+
+def load_snapshot(server, site_id, user_id, obj, max_age):
+    """
+    Loads an object listing stored by save_snapshot.
+
+    'server'        specified server address
+    'site_id'       ID of the site that the user is signed into
+    'user_id'       ID of the signed in user
+    'obj'           object of the listing: workbook, datasource, project, view
+    'max_age'       maximum age of the snapshot in hours
+    Returns the XML elements of the listing, or None if no snapshot younger than max_age exists.
+    """
+    snapshot_file = _snapshot_file(server, site_id, user_id, obj)
+    if not os.path.exists(snapshot_file):
+        return None
+
+    snapshot = ET.parse(snapshot_file).getroot()
+    created = datetime.fromisoformat(snapshot.get('created'))
+    if (snapshot.get('server'), snapshot.get('site'), snapshot.get('user')) != (server, site_id, user_id) or datetime.now() - created > timedelta(hours=max_age):
+        return None
+    return list(snapshot)
+
+@phase('load_user_names')
+def load_user_names(session, server, auth_token, user_id, site_id, page_size=100):
+    """
+    Loads the names of all the users of the site with the paginated users listing,
+    so that user_id2name does not need one request per user.
+
+    'server'        specified server address
+    'auth_token'    authentication token that grants user access to API calls
+    'user_id'       ID of the signed in user
+    'site_id'       ID of the site that the user is signed into
+    """
+    users = get_all(session, server, auth_token, user_id, site_id, page_size, 1, 'user', PAGE_WORKERS)
+    user_names[server] = {user.get('id'): user.get('name') for user in users}
+    return
+
+
+@phase('user_id2name')
 def user_id2name(session, server, auth_token, site_id, target_user_id):
     """
     Maps user ID to the respective user name on the server
@@ -207,28 +688,44 @@ def user_id2name(session, server, auth_token, site_id, target_user_id):
     if (not isinstance(target_user_id, str)):
         return (None, None)
     
+    # Users loaded in bulk by load_user_names (or already queried) are answered from memory
+    names = user_names.setdefault(server, {})
+    if target_user_id in names:
+        return names[target_user_id]
+
     url = server + "/api/{0}/sites/{1}/users/{2}?fields=name".format(VERSION, site_id, target_user_id)
     
-    server_response = session.get(url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
+    server_response = session.get(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))    
+    xml_response = _parse_response(server_response)    
     
     #Creating tuple of name and e-mail from dictionary
     name = xml_response[0].get('name')       
+    names[target_user_id] = name
     
     return name
 
-def get_project_leader(project_name, all_projects, server, site_id, auth_token, session, df_groups, log):
+@phase('get_project_leader')
+def get_project_leader(project_name, all_projects, server, site_id, auth_token, session, groups_index, log):
     
     pfound =[project for project in all_projects if project.get('name') == project_name]
     project_id = pfound[0].get('id')
+
+    # The leaders of a project are queried once per run, then served from project_leaders
+    cache = project_leaders.setdefault(server, {})
+    stats = project_leaders_stats.setdefault(server, {'hits': 0, 'misses': 0})
+    if project_id in cache:
+        stats['hits'] += 1
+        l_users, l_groups = cache[project_id]
+        return [dict(lu) for lu in l_users], list(l_groups)
+    stats['misses'] += 1
     
     url=server + "/api/" + VERSION + "/sites/" + site_id + "/projects/" + project_id + "/permissions"
 
-    server_response = session.get(url, data=None , headers={'x-tableau-auth': auth_token}, verify=verifySsl) 
+    server_response = session.get(url, data=None , headers=_headers(auth_token), verify=verifySsl) 
     _check_status(server_response, 200)
     
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = _parse_response(server_response)
     
     permissions = xml_response.findall('.//t:granteeCapabilities', namespaces=xmlns)
     leads_users = []
@@ -252,18 +749,13 @@ def get_project_leader(project_name, all_projects, server, site_id, auth_token,
     for lgroup in leads_groups:
         try:
             l_groups.append({'id': lgroup.get('id')})
-            uing = get_users_in_group(df_groups, lgroup.get('id'))
+            uing = get_users_in_group(groups_index, lgroup.get('id'))
             leads_users = leads_users + uing
         
         except Exception as err:
-            log = log + "\n\nERROR: your user is not authorized to query group '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!".format(lgroup.get('id'), server)
+            log += "\n\nERROR: your user is not authorized to query group '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!".format(lgroup.get('id'), server)
             l_groups.append(None)
-            logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-            file = open(logfile_name, "w") 
-            file.write(log) 
-            file.close()
-            os.system(logfile_name.replace('/', '\\'))
-            error()
+            log_file(log)
 
     for luser in leads_users:
         try:
@@ -273,18 +765,36 @@ def get_project_leader(project_name, all_projects, server, site_id, auth_token,
                 l_user = user_id2name(session, server, auth_token, site_id, luser.get('id'))
                 l_users.append({'name': l_user, 'id': luser.get('id')})
         except Exception as err:
-            log = log + "\n\nERROR: your user is not authorized to query user '{0}' in server {1}, so no email was sent.\nAdmin privilegies are required!".format(luser.get('id'),server)
+            log += "\n\nERROR: your user is not authorized to query user '{0}' in server {1}, so no email was sent.\nAdmin privilegies are required!".format(luser.get('id'),server)
             l_users.append(None)
-            logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-            file = open(logfile_name, "w") 
-            file.write(log) 
-            file.close()
-            os.system(logfile_name.replace('/', '\\'))
-            error()       
+            log_file(log)
         
     l_users = [i for i in l_users if i != None]
     l_users = [dict(y) for y in set(tuple(x.items()) for x in l_users)]
-    return l_users, l_groups
+    cache[project_id] = (l_users, l_groups)
+    return [dict(lu) for lu in l_users], list(l_groups)
+
+
+def invalidate_project_leaders(server, project_id=None):
+    """
+    Forgets the project leaders stored by get_project_leader, so that they are queried again.
+
+    'server'        specified server address
+    'project_id'    ID of the project to forget (None = every project of the server)
+    """
+    if project_id is None:
+        project_leaders.pop(server, None)
+    else:
+        project_leaders.get(server, {}).pop(project_id, None)
+    return
+
+
+def project_leaders_summary(server):
+    """
+    Returns the log line with the hits and misses of the project leader cache of the server.
+    """
+    stats = project_leaders_stats.get(server, {'hits': 0, 'misses': 0})
+    return '\n\nProject leader cache: {0} hits, {1} misses'.format(stats['hits'], stats['misses'])
 
 
 def user_to_email(users_list):
@@ -297,7 +807,8 @@ def user_to_email(users_list):
     return emails_list
 
 
-def empty_projects(username, password, server_config, df_groups, log = ''):
+@phase('empty_projects')
+def empty_projects(username, password, server_config, groups_index, log = '', recursive=False):
     
     
     """
@@ -306,10 +817,13 @@ def empty_projects(username, password, server_config, df_groups, log = ''):
     'username'        Tableau ECB/ESCB username (Admin)
     'password'        Tableau ECB/ESCB password (Admin)
     'server_config'   from config()
+    'recursive'       also report subprojects whose whole subtree is empty (see find_empty_projects)
     """
     
     setup()
     server = server_config['server']
+    invalidate_project_leaders(server)
+    project_leaders_stats[server] = {'hits': 0, 'misses': 0}
     print("Processing server: {0}".format(server))
     # Create session object for use throughout script
     # Session object also disallows for system-wide environment variables (e.g. http_proxy) that may interfere with connection
@@ -319,8 +833,7 @@ def empty_projects(username, password, server_config, df_groups, log = ''):
     'app':'TABLEAU',
     'password':password,
     'submit':'Login'}
-    session = requests.Session()
-    session.trust_env = False
+    session = new_session()
     if 'escb.eu' in server:
         #the IAM portal sometimes does not respond, so the connection attempt will be executed 5 times until it fails
         iam_auth_counter = 0
@@ -333,34 +846,31 @@ def empty_projects(username, password, server_config, df_groups, log = ''):
             print('Connection to IAM portal not possible, please try again later.')
     
     ##### STEP 1: Sign in #####
-    log = log + "\n1. Signing in as " + username
+    log += "\n1. Signing in as " + username
     try:
         auth_token, site_id, user_id = sign_in(session, server, username, password)
-        log = log + " ---> succeded\n\n"
+        log += " ---> succeded\n\n"
     except Exception as err:
-        log = log + "\n\nERROR: could not sign in server {0}".format(server)
-        logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-        file = open(logfile_name, "w") 
-        file.write(log) 
-        file.close()
-        os.system(logfile_name.replace('/', '\\'))
-        error()
+        log += "\n\nERROR: could not sign in server {0}".format(server)
+        log_file(log)
+
+    try:
+        load_user_names(session, server, auth_token, user_id, site_id)
+    except Exception as err:
+        log += "\n\nWARNING: could not load the users of server {0}, user names will be queried one by one".format(server)
 
     page_size=100 # maximum number of items per page
     page_num=1
     
     ##### STEP 2: retrieve name of empty projects with hierarchies #####
     try:
-        empty_projects, all_projects = get_empty_projects(session, server, auth_token, site_id, user_id, page_size, page_num)
+        empty_projects, all_projects = get_empty_projects(session, server, auth_token, site_id, user_id, page_size, page_num, server_config.get('snapshot_max_age', 0), recursive)
     except Exception as err:
-        log = log + "\n\nERROR: could not retrieve empty projects, some problem incurred in the request {0}".format(server)
-        file = open(datetime.now().strftime("logs/log_%m%d_%H%M%S.txt"), "w") 
-        file.write(log) 
-        file.close()
-        error()
-    log = log + "Empty Projects:\n"
+        log += "\n\nERROR: could not retrieve empty projects, some problem incurred in the request {0}".format(server)
+        log_file(log)
+    log += "Empty Projects:\n"
     for empr in empty_projects:
-        log = log + "- " + empr.get('name') + "\n"            
+        log += "- " + empr.get('name') + "\n"            
 
     ##### STEP 3: retrieve project leader id for every project (in case is not found, find the closest in hierarchy) #####
     
@@ -369,7 +879,7 @@ def empty_projects(username, password, server_config, df_groups, log = ''):
     for empro in empty_projects:
         info = {'name': empro.get('name'), 'id': empro.get('id')}
         try:
-            users, groups =  get_project_leader(empro.get('name'), all_projects, server, site_id, auth_token, session, df_groups, log)
+            users, groups =  get_project_leader(empro.get('name'), all_projects, server, site_id, auth_token, session, groups_index, log)
             info['lead_users'] = users
             info['lead_groups'] = groups
             info['emails'] = [us['name'] for us in users]
@@ -377,14 +887,11 @@ def empty_projects(username, password, server_config, df_groups, log = ''):
 
         except Exception as err:
             print('             problem incurred with project' + empro.get('name'))
-            log = log + "\nERROR: your user is not authorized to query users for project '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!\n".format(empro.get('name'),server)
-            logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-            file = open(logfile_name, "w") 
-            file.write(log) 
-            file.close()
-            os.system(logfile_name.replace('/', '\\'))
-            error()
+            log += "\nERROR: your user is not authorized to query users for project '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!\n".format(empro.get('name'),server)
+            log_file(log)
         
+    log += project_leaders_summary(server)
+
     ##### STEP 3: Sign out #####
         
     print("\n7. Signing out and invalidating the authentication token")
@@ -394,7 +901,7 @@ def empty_projects(username, password, server_config, df_groups, log = ''):
     return em_projects, log
 
 
-def get_users_in_group(df_groups, group_id):
+def get_users_in_group(groups_index, group_id):
     """
     Get all the users in the group using group id
  
@@ -410,57 +917,250 @@ def get_users_in_group(df_groups, group_id):
     users = xml_response.findall('.//t:user', namespaces=xmlns)
     return users
     """
-    df = df_groups[(df_groups[0] == group_id)][[1,2]]
-    df = [{'name' : list(df[1])[i].lower(), 'id' : list(df[2])[i]} for i in range(len(df))]
-    for d in range(len(df)):
-        if 't-' in df[d]['name']:
-            df[d]['name'] = df[d]['name'][4:(len(df[d]['name'])-1)]
-    return df
+    return [dict(member) for member in groups_index.get(group_id, ())]
 
 
-def postgresql(password, host, query):
-    """ Querying projects with missing Project Leaders"""
-    
+def index_groups(df_groups):
+    """
+    Indexes the group members read from postgreSQL, once per run
+
+    'df_groups'     result of the group_users query (group id, user name, user id)
+    Returns a dictionary group id -> tuple of members {'name', 'id'}, with the user names
+    already lower case and without the 't-' prefix.
+    """
+    members = {}
+    for group_id, name, user_id in zip(df_groups['Groupid'], df_groups['Username'], df_groups['Userid']):
+        if not isinstance(group_id, str) or not isinstance(name, str):
+            continue
+        name = name.lower()
+        if 't-' in name:
+            name = name[4:(len(name)-1)]
+        members.setdefault(group_id, []).append({'name': name, 'id': user_id})
+    return {group_id: tuple(group_members) for group_id, group_members in members.items()}
+
+
+def get_connection(password, host):
+    """
+    Returns a connection to the Tableau repository of a host, reusing a connection of
+    the pool of the host when one is free, so that every query does not open a new one.
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    """
+    with connection_pools_lock:
+        if host not in connection_pools:
+            connection_pools[host] = psycopg2.pool.ThreadedConnectionPool(1, POOL_SIZE, database='workgroup', user='readonly', password=password, host=host, port=8060)
+            connection_pools_stats[host] = {'queries': 0, 'connections': set()}
+        pool = connection_pools[host]
+    connection = pool.getconn()
+    with connection_pools_lock:
+        connection_pools_stats[host]['queries'] += 1
+        connection_pools_stats[host]['connections'].add(id(connection))
+    return connection
+
+
+def release_connection(host, connection):
+    """
+    Gives a connection back to the pool of its host.
+    """
+    try:
+        # close the read-only transaction opened by the query
+        connection.rollback()
+        connection_pools[host].putconn(connection)
+    except (Exception, psycopg2.DatabaseError) as error:
+        connection_pools[host].putconn(connection, close=True)
+    return
+
+
+def close_connection_pools():
+    """
+    Closes every pooled connection, at the end of the run.
+    """
+    with connection_pools_lock:
+        for pool in connection_pools.values():
+            pool.closeall()
+        connection_pools.clear()
+    return
+
+
+def connection_pools_summary():
+    """
+    Returns the log lines with the number of queries and connections used per host.
+    """
+    text = ''
+    for host, stats in connection_pools_stats.items():
+        connections = len(stats['connections'])
+        text = text + '\npostgreSQL {0}: {1} queries on {2} connection(s), {3} reused'.format(host, stats['queries'], connections, stats['queries'] - connections)
+    return text
+
+
+def postgresql_batches(password, host, query, params=None, batch_size=5000):
+    """
+    Reads the result of a query on the Tableau repository batch by batch, through a
+    server-side cursor, so that large tables are never loaded in memory at once.
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    'query'         SQL query, with %s placeholders for 'params'
+    'batch_size'    number of rows fetched from the server at a time
+    Yields one DataFrame per batch, with the column names of the query and the "Server" column
+    (a single empty DataFrame if the query returns no row).
+    """
+    connection = get_connection(password, host)
+    # time spent waiting for the repository only, not for the caller reading the batches
+    elapsed = 0.0
+    rows_read = 0
     try:
-        connection = psycopg2.connect(database='workgroup', user='readonly', password=password, host=host, port=8060)
-        cur = connection.cursor()
-        cur.execute(query)
-        row = cur.fetchone()
-        df = [row]
-     
-        while row is not None:
-            df.append(row)
-            row = cur.fetchone()
+        # a named cursor is declared on the server, rows are only sent when fetched
+        cur = connection.cursor(name='housekeeping')
+        start = time.perf_counter()
+        cur.execute(query.strip().rstrip(';'), params)
+        rows = cur.fetchmany(batch_size)
+        elapsed += time.perf_counter() - start
+        columns = [column[0] for column in cur.description]
+        first = True
+        while rows or first:
+            rows_read += len(rows)
+            df = pd.DataFrame(rows, columns=columns)
+            df["Server"] = host
+            yield df
+            first = False
+            start = time.perf_counter()
+            rows = cur.fetchmany(batch_size)
+            elapsed += time.perf_counter() - start
         cur.close()
-        
+    finally:
+        release_connection(host, connection)
+        _add_timing(query_timings, query_timings_lock, _query_table(query), elapsed, rows=rows_read)
+
+
+def _query_table(query):
+    """
+    Returns the name a query is timed under in query_timings: the first table it reads.
+    """
+    match = re.search(r'\bfrom\s+([\w."]+)', query, re.IGNORECASE)
+    return match.group(1) if match else query.strip()[:40]
+
+
+def postgresql(password, host, query, params=None):
+    """
+    Queries the Tableau repository (workgroup database)
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    'query'         SQL query, with %s placeholders for 'params'
+    Returns a DataFrame with the column names of the query and the "Server" column.
+    """
+    try:
+        df = pd.concat(list(postgresql_batches(password, host, query, params)), ignore_index=True)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    
-    finally:
-        if connection is not None:
-            connection.close()
-    df = pd.DataFrame(df)
-    df["Server"] = host
+        raise
     df = df.drop_duplicates()
     return df
 
 
-def empty_projects_email(emails, proj_name, server, proj_num, deadline):
-    
+def _recipient(name):
+    """
+    Returns the email recipient of a Tableau user name (without the t- or eu prefix).
+    """
+    name = name.lower()
+    if 't-' in name:
+        return name[4:]
+    elif name[0:2] == 'eu' and len(name) > 8:
+        return name[2:]
+    return name
+
+
+def queue_digest(recipients, finding, leaders=()):
+    """
+    Adds a finding to the digest of every recipient, all the digests are emailed at once by send_digests.
+
+    'recipients'    Tableau user names of the people to inform (owners, subscribers...)
+    'finding'       dictionary describing the finding, its 'server' key groups the findings in the email
+    'leaders'       Tableau user names of the project leaders informed as such (not already in 'recipients')
+    Every recipient receives a copy of the finding with its 'role': 'owner' or 'leader'.
+    """
+    owners = set(_recipient(r) for r in recipients)
+    with digests_lock:
+        for recipient in sorted(owners):
+            digests.setdefault(recipient, []).append(dict(finding, role='owner'))
+        for recipient in sorted(set(_recipient(r) for r in leaders) - owners):
+            digests.setdefault(recipient, []).append(dict(finding, role='leader'))
+    return
+
+
+@phase('send_digests')
+def send_digests():
+    """
+    Creates one Outlook email per recipient listing every finding queued for them (over all the servers
+    of the run), instead of one email per object. The digests are emptied.
+    Returns the log text of the emails created.
+    """
+    with digests_lock:
+        pending = dict(digests)
+        digests.clear()
+    text = "\n\n-------- Emails (one per recipient) ---------"
+    if not pending:
+        return text + "\nNo email to prepare."
     outlook = client.Dispatch("Outlook.Application")
-    
-    for i in range(len(emails)):
-        if 't-' in emails[i].lower():
-            emails[i] = emails[i].lower()[4:len(emails[i])]
-        elif emails[i].lower()[0:2] == 'eu' and len(emails[i]) > 8:
-            emails[i] = emails[i].lower()[2:len(emails[i])]
-        else:
-            emails[i] = emails[i].lower()
-
-    message.To = '; '.join(list(set(emails)))
-    message.BCC = ""
-    message.Subject = "FOR YOUR ACTION: Tableau empty projects in Tableau Server"
-    
+    for recipient, findings in sorted(pending.items()):
+        try:
+            message = outlook.CreateItem(0)
+            message.To = recipient
+            message.BCC = ""
+            message.Subject = "FOR YOUR ACTION: Tableau empty projects in Tableau Server"
+            message.HTMLBody = _digest_body(findings)
+            message.Display()
+            text += "\n- {0}: {1} item(s)".format(recipient, len(findings))
+        except Exception as err:
+            text += "\n\n WARNING: problem in creating the email for {0}! create manually! \n".format(recipient)
+    return text
+
+
+def _by_server(findings):
+    """
+    Returns the findings grouped by server, in the order they were found.
+    """
+    servers = {}
+    for finding in findings:
+        servers.setdefault(finding['server'], []).append(finding)
+    return servers.items()
+
+
+def empty_projects_email(emails, proj_name, server, proj_num, deadline, info=''):
+    """
+    Queues an empty project for the email of its project leaders (see send_digests).
+
+    'emails'      user names of the project leaders
+    'proj_name'   name of the project
+    'server'      specified server address
+    'proj_num'    repository id of the project (link of the email)
+    'deadline'    date of deletion of the project
+    'info'        name of the server in server_dict, shown in the email
+    """
+    queue_digest([], {'server': server, 'info': info, 'name': proj_name, 'id': proj_num, 'deadline': deadline}, leaders=emails)
+    return
+
+
+def _server_label(server, info=''):
+    """
+    Returns the name of the server shown in the emails: its 'info' in server_dict, else the name
+    of the ECB/ESCB server at this address, else the address.
+    """
+    if info:
+        return 'Tableau Server {0}'.format(info)
+    labels = {'https://a-tableau.ecb.de': 'Tableau ECB Acceptance Server',
+              'https://a-tableau.escb.eu': 'Tableau ESCB Acceptance Server',
+              'https://tableau.ecb.de': 'Tableau ECB Production Server',
+              'https://tableau.escb.eu': 'Tableau ESCB Production Server'}
+    return labels.get(server.rstrip('/'), 'Tableau Server {0}'.format(server.rstrip('/')))
+
+
+def _digest_body(findings):
+    """
+    Returns the HTML body of the email of one project leader, listing all of their empty projects.
+    """
     Body = """
 &nbsp_____________________________________________________________________________________________<br>
 {0}{0}{0}{0}{0}{0} <img src="{2}" alt=Move workbook back to project><br>
@@ -470,33 +1170,25 @@ def empty_projects_email(emails, proj_name, server, proj_num, deadline):
 
 <br>
 {0} We are currently performing a clean-up of all our Tableau Servers and we have observed that the <br>
-{0} project you own has no content. We are kindly asking you if the mentioned project can be deleted  <br>
+{0} project(s) you own has/have no content. We are kindly asking you if the mentioned project(s) can be deleted  <br>
 {0} from Tableau server or the item is still needed. <br>
 <br>
 {0} <b>!</b> Please be informed that in case of no reply to this email, we will consider that is ok from <br>
-{0} your side to <b>permanently delete</b> the project from Tableau which will happen on <b>{1} <br>
+{0} your side to <b>permanently delete</b> the project(s) from Tableau which will happen on <b>{1} <br>
 {0} without any further announcement.</b> <br>
 &nbsp_____________________________________________________________________________________________<br>
 <br>
 {0}{0}{0}{0}{0}{0} <b>Empty project(s) to be decommissioned on {1}:</b><br>
-<br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', deadline, os.getcwd()+"\\Tableau.jpg")
-    if server == 'https://a-tableau.ecb.de/':
-        Body = Body + """{0} <a href='https://a-tableau.ecb.de/'>Tableau ECB Acceptance Server</a> <br>
-        {0}{0} <a href='https://a-tableau.ecb.de/#/projects/{2}'> {1} </a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', proj_name, proj_num)
-    elif server == 'https://a-tableau.escb.eu':
-        Body = Body + """{0} <a href='https://a-tableau.escb.eu/'>Tableau ESCB Acceptance Server</a> <br>
-        {0}{0} <a href='https://a-tableau.escb.eu/#/projects/{2}'> {1} </a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', proj_name, proj_num)
-    elif server == 'https://tableau.ecb.de/':
-        Body = Body + """{0} <a href='https://tableau.ecb.de/'>Tableau ECB Production Server</a> <br>
-        {0}{0} <a href='https://tableau.ecb.de/#/projects/{2}'> {1} </a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', proj_name, proj_num)
-    elif server == 'https://tableau.escb.eu':
-        Body = Body + """{0} <a href='https://tableau.escb.eu/'>Tableau ESCB Production Server</a> <br>
-        {0}{0} <a href='https://tableau.escb.eu/#/projects/{2}'> {1} </a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', proj_name, proj_num)        
+<br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', findings[0]['deadline'], os.getcwd()+"\\Tableau.jpg")
+    for server, projects in _by_server(findings):
+        Body = Body + """{0} <a href='{1}/'>{2}</a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', server.rstrip('/'), _server_label(server, projects[0].get('info', '')))
+        for project in projects:
+            Body = Body + """
+        {0}{0} <a href='{1}/#/projects/{3}'> {2} </a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', server.rstrip('/'), project['name'], project['id'])
     Body = Body + """<br>
 &nbsp_____________________________________________________________________________________________<br>
 <br>
 {0} Best Regards, <br>
 {0} Tableau Support Team <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
-    message.HTMLBody = Body
-    message.Display()
+    return Body
     
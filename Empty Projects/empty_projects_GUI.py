@@ -12,17 +12,84 @@ from functools import partial
 import empty_projects as ep
 from datetime import datetime, timedelta, date
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 #Configurations for different ECB Tableau servers
-server_dict = {'server1': {'server':'', 'postgreSQL' : '','info':''},
-                'server2': {'server':'', 'postgreSQL' : '','info':''},
-                'server3': {'server':'', 'postgreSQL' : '','info':''},
-                'server4': {'server':'', 'postgreSQL' : '','info':''}}
+server_dict = {'server1': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server2': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server3': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server4': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12}}
 
 selected_servers = []    
 deadline = date.today() + timedelta(+30)
 deadline = '{0}/{1}/{2}'.format(deadline.day, deadline.month, deadline.year)
 
+def process_server(x, username, password, readonly_pw, run_log):
+    """
+    Processes one server, in its own worker thread (see validateLogin).
+
+    'x'             index of the server (0 for server1 ... 3 for server4)
+    'username'      admin username of the server
+    'password'      admin password of the server
+    'readonly_pw'   password of the postgreSQL readonly user
+    'run_log'       log of the run, the server is logged in a child of it
+    Returns the log of the server and the text listing its projects without Project Leader.
+    """
+    server = server_dict['server{0}'.format(x + 1)]
+    # the repository is queried before the process itself calls setup(): the connection pool size is set there
+    ep.setup()
+    log = run_log.child(server['server'])
+    try:
+        log += """
+
+-------------------------------------------------------
+----- Connecting to """ + server['server'] + """ ------
+-------------------------------------------------------
+
+"""
+
+        try:
+            df = ep.postgresql(readonly_pw, server['postgreSQL'],'select * from projects')
+            groups_index = ep.index_groups(ep.postgresql(readonly_pw, server['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id'))
+
+        except Exception as err:
+            log += "\n\nERROR: could not connect to the postgreSQL server, verify readonly password and retry."
+            return log, ''
+
+        emptyprojects, log = ep.empty_projects(username, password, server, groups_index, log, args.recursive)
+
+        log += """
+
+-------------------------------------------------------
+----- Connecting to """ + server['postgreSQL'] + """ ------
+-------------------------------------------------------
+
+"""
+
+        log += "\n\n-------- Preparing email for Project Leaders ---------"
+        no_pl = []
+        for emps in emptyprojects:
+            if emps['emails'] != []:
+                log += "\n\n- Project name = {0}:\nsending emails to the following project leaders: {1}".format(emps['name'],', '.join([em['name'] for em in emps['lead_users']]))
+                if len(df[df['name'] == emps['name']]) == 1:
+                    project_number = str(int(df[df['name'] == emps['name']]['id'].iloc[0]))
+                else:
+                    project_number = '000'
+                    log += '\n\n WARNING: could not find project number in postgreSQL for project {0}! correct manually \n'.format(emps['name'])
+                try:
+                    ep.empty_projects_email(emps['emails'], emps['name'], server['server'], project_number, deadline, server['info'])
+                    log += '\n\nProject {0} has been added to the email of its project leaders!'.format(emps['name'])
+                except Exception as err:
+                    log += "\n\n WARNING: problem in creating the email for empty_project {0}! create manually! \n".format(emps['name'])
+            else:
+                no_pl.append(emps['name'])
+        text = '\n\n No Project Leader was found for the following projects in {0} server: \n-{1}'.format(server['server'], '\n-'.join(no_pl))
+        return log, text
+    except Exception as err:
+        log += '\n\nERROR: the process stopped for {0}: {1}'.format(server['server'], err)
+        return log, ''
+
+
 def validateLogin(ECBA_username, 
                   ESCBA_username, 
                   ECBP_username, 
@@ -79,7 +146,8 @@ def validateLogin(ECBA_username,
     Tab_pw = [ECBA_pw, ESCBA_pw, ECBP_pw, ESCBP_pw]
     readonly_passwords = [read_ECBA_pw, read_ESCBA_pw, read_ECBP_pw, read_ESCBP_pw]
     
-    log = """
+    log = ep.RunLog()
+    log += """
 ##########################
 # Empty Projects process #
 ##########################
@@ -87,81 +155,25 @@ def validateLogin(ECBA_username,
 Server selected: {0}""".format(', '.join(args.servers))
     
     tkWindow.destroy()
+    no_pl_found = []
    
-    for x in range(len(Tab_users)):
-        if Tab_users[x] != None:
-            
-            if x == 0:
-                server = server_dict['server1']
-                readonly_pw = readonly_passwords[0]
-            elif x == 1:
-                server = server_dict['server2']  
-                readonly_pw = readonly_passwords[1]
-            elif x == 2:
-                server = server_dict['server3']
-                readonly_pw = readonly_passwords[2]
-            else:
-                server = server_dict['server4']
-                readonly_pw = readonly_passwords[3]
-            
-            log = log + """
-
--------------------------------------------------------
------ Connecting to """ + server['server'] + """ ------
--------------------------------------------------------
-
-"""
-
-            try:
-                df = ep.postgresql(readonly_pw, server['postgreSQL'],'select * from projects')
-                df_groups = ep.postgresql(readonly_pw, server['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id')
-
-            except Exception as err:
-                log = log + "\n\nERROR: could not connect to the postgreSQL server, verify readonly password and retry."
-                logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-                file = open(logfile_name, "w") 
-                file.write(log)
-                file.close()
-                os.system(logfile_name.replace('/', '\\'))
-                error()
-
-            emptyprojects, log = ep.empty_projects(Tab_users[x], Tab_pw[x], server, df_groups, log)
-
-            log = log + """
-
--------------------------------------------------------
------ Connecting to """ + server['postgreSQL'] + """ ------
--------------------------------------------------------
-
-"""
-
-            log = log + "\n\n-------- Preparing email for Project Leaders ---------"
-            no_pl = []
-            no_pl_found = []
-            for emps in emptyprojects:
-                if emps['emails'] != []:
-                    log = log + "\n\n- Project name = {0}:\nsending emails to the following project leaders: {1}".format(emps['name'],', '.join([em['name'] for em in emps['lead_users']]))
-                    if len(df[df[1] == emps['name']]) == 1:
-                        project_number = str(int(df[df[1] == emps['name']][0]))
-                    else:
-                        project_number = '000'
-                        log = log + '\n\n WARNING: could not find project number in postgreSQL for project {0}! correct manually \n'.format(emps['name'])
-                    try:
-                        ep.empty_projects_email(emps['emails'], emps['name'], server['server'], project_number, deadline)
-                        log = log + '\n\nEmail for project {0} has been sent!'.format(emps['name'])
-                    except Exception as err:
-                        log = log + "\n\n WARNING: problem in creating the email for empty_project {0}! create manually! \n".format(emps['name'])
-                else:
-                    no_pl.append(emps['name'])
-            text = '\n\n No Project Leader was found for the following projects in {0} server: \n-{1}'.format(server['server'], '\n-'.join(no_pl))
-            no_pl_found.append(text)
+    selected = [x for x in range(len(Tab_users)) if Tab_users[x] != None]
+    #Every selected server is processed in its own worker, the logs are merged in the order of the servers
+    with ThreadPoolExecutor(max_workers=max(len(selected), 1)) as executor:
+        results = list(executor.map(lambda x: process_server(x, Tab_users[x], Tab_pw[x], readonly_passwords[x], log), selected))
+    for server_log, text in results:
+        log += server_log
+        no_pl_found.append(text)
     
-    log = log + ' '.join(no_pl_found) +  "\n\nEMPTY PROJECTS PROCESS COMPLETED!"
+    #Every person receives one email listing their findings on all the selected servers
+    log += ep.send_digests()
+    log += ep.metrics_summary()
+    log += ep.connection_pools_summary()
+    log += '\n\nMetrics written to {0}'.format(ep.write_metrics(log.path.replace('run_', 'metrics_')[:-len('.jsonl')] + '.json'))
+    ep.close_connection_pools()
+    log += ' '.join(no_pl_found) +  "\n\nEMPTY PROJECTS PROCESS COMPLETED!"
 
-    logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-    file = open(logfile_name, "w") 
-    file.write(log)
-    file.close()
+    logfile_name = log.render()
     os.system(logfile_name.replace('/', '\\'))
  
     return 
@@ -178,6 +190,8 @@ if __name__ == "__main__":
             The process identify the emtpy projects and send an email notification to their Project Leaders asking for deletion.')
     parser.add_argument('servers', metavar='server', type=str, nargs='+', choices=['server1', 'server2', 'server3', 'server4', 'none'], default='none',
                     help="Server(s) in scope. Please choose from 'server1', 'server2', 'server3', 'server4', separated by spaces.")
+    parser.add_argument('--recursive', action='store_true',
+                    help="Also report subprojects whose whole subtree has no workbook or datasource, not only empty top-level projects.")
     args = parser.parse_args()
     
     if args.servers == 'none':
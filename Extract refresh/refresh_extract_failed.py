@@ -1,44 +1,157 @@
 import requests # Contains methods used to make HTTP requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import random
 import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+import io
 import math
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import win32com.client as client
 import pandas as pd
 import os
 import re
+import json
 import ast
 import psycopg2
+import psycopg2.pool
+import threading
+import bisect
+from contextlib import contextmanager
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
 
 def setup():
-    global verifySsl, VERSION, xmlns
+    global verifySsl, VERSION, xmlns, RESPONSE_FORMAT, PAGE_WORKERS, SNAPSHOT_DIR, POOL_SIZE, ASYNC_CONCURRENCY, DELETE_RATE, DELETE_RETRIES, DELETE_BACKOFF, WATERMARK_DIR, HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF, LATENCY_BUCKETS
     
     verifySsl = False
     #Tableau Server version nr.
     VERSION = '3.8'
     xmlns = {'t': 'http://tableau.com/api'}
+    #Format of the REST responses: 'xml' or 'json'
+    RESPONSE_FORMAT = os.environ.get('TABLEAU_RESPONSE_FORMAT', 'xml').lower()
+    #Number of pages requested at the same time when listing objects
+    PAGE_WORKERS = 4
+    #Folder of the object listings shared by the housekeeping processes
+    SNAPSHOT_DIR = os.environ.get('TABLEAU_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'snapshots'))
+    #Maximum number of connections kept open to each postgreSQL repository
+    POOL_SIZE = 4
+    #Connections kept alive to each Tableau server by the session of new_session
+    HTTP_POOL_SIZE = 16
+    #Number of retries of a GET request (connection error, 429 or 5xx), waiting about HTTP_BACKOFF * 2^attempt seconds in between
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF = 0.5
+    #Upper bounds in seconds of the latency histograms of metrics_summary (the last bucket counts the slower calls)
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    #Maximum number of REST calls in flight at the same time in run_calls
+    ASYNC_CONCURRENCY = 8
+    #Maximum number of DELETE requests started per second by bulk_delete (0 = no limit)
+    DELETE_RATE = 5
+    #Number of retries of a DELETE request answered with 429 or 5xx, waiting DELETE_BACKOFF * 2^attempt seconds in between
+    DELETE_RETRIES = 3
+    DELETE_BACKOFF = 1.0
+    #Folder of the _background_tasks watermarks and failure streaks kept between runs of five_days_errors
+    WATERMARK_DIR = os.environ.get('TABLEAU_WATERMARK_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'watermarks'))
+
+
+#Names of the users per server (user id -> name), filled by load_user_names and user_id2name
+user_names = {}
+#Project leaders per server (project id -> (users, groups)) and cache hit/miss counters, filled by get_project_leader
+project_leaders = {}
+project_leaders_stats = {}
+#Connection pools to the postgreSQL repositories (host -> pool) and their usage, shared by every query of the run
+connection_pools = {}
+connection_pools_stats = {}
+connection_pools_lock = threading.Lock()
+#Time of the REST requests per endpoint ('GET /sites/{id}/workbooks' -> count, total and max seconds, histogram), filled by _record_timing
+http_timings = {}
+http_timings_lock = threading.Lock()
+#Time of the phases of the processes (function or step -> count, total and max seconds, histogram), filled by phase
+phase_timings = {}
+phase_timings_lock = threading.Lock()
+#Time of the repository queries per table read (table -> count, rows, total and max seconds, histogram), filled by postgresql_batches
+query_timings = {}
+query_timings_lock = threading.Lock()
+#Findings waiting to be emailed (recipient -> findings with the role of the recipient), filled by queue_digest and emptied by send_digests
+digests = {}
+digests_lock = threading.Lock()
 
 
 #Configurations for different ECB Tableau servers
     
 
+class RunLog:
+    """
+    Log of a run, written to disk as it grows.
+
+    Every text added with += is one record (time, server, level, text) of the JSON Lines file
+    logs/run_<start>.jsonl, appended in batches of 'buffer_size' records. The readable report,
+    the text of all the records, is rendered once at the end by render().
+    """
+    def __init__(self, server=None, path=None, buffer_size=50, lock=None):
+        self.server = server
+        self.path = path or datetime.now().strftime("logs/run_%m%d_%H%M%S.jsonl")
+        self.buffer_size = buffer_size
+        self.lock = lock or threading.Lock()
+        self.texts = []
+        self.buffer = []
+
+    def __iadd__(self, text):
+        if isinstance(text, RunLog):
+            # log of a server processed by a worker: its records are already in the file
+            text.flush()
+            self.texts.extend(text.texts)
+            return self
+        if text == '':
+            return self
+        self.texts.append(text)
+        level = 'error' if 'ERROR' in text else 'warning' if 'WARNING' in text else 'info'
+        self.buffer.append({'time': datetime.now().isoformat(), 'server': self.server, 'level': level, 'text': text})
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return self
+
+    def __str__(self):
+        return ''.join(self.texts)
+
+    def child(self, server):
+        """
+        Returns the log of one server of the run, written to the same file.
+        """
+        return RunLog(server, self.path, self.buffer_size, self.lock)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(''.join(json.dumps(record) + '\n' for record in self.buffer))
+        self.buffer = []
+
+    def render(self, logfile_name=None):
+        """
+        Writes the readable report of the run (logs/log_<start>.txt by default) and returns its path.
+        """
+        self.flush()
+        if logfile_name == None:
+            logfile_name = self.path.replace('run_', 'log_')[:-len('.jsonl')] + '.txt'
+        with open(logfile_name, 'w', encoding='utf-8') as file:
+            file.write(str(self))
+        return logfile_name
+
+
 class ApiCallError(Exception):
     pass
 
 class UserDefinedFieldError(Exception):
     pass
 
-def _encode_for_display(text):
-    """
-    Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
-
-    Returns an ASCII-encoded version of the text.
-    Unicode characters are converted to ASCII placeholders (for example, "?").
-    """
-    return text.encode('ascii', errors="backslashreplace").decode('utf-8')
-
+class ProcessStopped(Exception):
+    pass
 
 def _check_status(server_response, success_code):
     """
@@ -49,7 +162,20 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        if RESPONSE_FORMAT == 'json':
+            try:
+                error = server_response.json().get('error', {})
+            except (ValueError, AttributeError):
+                # not an error of the REST API (e.g. the HTML page of a proxy): report the status and the body
+                raise ApiCallError('HTTP {0}: {1}'.format(server_response.status_code, server_response.text[:500]))
+            raise ApiCallError('{0}: {1} - {2}'.format(error.get('code', 'unknown code'), error.get('summary', 'unknown summary'), error.get('detail', 'unknown detail')))
+        try:
+            parsed_response = ET.fromstring(server_response.text)
+        except ET.ParseError:
+            parsed_response = None
+        if parsed_response is None or parsed_response.find('t:error', namespaces=xmlns) is None:
+            # not an error of the REST API (e.g. the HTML page of a proxy): report the status and the body
+            raise ApiCallError('HTTP {0}: {1}'.format(server_response.status_code, server_response.text[:500]))
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -64,6 +190,169 @@ def _check_status(server_response, success_code):
         raise ApiCallError(error_message)
     return
 
+def _headers(auth_token=None):
+    """
+    Returns the headers of a REST call: the authentication token, and the Accept header in JSON mode.
+    """
+    headers = {}
+    if auth_token != None:
+        headers['x-tableau-auth'] = auth_token
+    if RESPONSE_FORMAT == 'json':
+        headers['Accept'] = 'application/json'
+    return headers
+
+
+def _json_to_element(tag, value):
+    """
+    Converts an object of a JSON response into the element of the XML response it stands for:
+    values become attributes, objects become child elements and lists become repeated child elements.
+    """
+    element = ET.Element('{{{0}}}{1}'.format(xmlns['t'], tag))
+    for key, val in value.items():
+        for v in (val if isinstance(val, list) else [val]):
+            if isinstance(v, dict):
+                element.append(_json_to_element(key, v))
+            elif isinstance(val, list):
+                ET.SubElement(element, '{{{0}}}{1}'.format(xmlns['t'], key)).text = str(v)
+            elif isinstance(v, bool):
+                element.set(key, str(v).lower())
+            else:
+                element.set(key, str(v))
+    return element
+
+
+def _parse_response(server_response):
+    """
+    Parses the response of a REST call, XML or JSON (see RESPONSE_FORMAT), into an XML element,
+    so that the objects are read the same way in both modes.
+    """
+    if RESPONSE_FORMAT == 'json':
+        return _json_to_element('tsResponse', server_response.json())
+    return ET.fromstring(server_response.content)
+
+
+class JitterRetry(Retry):
+    """
+    Retry policy of urllib3 adding a random jitter to the backoff, so that the workers of a run do not all retry at the same time.
+    """
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, backoff)
+
+
+def _endpoint(request):
+    """
+    Returns the endpoint of a request: method and path, without the api version, the ids and the query.
+    """
+    path = urlsplit(request.url).path
+    path = re.sub(r'^/api/[0-9.]+', '', path)
+    path = re.sub(r'/[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|/[0-9]+(?=/|$)', '/{id}', path)
+    return '{0} {1}'.format(request.method, path)
+
+
+def _add_timing(timings, lock, name, elapsed, **counters):
+    """
+    Adds one call to the timings of 'name': count, total and max seconds, calls per bucket of LATENCY_BUCKETS
+    and the 'counters' (e.g. rows=10) summed over the calls.
+    """
+    with lock:
+        timing = timings.setdefault(name, dict({'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}, **{counter: 0 for counter in counters}))
+        timing['count'] += 1
+        timing['total'] += elapsed
+        timing['max'] = max(timing['max'], elapsed)
+        timing['buckets'][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        for counter, value in counters.items():
+            timing[counter] += value
+    return
+
+
+@contextmanager
+def phase(name):
+    """
+    Span of a phase of the process, its time is added to phase_timings (see metrics_summary).
+    Used around a step ("with phase('...'):") or as decorator of a function ("@phase('get_all')").
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_timing(phase_timings, phase_timings_lock, name, time.perf_counter() - start)
+
+
+def _record_timing(server_response, *args, **kwargs):
+    """
+    Response hook of the sessions, records the time of the request in http_timings.
+    """
+    _add_timing(http_timings, http_timings_lock, _endpoint(server_response.request), server_response.elapsed.total_seconds())
+    return server_response
+
+
+def new_session():
+    """
+    Creates the session used for all the REST calls to a server: up to HTTP_POOL_SIZE keep-alive connections
+    (one TLS handshake per connection instead of one per call), gzip responses, GET requests retried with
+    backoff and jitter, and the time of every request recorded per endpoint (see metrics_summary).
+    """
+    session = requests.Session()
+    session.trust_env = False
+    retry = JitterRetry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.hooks['response'].append(_record_timing)
+    return session
+
+
+def _timings_table(title, timings, lock, counters=()):
+    """
+    Returns the log lines of a table of timings, longest total first: count, 'counters', total, average
+    and max seconds, and the number of calls per bucket of LATENCY_BUCKETS.
+    """
+    with lock:
+        rows = sorted([(name, dict(timing, buckets=list(timing['buckets']))) for name, timing in timings.items()], key=lambda row: -row[1]['total'])
+    header = ['count'] + list(counters) + ['total', 'average', 'max'] + ['<={0}s'.format(bound) for bound in LATENCY_BUCKETS] + ['>{0}s'.format(LATENCY_BUCKETS[-1])]
+    width = max([len(title)] + [len(name) for name, timing in rows])
+    text = '\n\n{0:<{1}} '.format(title, width) + ' '.join(['{0:>8}'.format(column) for column in header])
+    for name, timing in rows:
+        values = [timing['count']] + [timing[counter] for counter in counters]
+        values += ['{0:.3f}s'.format(seconds) for seconds in (timing['total'], timing['total'] / timing['count'], timing['max'])] + timing['buckets']
+        text += '\n{0:<{1}} '.format(name, width) + ' '.join(['{0:>8}'.format(value) for value in values])
+    return text
+
+
+def metrics_summary():
+    """
+    Returns the summary tables written at the end of the log: the phases of the processes (the spans of
+    the servers processed at the same time add up), the REST requests per endpoint and the repository queries per table.
+    """
+    return (_timings_table('Phases', phase_timings, phase_timings_lock)
+            + _timings_table('REST requests', http_timings, http_timings_lock)
+            + _timings_table('Repository queries', query_timings, query_timings_lock, ('rows',)))
+
+
+def write_metrics(path=None):
+    """
+    Writes the metrics of the run (see metrics_summary, plus the connection pools) as a JSON file and returns its path.
+
+    'path'          logs/metrics_<time>.json by default
+    """
+    if path == None:
+        path = datetime.now().strftime("logs/metrics_%m%d_%H%M%S.json")
+    metrics = {'latency_buckets': list(LATENCY_BUCKETS)}
+    for name, timings, lock in (('phases', phase_timings, phase_timings_lock), ('http', http_timings, http_timings_lock), ('queries', query_timings, query_timings_lock)):
+        with lock:
+            metrics[name] = json.loads(json.dumps(timings))
+    with connection_pools_lock:
+        metrics['connection_pools'] = {host: {'queries': stats['queries'], 'connections': len(stats['connections'])} for host, stats in connection_pools_stats.items()}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(metrics, file, indent=2)
+    return path
+
+
+@phase('sign_in')
 def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
@@ -86,15 +375,12 @@ def sign_in(session, server, username, password, site=""):
     xml_request = ET.tostring(xml_request)
 
     # Make the request to server
-    server_response = session.post(url, data=xml_request, verify=verifySsl) 
+    server_response = session.post(url, data=xml_request, headers=_headers(), verify=verifySsl) 
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
     # Reads and parses the response
     try:
-        parsed_response = ET.fromstring(server_response)
+        parsed_response = _parse_response(server_response)
     except Exception as err:
         print("There was an error parsing the server response. This error may be linked to incorrect credentials.")
         raise
@@ -114,16 +400,26 @@ def sign_out(session, server, auth_token):
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
     
-    server_response = session.post(url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
+    server_response = session.post(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 204)
     return
 
 
 def log_file(log):
-    logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-    file = open(logfile_name, "w") 
-    file.write(log)
-    file.close()
+    """
+    Writes the log, opens it and stops the process after an error.
+    The log of a server processed by a worker (see RunLog.child) is not written here, as the servers run
+    at the same time: ProcessStopped ends the server, its log is merged with the others and written once by the GUI.
+    """
+    if isinstance(log, RunLog) and log.server is not None:
+        raise ProcessStopped('see the errors above')
+    if isinstance(log, RunLog):
+        logfile_name = log.render()
+    else:
+        logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
+        file = open(logfile_name, "w", encoding="utf-8") 
+        file.write(log)
+        file.close()
     os.system(logfile_name.replace('/', '\\'))
     error()
     return
@@ -201,15 +497,15 @@ def delete_extract_refresh(session, server, auth_token, site_id, extract_list, a
 
 def delete_extract_refresh(session, server, auth_token, site_id, extract_failed_list, log = ''):
     
-    for efl in extract_failed_list:
-            log = log + '\n\nExtract Refresh task (id {}) found for {} {}.\nDELETING TASK'.format(efl['task_id'], efl['object'], efl['title'])
-            delete_url = server + '/api/{}/sites/{}/tasks/extractRefreshes/{}'.format(VERSION, site_id, efl['task_id'])
-            try:
-                server_response = requests.delete(delete_url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
-                log = log + ' ---> DELETED!\n\n' + delete_url
-            except Exception as err:
-                log = log + '\n\nERROR: could not delete task, some problem occurred!'
-                log_file(log)
+    delete_urls = [server + '/api/{}/sites/{}/tasks/extractRefreshes/{}'.format(VERSION, site_id, efl['task_id']) for efl in extract_failed_list]
+    outcomes = bulk_delete(session, delete_urls, auth_token)
+    for efl, outcome in zip(extract_failed_list, outcomes):
+        log += '\n\nExtract Refresh task (id {}) found for {} {}.\nDELETING TASK'.format(efl['task_id'], efl['object'], efl['title'])
+        if outcome['deleted']:
+            log += ' ---> DELETED!\n\n' + outcome['url']
+        else:
+            log += '\n\nERROR: could not delete task after {0} attempt(s): {1}'.format(outcome['attempts'], outcome['error'])
+    log += bulk_delete_summary(outcomes)
     return log
 
 
@@ -222,26 +518,28 @@ def find_owners(all_objects, target_object):
     return list(set(o_found))
 
 
+@phase('query_views')
 def query_views(session, server, auth_token, site_id, workbook_id):
     url = server + "/api/{0}/sites/{1}/workbooks/{2}/views".format(VERSION, site_id, workbook_id)
 
-    server_response = session.get(url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
+    server_response = session.get(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = _parse_response(server_response)
     
     views = xml_response.findall('.//t:view', namespaces=xmlns)
     
     return views
 
 
-def get_objects_owners(session, server, site_id, user_id, auth_token, all_projects, all_workbooks, all_datasources):
+@phase('get_objects_owners')
+def get_objects_owners(session, server, site_id, user_id, auth_token, all_projects, all_workbooks, all_datasources, site_views):
 
     
+    views_by_workbook = index_views(site_views)
     all_views = []
     for workbook in all_workbooks:
         if workbook.get('id') != None:
-            views_in_workbook = query_views(session, server, auth_token, site_id, workbook.get('id'))
-            for viw in views_in_workbook:
+            for viw in views_by_workbook.get(workbook.get('id'), []):
                 view = {'connection': viw,'workbook': workbook.get('name')}
                 all_views.append(view)
     
@@ -282,50 +580,220 @@ def get_objects_owners(session, server, site_id, user_id, auth_token, all_projec
     return projects, workbooks, datasources, views
 
 
-def query_jobs(session, server, auth_token, site_id, page_size, page_num):
-    
+def _job_filter(field, value):
+    if isinstance(value, (list, tuple)):
+        return '{0}:in:[{1}]'.format(field, ','.join(value))
+    return '{0}:eq:{1}'.format(field, value)
+
+
+def iter_jobs(session, server, auth_token, site_id, page_size=100, page_num=1, job_type=None, status=None, created_after=None, created_before=None):
+    """
+    Gets the background jobs of the site page by page, filtered by the server.
+
+    'job_type'          type(s) of job, e.g. 'refresh_extracts' or ['refresh_extracts', 'increment_extracts']
+    'status'            status(es) of job, e.g. 'Failed'
+    'created_after'     datetime (UTC) from which the jobs were created
+    'created_before'    datetime (UTC) until which the jobs were created
+    Yields the backgroundJob elements of each page.
+    """
+    filters = []
+    if job_type != None:
+        filters.append(_job_filter('jobType', job_type))
+    if status != None:
+        filters.append(_job_filter('status', status))
+    if created_after != None:
+        filters.append('createdAt:gte:{0}'.format(created_after.strftime('%Y-%m-%dT%H:%M:%SZ')))
+    if created_before != None:
+        filters.append('createdAt:lte:{0}'.format(created_before.strftime('%Y-%m-%dT%H:%M:%SZ')))
     url = "{0}/api/{1}/sites/{2}/jobs".format(server, VERSION, site_id)
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-   
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token}, verify=False)
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    text_response = server_response.text.split('><')
-    
-    total_items = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
-    max_page = int(math.ceil(total_items / page_size))
-    
-    # Continue querying if more workbooks exist on the server
-    for page in range(2, max_page + 1):
-        page_num+=1
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-
-        server_response = session.get(paged_url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
-        _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        text_response = text_response + server_response.text.split('><')
- 
-    job_id = []
-    job_status = []
-    job_created = []
-    job_started = []
-    job_ended = []
-    job_type = []
-    
-    for tr in text_response:
-        if 'backgroundJob' in tr and 'backgroundJobs' not in tr:
-            new_line = tr.split(' ')
-            job_id.append([jid for jid in new_line if 'id' in jid][0].split('"')[1])
-            job_status.append([jid for jid in new_line if 'status' in jid][0].split('"')[1])
-            job_created.append([jid for jid in new_line if 'createdAt' in jid][0].split('"')[1])
-            job_started.append([jid for jid in new_line if 'startedAt' in jid][0].split('"')[1])
-            job_ended.append([jid for jid in new_line if 'endedAt' in jid][0].split('"')[1])
-            job_type.append([jid for jid in new_line if 'jobType' in jid][0].split('"')[1])
-    df = pd.DataFrame({'id':job_id,'status':job_status,'createdAt':job_created,'startedAt':job_started,
-                       'endedAt':job_ended, 'type':job_type})
+    if len(filters) > 0:
+        url = url + '?filter=' + ','.join(filters)
+
+    while True:
+        jobs, total_items = _get_page(session, url, auth_token, page_size, page_num, 'backgroundJob')
+        yield jobs
+        if page_num * page_size >= total_items or len(jobs) == 0:
+            break
+        page_num += 1
+
+
+@phase('query_jobs')
+def query_jobs(session, server, auth_token, site_id, page_size, page_num, job_type=None, status=None, created_after=None, created_before=None):
+    """
+    Gets the background jobs of the site (see iter_jobs for the filters).
+
+    Returns a DataFrame with one row per job: id, status, createdAt, startedAt, endedAt (UTC datetimes) and type.
+    """
+    columns = {'id': 'id', 'status': 'status', 'createdAt': 'createdAt', 'startedAt': 'startedAt', 'endedAt': 'endedAt', 'jobType': 'type'}
+    pages = []
+    for jobs in iter_jobs(session, server, auth_token, site_id, page_size, page_num, job_type, status, created_after, created_before):
+        pages.append(pd.DataFrame([{column: job.get(attribute) for attribute, column in columns.items()} for job in jobs], columns=list(columns.values())))
+    df = pd.concat(pages, ignore_index=True)
+    for column in ('createdAt', 'startedAt', 'endedAt'):
+        df[column] = pd.to_datetime(df[column], utc=True, errors='coerce')
+    df['status'] = df['status'].astype('category')
+    df['type'] = df['type'].astype('category')
     return df
 
-def get_all(session, server, auth_token, user_id, site_id, page_size, page_num, obj):
+async def _call(semaphore, function, args):
+    async with semaphore:
+        # the REST calls use requests, which blocks: each call runs in a worker thread of the event loop
+        return await asyncio.to_thread(function, *args)
+
+
+async def gather_calls(calls, concurrency):
+    """
+    Runs REST calls concurrently, with at most 'concurrency' calls in flight at the same time.
+
+    'calls'         list of (function, args), e.g. (user_id2name, (session, server, auth_token, site_id, user_id))
+    'concurrency'   maximum number of calls running at the same time
+    Returns the results in the order of 'calls', with the exception in place of the result of a failed call.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_call(semaphore, function, args) for function, args in calls], return_exceptions=True)
+
+
+def run_calls(calls, concurrency=None):
+    """
+    Blocking entry point of gather_calls, for the processes (ASYNC_CONCURRENCY calls at a time by default).
+    """
+    if len(calls) == 0:
+        return []
+    return asyncio.run(gather_calls(calls, concurrency or ASYNC_CONCURRENCY))
+
+
+class RateLimiter:
+    """
+    Spaces the calls made by several threads, so that at most 'rate' calls start every second (no limit if 'rate' is 0).
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_call)
+            self.next_call = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _delete_with_retries(session, url, auth_token, limiter, retries, backoff):
+    """
+    Sends one DELETE request, retried with exponential backoff (or after the Retry-After delay of the server)
+    when the server answers 429 or 5xx or the connection fails.
+    Returns the outcome: {'url', 'status', 'attempts', 'deleted', 'error'}
+    """
+    outcome = {'url': url, 'status': None, 'attempts': 0, 'deleted': False, 'error': None}
+    for attempt in range(retries + 1):
+        limiter.wait()
+        outcome['attempts'] += 1
+        delay = backoff * 2 ** attempt
+        try:
+            server_response = session.delete(url, headers=_headers(auth_token), verify=verifySsl)
+        except requests.exceptions.RequestException as err:
+            outcome['error'] = str(err)
+        else:
+            outcome['status'] = server_response.status_code
+            if server_response.status_code in (200, 204):
+                outcome['deleted'] = True
+                outcome['error'] = None
+                return outcome
+            try:
+                _check_status(server_response, 204)
+            except Exception as err:
+                outcome['error'] = str(err) or 'HTTP {0}'.format(server_response.status_code)
+            if server_response.status_code != 429 and server_response.status_code < 500:
+                return outcome
+            retry_after = server_response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = int(retry_after)
+        if attempt < retries:
+            time.sleep(delay)
+    return outcome
+
+
+@phase('bulk_delete')
+def bulk_delete(session, urls, auth_token, rate=None, retries=None, concurrency=None):
+    """
+    Deletes several REST resources (tasks, subscriptions, users...) concurrently, in one pass.
+
+    'session'       session of the server
+    'urls'          urls of the resources to delete
+    'auth_token'    authentication token of the session
+    'rate'          maximum number of DELETE requests started per second (DELETE_RATE by default, 0 = no limit)
+    'retries'       number of retries of a request answered with 429 or 5xx (DELETE_RETRIES by default)
+    'concurrency'   maximum number of requests in flight (ASYNC_CONCURRENCY by default)
+    Returns the outcome of every url, in the order of 'urls' (see _delete_with_retries).
+    """
+    limiter = RateLimiter(DELETE_RATE if rate is None else rate)
+    retries = DELETE_RETRIES if retries is None else retries
+    results = run_calls([(_delete_with_retries, (session, url, auth_token, limiter, retries, DELETE_BACKOFF)) for url in urls], concurrency)
+    return [result if not isinstance(result, Exception) else {'url': url, 'status': None, 'attempts': 0, 'deleted': False, 'error': str(result)}
+            for url, result in zip(urls, results)]
+
+
+def bulk_delete_summary(outcomes):
+    """
+    Returns the log line counting the resources deleted by bulk_delete and the requests retried.
+    """
+    deleted = len([outcome for outcome in outcomes if outcome['deleted']])
+    retried = sum([outcome['attempts'] - 1 for outcome in outcomes if outcome['attempts'] > 1])
+    return '\n\nBulk delete: {0} of {1} deleted, {2} request(s) retried'.format(deleted, len(outcomes), retried)
+
+
+def _parse_items(content, obj):
+    """
+    Parses a listing page incrementally, straight from the bytes of the response.
+
+    'content'       raw body of the server response
+    'obj'           object listed: workbook, datasource, project, view, user
+    Returns the items of the listing, each one detached from the page as soon as it is read,
+    and the total number of items available.
+    """
+    item_tag = '{{{0}}}{1}'.format(xmlns['t'], obj)
+    list_tag = item_tag + 's'
+    pagination_tag = '{{{0}}}pagination'.format(xmlns['t'])
+    items = []
+    total_items = None
+    parents = []
+    for event, element in ET.iterparse(io.BytesIO(content), events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag == item_tag and len(parents) > 0 and parents[-1].tag == list_tag:
+            items.append(element)
+            parents[-1].remove(element)
+        elif element.tag == pagination_tag:
+            total_items = int(element.get('totalAvailable'))
+    return items, total_items
+
+
+def _get_page(session, url, auth_token, page_size, page_num, obj):
+    """
+    Gets one page of objects from ECB/ESCB Tableau server.
+
+    'url'           listing address of the object, without paging parameters (filters allowed)
+    'auth_token'    authentication token that grants user access to API calls
+    'obj'           object to be retrieved: workbook, datasource, project, view
+    Returns the items in the page and the total number of items available.
+    """
+    paged_url = url + ("&" if "?" in url else "?") + "pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+    server_response = session.get(paged_url, headers=_headers(auth_token), verify=verifySsl)
+    _check_status(server_response, 200)
+    if RESPONSE_FORMAT == 'json':
+        xml_response = _parse_response(server_response)
+        items = xml_response.findall('t:{0}s/t:{0}'.format(obj), namespaces=xmlns)
+        return items, int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
+    return _parse_items(server_response.content, obj)
+
+
+@phase('get_all')
+def get_all(session, server, auth_token, user_id, site_id, page_size, page_num, obj, max_workers=1):
     """
     Gets all_objects from ECB/ESCB Tableau server.
 
@@ -334,6 +802,7 @@ def get_all(session, server, auth_token, user_id, site_id, page_size, page_num,
     'user_id'       ID of user with access to workbook
     'site_id'       ID of the site that the user is signed into
     'obj'           object to be retrieved: workbook, datasource, project, view
+    'max_workers'   number of pages requested at the same time (1 = one page after the other)
     """
     
     if obj == 'workbook':
@@ -341,32 +810,122 @@ def get_all(session, server, auth_token, user_id, site_id, page_size, page_num,
     else:
         url = server + "/api/{0}/sites/{1}/".format(VERSION, site_id) + obj + 's'
 
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-
-    server_response = session.get(url,data=None,  headers={'x-tableau-auth': auth_token}, verify=verifySsl) #, verify=verifySsl
-    _check_status(server_response, 200) #Function defined above
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    
-    items = xml_response.findall('.//t:' + obj, namespaces=xmlns) #Search XML for workbook data
-    
-    # Used to determine if more requests are required to find all workbooks on server
-    total_items = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
+    # The first page tells how many requests are required to find all objects on server
+    items, total_items = _get_page(session, url, auth_token, page_size, page_num, obj)
     max_page = int(math.ceil(total_items / page_size))
-    
-    # Continue querying if more workbooks exist on the server
-    for page in range(2, max_page + 1):
-        page_num+=1
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-
-        server_response = session.get(paged_url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
-        _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        #Search XML server response (xml_response) for relevant data - workbooks
-        items.extend(xml_response.findall('.//t:' + obj, namespaces=xmlns))
+    pages = range(page_num + 1, page_num + max_page)
+
+    if max_workers > 1 and len(pages) > 1:
+        # map() returns the pages in the order they were requested, so the items
+        # are reassembled exactly as in the sequential crawl
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda page: _get_page(session, url, auth_token, page_size, page, obj)[0], pages))
+    else:
+        results = [_get_page(session, url, auth_token, page_size, page, obj)[0] for page in pages]
+
+    for page_items in results:
+        items.extend(page_items)
     
     return items
 
+
+@phase('get_inventory')
+def get_inventory(session, server, auth_token, user_id, site_id, page_size, page_num, objs, max_workers=1, snapshot_max_age=0):
+    """
+    Gets the listings of several objects from ECB/ESCB Tableau server at the same time.
+
+    'objs'              objects to be retrieved, e.g. ('project', 'workbook', 'datasource')
+    'max_workers'       number of pages requested at the same time for each listing
+    'snapshot_max_age'  age in hours under which a listing saved by a previous process is reused
+                        (0 = always query the server)
+    Returns a dictionary with the list of items for every object.
+    """
+    inventory = {}
+    if snapshot_max_age > 0:
+        for obj in objs:
+            items = load_snapshot(server, site_id, user_id, obj, snapshot_max_age)
+            if items is not None:
+                inventory[obj] = items
+    missing = [obj for obj in objs if obj not in inventory]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {obj: executor.submit(get_all, session, server, auth_token, user_id, site_id, page_size, page_num, obj, max_workers) for obj in missing}
+        for obj, future in futures.items():
+            inventory[obj] = future.result()
+            if snapshot_max_age > 0:
+                save_snapshot(server, site_id, user_id, obj, inventory[obj])
+    return inventory
+
+
+def _snapshot_file(server, site_id, user_id, obj):
+    """
+    Returns the path of the snapshot file of an object listing, one file per server, site, user and object:
+    the listings hold what the signed in user sees on the site (the workbooks are even listed per user).
+    """
+    key = re.sub('[^0-9A-Za-z]+', '_', '{0}_{1}_{2}'.format(server, site_id, user_id)).strip('_')
+    return os.path.join(SNAPSHOT_DIR, '{0}_{1}s.xml'.format(key, obj))
+
+
+def save_snapshot(server, site_id, user_id, obj, items):
+    """
+    Stores an object listing on local disk, so that the other housekeeping processes
+    can reuse it instead of crawling the server again.
+
+    'server'        specified server address
+    'site_id'       ID of the site that the user is signed into
+    'user_id'       ID of the signed in user
+    'obj'           object of the listing: workbook, datasource, project, view
+    'items'         XML elements returned by get_all
+    """
+    snapshot = ET.Element('snapshot', server=server, site=site_id, user=user_id, obj=obj, created=datetime.now().isoformat())
+    snapshot.extend(items)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    snapshot_file = _snapshot_file(server, site_id, user_id, obj)
+    # Write to a temporary file first, so a process reading the snapshot never sees half of it
+    ET.ElementTree(snapshot).write(snapshot_file + '.tmp', encoding='utf-8')
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+    return
+
+
+def load_snapshot(server, site_id, user_id, obj, max_age):
+    """
+    Loads an object listing stored by save_snapshot.
+
+    'server'        specified server address
+    'site_id'       ID of the site that the user is signed into
+    'user_id'       ID of the signed in user
+    'obj'           object of the listing: workbook, datasource, project, view
+    'max_age'       maximum age of the snapshot in hours
+    Returns the XML elements of the listing, or None if no snapshot younger than max_age exists.
+    """
+    snapshot_file = _snapshot_file(server, site_id, user_id, obj)
+    if not os.path.exists(snapshot_file):
+        return None
+
+    snapshot = ET.parse(snapshot_file).getroot()
+    created = datetime.fromisoformat(snapshot.get('created'))
+    if (snapshot.get('server'), snapshot.get('site'), snapshot.get('user')) != (server, site_id, user_id) or datetime.now() - created > timedelta(hours=max_age):
+        return None
+    return list(snapshot)
+
  
+def index_views(all_views):
+    """
+    Indexes the views of the site-level listing by the id of their workbook.
+
+    'all_views'     views from get_all(..., 'view'), each one with its workbook and owner inlined
+    Returns a dictionary {workbook id: [views]}, the views in the order of the listing.
+    """
+    views_by_workbook = {}
+    for view in all_views:
+        workbook = view.find('t:workbook', namespaces=xmlns)
+        if workbook != None:
+            views_by_workbook.setdefault(workbook.get('id'), []).append(view)
+    return views_by_workbook
+
+
 def find_workbook(all_workbooks, workbook_id):
     w_found = []
     for work in all_workbooks:
@@ -377,93 +936,275 @@ def find_workbook(all_workbooks, workbook_id):
         return w_found[0].get('name')
         
 
-def postgresql(password, host, query):
-    """ Querying projects with missing Project Leaders"""
-    
+def get_connection(password, host):
+    """
+    Returns a connection to the Tableau repository of a host, reusing a connection of
+    the pool of the host when one is free, so that every query does not open a new one.
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    """
+    with connection_pools_lock:
+        if host not in connection_pools:
+            connection_pools[host] = psycopg2.pool.ThreadedConnectionPool(1, POOL_SIZE, database='workgroup', user='readonly', password=password, host=host, port=8060)
+            connection_pools_stats[host] = {'queries': 0, 'connections': set()}
+        pool = connection_pools[host]
+    connection = pool.getconn()
+    with connection_pools_lock:
+        connection_pools_stats[host]['queries'] += 1
+        connection_pools_stats[host]['connections'].add(id(connection))
+    return connection
+
+
+def release_connection(host, connection):
+    """
+    Gives a connection back to the pool of its host.
+    """
     try:
-        connection = psycopg2.connect(database='workgroup', user='readonly', password=password, host=host, port=8060)
-        cur = connection.cursor()
-        cur.execute(query)
-        row = cur.fetchone()
-        df = [row]
-     
-        while row is not None:
-            df.append(row)
-            row = cur.fetchone()
+        # close the read-only transaction opened by the query
+        connection.rollback()
+        connection_pools[host].putconn(connection)
+    except (Exception, psycopg2.DatabaseError) as error:
+        connection_pools[host].putconn(connection, close=True)
+    return
+
+
+def close_connection_pools():
+    """
+    Closes every pooled connection, at the end of the run.
+    """
+    with connection_pools_lock:
+        for pool in connection_pools.values():
+            pool.closeall()
+        connection_pools.clear()
+    return
+
+
+def connection_pools_summary():
+    """
+    Returns the log lines with the number of queries and connections used per host.
+    """
+    text = ''
+    for host, stats in connection_pools_stats.items():
+        connections = len(stats['connections'])
+        text = text + '\npostgreSQL {0}: {1} queries on {2} connection(s), {3} reused'.format(host, stats['queries'], connections, stats['queries'] - connections)
+    return text
+
+
+def postgresql_batches(password, host, query, params=None, batch_size=5000):
+    """
+    Reads the result of a query on the Tableau repository batch by batch, through a
+    server-side cursor, so that large tables are never loaded in memory at once.
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    'query'         SQL query, with %s placeholders for 'params'
+    'batch_size'    number of rows fetched from the server at a time
+    Yields one DataFrame per batch, with the column names of the query and the "Server" column
+    (a single empty DataFrame if the query returns no row).
+    """
+    connection = get_connection(password, host)
+    # time spent waiting for the repository only, not for the caller reading the batches
+    elapsed = 0.0
+    rows_read = 0
+    try:
+        # a named cursor is declared on the server, rows are only sent when fetched
+        cur = connection.cursor(name='housekeeping')
+        start = time.perf_counter()
+        cur.execute(query.strip().rstrip(';'), params)
+        rows = cur.fetchmany(batch_size)
+        elapsed += time.perf_counter() - start
+        columns = [column[0] for column in cur.description]
+        first = True
+        while rows or first:
+            rows_read += len(rows)
+            df = pd.DataFrame(rows, columns=columns)
+            df["Server"] = host
+            yield df
+            first = False
+            start = time.perf_counter()
+            rows = cur.fetchmany(batch_size)
+            elapsed += time.perf_counter() - start
         cur.close()
-        
+    finally:
+        release_connection(host, connection)
+        _add_timing(query_timings, query_timings_lock, _query_table(query), elapsed, rows=rows_read)
+
+
+def _query_table(query):
+    """
+    Returns the name a query is timed under in query_timings: the first table it reads.
+    """
+    match = re.search(r'\bfrom\s+([\w."]+)', query, re.IGNORECASE)
+    return match.group(1) if match else query.strip()[:40]
+
+
+def postgresql(password, host, query, params=None):
+    """
+    Queries the Tableau repository (workgroup database)
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    'query'         SQL query, with %s placeholders for 'params'
+    Returns a DataFrame with the column names of the query and the "Server" column.
+    """
+    try:
+        df = pd.concat(list(postgresql_batches(password, host, query, params)), ignore_index=True)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    
-    finally:
-        if connection is not None:
-            connection.close()
-    df = pd.DataFrame(df)
-    df["Server"] = host
+        raise
     df = df.drop_duplicates()
     return df
 
 
-def five_days_errors(password, host):
+def failure_streaks(df):
+    """
+    Computes the failure streaks of every item of the background tasks at once.
+
+    'df'            background tasks with the columns items, items_id, completed_at and finish_code (0 = succeeded)
+    Returns the completed tasks sorted by item and completion time (the running ones are left out), with the columns:
+    'delta'         days since the previous task of the item (0 for the first one)
+    'cum_delta'     length in days of the failure streak up to the task (0 when the task succeeded)
+    'runs'          number of failed runs in the streak up to the task (0 when the task succeeded)
+    When df has the 'carry_days' and 'carry_runs' columns (rows seeded from a saved state, see five_days_errors),
+    the failures in the streak of a seeded row are counted on top of its values.
+    """
+    df = df[df['completed_at'].notnull()].sort_values(by=['items', 'items_id', 'completed_at']).copy()
+    # workbooks and datasources have their own ids: an item is its type (items) and its id
+    items = [df['items'], df['items_id']]
+    # only a success ends a streak: failed and cancelled tasks are part of it
+    failed = df['finish_code'] != 0
+    df['delta'] = pd.to_datetime(df['completed_at']).dt.normalize().groupby(items).diff().dt.days.fillna(0).astype(int)
+    # every success starts a new streak for the item
+    streak = items + [(~failed).astype(int).groupby(items).cumsum()]
+    df['runs'] = failed.astype(int).groupby(streak).cumsum().where(failed, 0)
+    # the first failure of a streak counts for 1 day, the next ones add the days since the previous task
+    df['cum_delta'] = (df['delta'].where(failed & (df['runs'] > 1), 0).groupby(streak).cumsum() + 1).where(failed, 0)
+    if 'carry_days' in df.columns:
+        df['cum_delta'] = df['cum_delta'] + df['carry_days'].fillna(0).groupby(streak).transform('max').where(failed, 0).astype(int)
+        df['runs'] = df['runs'] + df['carry_runs'].fillna(0).groupby(streak).transform('max').where(failed, 0).astype(int)
+    return df
+
+
+def streaks_summary(df, threshold=5):
+    """
+    Returns the items whose current failure streak (see failure_streaks) is longer than 'threshold' days,
+    one row per item: items_id, items, title, server, streak_days, failed_runs and last_completed_at.
+    """
+    last = df.groupby(['items', 'items_id'], sort=False).tail(1)
+    last = last[last['cum_delta'] > threshold]
+    return pd.DataFrame({'items_id': last['items_id'], 'items': last['items'], 'title': last['title'], 'server': last['server'],
+                         'streak_days': last['cum_delta'], 'failed_runs': last['runs'],
+                         'last_completed_at': last['completed_at']}).reset_index(drop=True)
+
+
+def _watermark_file(host):
+    """
+    Returns the path of the watermark file of a postgreSQL host.
+    """
+    host_key = re.sub('[^0-9A-Za-z]+', '_', host).strip('_')
+    return os.path.join(WATERMARK_DIR, '{0}.json'.format(host_key))
+
+
+def load_watermark(host):
+    """
+    Loads the state saved by the last incremental run of five_days_errors on a host:
+    'last_id'   highest _background_tasks id read
+    'pending'   ids up to last_id still running at that time, to be read again
+    'items'     failure streak of every item failing at that time (items:items_id -> last task of the item)
+    """
+    watermark_file = _watermark_file(host)
+    if not os.path.exists(watermark_file):
+        return {'last_id': 0, 'pending': [], 'items': {}}
+    with open(watermark_file, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_watermark(host, watermark):
+    """
+    Stores the state of five_days_errors for the next incremental run (see load_watermark).
+    """
+    os.makedirs(WATERMARK_DIR, exist_ok=True)
+    watermark_file = _watermark_file(host)
+    # Write to a temporary file first, so an interrupted run never leaves half a watermark
+    with open(watermark_file + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(watermark, file)
+    os.replace(watermark_file + '.tmp', watermark_file)
+    return
+
+
+@phase('five_days_errors')
+def five_days_errors(password, host, threshold=5, incremental=False):
+    """
+    Finds the extracts whose refresh has been failing for more than 'threshold' days in a row.
+
+    'incremental'   only read the tasks recorded since the last incremental run, the streaks of
+                    the items are resumed from the watermark of the host (see load_watermark)
+    Returns the tasks of each of these items (with the delta, cum_delta and runs columns of failure_streaks),
+    one DataFrame per item. In incremental mode the first task of an item can be the one saved by the last run.
+    """
     #query = "select id,args,title, created_at,started_at,completed_at,job_type,job_name,notes from _background_tasks where finish_code =1 and job_name in ('Refresh Extracts','Increment Extracts')"
     query = "select id,args,title, created_at,started_at,completed_at,job_type,job_name,notes,finish_code from _background_tasks where job_name in ('Refresh Extracts','Increment Extracts')"
-    df = postgresql(password, host, query)
-    names = ['id','args','title', 'created_at','started_at','completed_at','job_type','job_name','notes','finish_code','server']
-    df.columns = names
-    df['items'] = [i.split('\n-')[1] for i in list(df['args'])]
-    df['items_id'] = [i.split('\n-')[2] for i in list(df['args'])]
+    if incremental:
+        watermark = load_watermark(host)
+        df = postgresql(password, host, query + ' and (id > %s or id = ANY(%s::integer[]))', (watermark['last_id'], watermark['pending']))
+    else:
+        df = postgresql(password, host, query)
+    df = df.rename(columns={'Server': 'server'})
+    args = df['args'].str.split('\n-')
+    df['items'] = args.str[1]
+    df['items_id'] = args.str[2]
     df = df[['id','items','title', 'items_id','created_at','started_at','completed_at','job_type','job_name','notes','finish_code','server']]
-    df['date'] = [str(i.day)+'-'+str(i.month)+'-'+str(i.year) for i in list(df['completed_at'])]
-    df = df.sort_values(by=['items_id', 'completed_at'])
-    
-    error_df = df[(df['finish_code'] == 1)]
-    unique_items = list(set(list(error_df['items_id'])))
-    error_df_list = []
-    for ui in unique_items:
-        data = df[(df['items_id']) == ui]
-        #data = data.groupby('date').tail(1)
-        error_df_list.append(data)
-    
-    for edl in range(len(error_df_list)):
-        delta_days = []
-        pivot_id = ''
-        for i in range(len(error_df_list[edl])):
-            if error_df_list[edl].iloc[i]['items_id'] == pivot_id:
-                if str(error_df_list[edl].iloc[i]['completed_at']) != 'NaT':
-                    l_date = date(error_df_list[edl].iloc[i]['completed_at'].year, error_df_list[edl].iloc[i]['completed_at'].month, error_df_list[edl].iloc[i]['completed_at'].day)
-                    delta = l_date - f_date
-                    delta_days.append(int(delta.days))
-                else:
-                    delta_days.append(None)
-            else:
-                delta_days.append(0)
-            pivot_id = error_df_list[edl].iloc[i]['items_id']
-            f_date = date(error_df_list[edl].iloc[i]['completed_at'].year, error_df_list[edl].iloc[i]['completed_at'].month, error_df_list[edl].iloc[i]['completed_at'].day)
-        error_df_list[edl]['delta'] = delta_days
-        
-        cum_delta = []
-        counter = 0
-        for i in range(len(error_df_list[edl])):
-            if error_df_list[edl].iloc[i]['finish_code'] == 0:
-                cum_delta.append(0)
-                counter = 0
-            else:
-                if counter == 0:
-                    counter = 1
-                    cum_delta.append(1)
-                else:
-                    cum_delta.append(counter + int(error_df_list[edl].iloc[i]['delta']))
-                    counter  = counter + int(error_df_list[edl].iloc[i]['delta'])
-        error_df_list[edl]['cum_delta'] =  cum_delta
-            
-    five_days_error = []
-    for x in error_df_list:
-        if list(x['cum_delta'])[len(x)-1] > 5:
-            five_days_error.append(x)
+    completed_at = pd.to_datetime(df['completed_at'])
+    df['date'] = completed_at.dt.day.astype(str) + '-' + completed_at.dt.month.astype(str) + '-' + completed_at.dt.year.astype(str)
+
+    if incremental:
+        running = df['completed_at'].isnull()
+        last_id = max([watermark['last_id']] + [int(i) for i in df['id']])
+        watermark['pending'] = [int(i) for i in df[running]['id']]
+        df = df[~running]
+        # one row per item still failing at the last run, carrying its streak
+        seeds = pd.DataFrame(list(watermark['items'].values()), columns=['items_id', 'items', 'title', 'server', 'completed_at', 'cum_delta', 'runs'])
+        seeds['completed_at'] = pd.to_datetime(seeds['completed_at'])
+        seeds['finish_code'] = 1
+        seeds['carry_days'] = seeds['cum_delta'] - 1
+        seeds['carry_runs'] = seeds['runs'] - 1
+        df = pd.concat([seeds.drop(columns=['cum_delta', 'runs']), df], ignore_index=True)
+
+    df = failure_streaks(df)
+    summary = streaks_summary(df, threshold)
+
+    if incremental:
+        last = df.groupby(['items', 'items_id'], sort=False).tail(1)
+        last = last[last['cum_delta'] > 0]
+        watermark['last_id'] = last_id
+        watermark['items'] = {'{0}:{1}'.format(row['items'].strip(), row['items_id'].strip()): {'items_id': row['items_id'], 'items': row['items'], 'title': row['title'], 'server': row['server'],
+                                                'completed_at': pd.Timestamp(row['completed_at']).isoformat(), 'cum_delta': int(row['cum_delta']), 'runs': int(row['runs'])}
+                              for row in last.to_dict('records')}
+        save_watermark(host, watermark)
+    failing = pd.MultiIndex.from_frame(df[['items', 'items_id']]).isin(pd.MultiIndex.from_frame(summary[['items', 'items_id']]))
+    five_days_error = [data for item, data in df[failing].groupby(['items', 'items_id'], sort=False)]
             
     return five_days_error
 
 
+@phase('load_user_names')
+def load_user_names(session, server, auth_token, user_id, site_id, page_size=100):
+    """
+    Loads the names of all the users of the site with the paginated users listing,
+    so that user_id2name does not need one request per user.
+
+    'server'        specified server address
+    'auth_token'    authentication token that grants user access to API calls
+    'user_id'       ID of the signed in user
+    'site_id'       ID of the site that the user is signed into
+    """
+    users = get_all(session, server, auth_token, user_id, site_id, page_size, 1, 'user', PAGE_WORKERS)
+    user_names[server] = {user.get('id'): user.get('name') for user in users}
+    return
+
+
+@phase('user_id2name')
 def user_id2name(session, server, auth_token, site_id, target_user_id):
     """
     Maps user ID to the respective user name on the server
@@ -479,28 +1220,86 @@ def user_id2name(session, server, auth_token, site_id, target_user_id):
     if (not isinstance(target_user_id, str)):
         return (None, None)
     
+    # Users loaded in bulk by load_user_names (or already queried) are answered from memory
+    names = user_names.setdefault(server, {})
+    if target_user_id in names:
+        return names[target_user_id]
+
     url = server + "/api/{0}/sites/{1}/users/{2}?fields=name".format(VERSION, site_id, target_user_id)
     
-    server_response = session.get(url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
+    server_response = session.get(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))    
+    xml_response = _parse_response(server_response)    
     
     #Creating tuple of name and e-mail from dictionary
     name = xml_response[0].get('name')       
+    names[target_user_id] = name
     return name
 
 
-def get_project_leader(project_name, all_projects, server, site_id, auth_token, session, df_groups, log):
-    
-    pfound =[project for project in all_projects if project.get('name') == project_name]
-    project_id = pfound[0].get('id')
-    
+def index_projects(all_projects):
+    """
+    Indexes the project hierarchy once per run, so that the top-level project of
+    any project is found without scanning the project list again.
+
+    'all_projects'  project elements returned by get_all
+    Returns a dictionary with the maps id -> project, name -> project and id -> top-level project
+    (None if the hierarchy of the project cannot be resolved).
+    """
+    by_id = {pr.get('id'): pr for pr in all_projects}
+    by_name = {}
+    for pr in all_projects:
+        by_name.setdefault(pr.get('name'), pr)
+
+    top = {}
+    for project_id in by_id:
+        # walk up until a project whose top-level project is already known,
+        # then store the result for every project met on the way
+        path = []
+        pivot = project_id
+        while pivot not in top:
+            if pivot not in by_id or pivot in path:
+                top[pivot] = None
+                break
+            path.append(pivot)
+            parent_id = by_id[pivot].get('parentProjectId')
+            if parent_id == None:
+                top[pivot] = by_id[pivot]
+                break
+            pivot = parent_id
+        for pid in path:
+            top[pid] = top[pivot]
+
+    return {'by_id': by_id, 'by_name': by_name, 'top': top}
+
+
+def find_top_project(project_index, project_id):
+    """
+    Returns the top-level project element of a project.
+
+    'project_index' dictionary returned by index_projects
+    'project_id'    ID of the project
+    Throws a KeyError if the hierarchy of the project cannot be resolved.
+    """
+    top_project = project_index['top'].get(project_id)
+    if top_project is None:
+        raise KeyError(project_id)
+    return top_project
+
+
+@phase('get_project_leader')
+def _fetch_project_leader(project_id, server, site_id, auth_token, session, groups_index):
+    """
+    Queries the Project Leaders of a project (users, and users of the leader groups) without logging anything.
+
+    Returns the leader users, the leader groups and the errors met, as log lines.
+    """
     url=server + "/api/" + VERSION + "/sites/" + site_id + "/projects/" + project_id + "/permissions"
 
-    server_response = session.get(url, data=None , headers={'x-tableau-auth': auth_token}, verify=verifySsl) 
+    server_response = session.get(url, data=None , headers=_headers(auth_token), verify=verifySsl) 
     _check_status(server_response, 200)
     
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = _parse_response(server_response)
     
     permissions = xml_response.findall('.//t:granteeCapabilities', namespaces=xmlns)
     leads_users = []
@@ -520,17 +1319,17 @@ def get_project_leader(project_name, all_projects, server, site_id, auth_token,
 
     l_users = []
     l_groups = []
+    errors = []
 
     for lgroup in leads_groups:
         try:
             l_groups.append({'id': lgroup.get('id')})
-            uing = get_users_in_group(df_groups, lgroup.get('id'))
+            uing = get_users_in_group(groups_index, lgroup.get('id'))
             leads_users = leads_users + uing
         
         except Exception as err:
-            log = log + "\n\nERROR: your user is not authorized to query group '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!".format(lgroup.get('id'), server)
+            errors.append("\n\nERROR: your user is not authorized to query group '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!".format(lgroup.get('id'), server))
             l_groups.append(None)
-            log_file(log)
 
     for luser in leads_users:
         try:
@@ -540,16 +1339,75 @@ def get_project_leader(project_name, all_projects, server, site_id, auth_token,
                 l_user = user_id2name(session, server, auth_token, site_id, luser.get('id'))
                 l_users.append({'name': l_user, 'id': luser.get('id')})
         except Exception as err:
-            log = log + "\n\nERROR: your user is not authorized to query user '{0}' in server {1}, so no email was sent.\nAdmin privilegies are required!".format(luser.get('id'),server)
+            errors.append("\n\nERROR: your user is not authorized to query user '{0}' in server {1}, so no email was sent.\nAdmin privilegies are required!".format(luser.get('id'),server))
             l_users.append(None)
-            log_file(log)
 
     l_users = [i for i in l_users if i != None]
     l_users = [dict(y) for y in set(tuple(x.items()) for x in l_users)]
-    return l_users, l_groups
+    return l_users, l_groups, errors
+
+
+def get_project_leader(project_name, all_projects, server, site_id, auth_token, session, groups_index, log):
+    
+    pfound =[project for project in all_projects if project.get('name') == project_name]
+    project_id = pfound[0].get('id')
+
+    # The leaders of a project are queried once per run, then served from project_leaders
+    cache = project_leaders.setdefault(server, {})
+    stats = project_leaders_stats.setdefault(server, {'hits': 0, 'misses': 0})
+    if project_id in cache:
+        stats['hits'] += 1
+        l_users, l_groups = cache[project_id]
+        return [dict(lu) for lu in l_users], list(l_groups)
+    stats['misses'] += 1
+
+    l_users, l_groups, errors = _fetch_project_leader(project_id, server, site_id, auth_token, session, groups_index)
+    for error in errors:
+        log += error
+        log_file(log)
+    cache[project_id] = (l_users, l_groups)
+    return [dict(lu) for lu in l_users], list(l_groups)
+
+
+def _prefetch_project_leader(project_name, all_projects, server, site_id, auth_token, session, groups_index):
+    """
+    Queries the Project Leaders of a project in a worker of run_calls, so that get_project_leader then reads them
+    from project_leaders. Nothing is logged here: a project that could not be queried completely is not stored,
+    get_project_leader queries it again and logs the error.
+    """
+    project_id = [project for project in all_projects if project.get('name') == project_name][0].get('id')
+    cache = project_leaders.setdefault(server, {})
+    if project_id in cache:
+        return
+    project_leaders_stats.setdefault(server, {'hits': 0, 'misses': 0})['misses'] += 1
+    l_users, l_groups, errors = _fetch_project_leader(project_id, server, site_id, auth_token, session, groups_index)
+    if len(errors) == 0:
+        cache[project_id] = (l_users, l_groups)
+
+
+def invalidate_project_leaders(server, project_id=None):
+    """
+    Forgets the project leaders stored by get_project_leader, so that they are queried again.
+
+    'server'        specified server address
+    'project_id'    ID of the project to forget (None = every project of the server)
+    """
+    if project_id is None:
+        project_leaders.pop(server, None)
+    else:
+        project_leaders.get(server, {}).pop(project_id, None)
+    return
+
+
+def project_leaders_summary(server):
+    """
+    Returns the log line with the hits and misses of the project leader cache of the server.
+    """
+    stats = project_leaders_stats.get(server, {'hits': 0, 'misses': 0})
+    return '\n\nProject leader cache: {0} hits, {1} misses'.format(stats['hits'], stats['misses'])
 
 
-def get_users_in_group(df_groups, group_id):
+def get_users_in_group(groups_index, group_id):
     """
     Get all the users in the group using group id
  
@@ -565,15 +1423,54 @@ def get_users_in_group(df_groups, group_id):
     users = xml_response.findall('.//t:user', namespaces=xmlns)
     return users
     """
-    df = df_groups[(df_groups[0] == group_id)][[1,2]]
-    df = [{'name' : list(df[1])[i].lower(), 'id' : list(df[2])[i]} for i in range(len(df))]
-    for d in range(len(df)):
-        if 't-' in df[d]['name']:
-            df[d]['name'] = df[d]['name'][4:(len(df[d]['name'])-1)]
-    return df
+    return [dict(member) for member in groups_index.get(group_id, ())]
 
 
-def extract_refresh_delete(username, password, server_config, list_failed_extract, df_groups, log = ''):
+def existing_objects(password, host, table, key, values, columns, array_type='integer'):
+    """
+    Checks which objects still exist in the Tableau repository with one indexed lookup,
+    instead of reading the whole table.
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    'table'         repository table (e.g. 'workbooks')
+    'key'           column the objects are looked up by (e.g. 'id' or 'luid')
+    'values'        values of 'key' to be checked
+    'columns'       columns to be returned, 'key' is always included
+    'array_type'    postgreSQL type of 'key' (e.g. 'integer' or 'uuid')
+    Returns a dictionary {value of 'key': row} with the objects found, each row being a dictionary of 'columns'.
+    """
+    values = list(dict.fromkeys(str(v) if array_type == 'uuid' else v for v in values))
+    if len(values) == 0:
+        return {}
+    columns = [key] + [c for c in columns if c != key]
+    # table and column names come from the code, only the values are sent as parameters
+    query = 'select {0} from {1} where {2} = ANY(%s::{3}[])'.format(', '.join(columns), table, key, array_type)
+    df = postgresql(password, host, query, (values,))
+    return {str(row[key]) if array_type == 'uuid' else row[key]: row for row in df[columns].to_dict('records')}
+
+
+def index_groups(df_groups):
+    """
+    Indexes the group members read from postgreSQL, once per run
+
+    'df_groups'     result of the group_users query (group id, user name, user id)
+    Returns a dictionary group id -> tuple of members {'name', 'id'}, with the user names
+    already lower case and without the 't-' prefix.
+    """
+    members = {}
+    for group_id, name, user_id in zip(df_groups['Groupid'], df_groups['Username'], df_groups['Userid']):
+        if not isinstance(group_id, str) or not isinstance(name, str):
+            continue
+        name = name.lower()
+        if 't-' in name:
+            name = name[4:(len(name)-1)]
+        members.setdefault(group_id, []).append({'name': name, 'id': user_id})
+    return {group_id: tuple(group_members) for group_id, group_members in members.items()}
+
+
+@phase('extract_refresh_delete')
+def extract_refresh_delete(username, password, server_config, list_failed_extract, groups_index, log = ''):
     
     """
     delete extract refresh tasks and output the session log text
@@ -586,6 +1483,8 @@ def extract_refresh_delete(username, password, server_config, list_failed_extrac
     
     setup()
     server = server_config['server']
+    invalidate_project_leaders(server)
+    project_leaders_stats[server] = {'hits': 0, 'misses': 0}
     print("Processing server: {0}".format(server))
     # Create session object for use throughout script
     # Session object also disallows for system-wide environment variables (e.g. http_proxy) that may interfere with connection
@@ -595,8 +1494,7 @@ def extract_refresh_delete(username, password, server_config, list_failed_extrac
     'app':'TABLEAU',
     'password':password,
     'submit':'Login'}
-    session = requests.Session()
-    session.trust_env = False
+    session = new_session()
     if 'escb.eu' in server:
         #the IAM portal sometimes does not respond, so the connection attempt will be executed 5 times until it fails
         iam_auth_counter = 0
@@ -610,25 +1508,46 @@ def extract_refresh_delete(username, password, server_config, list_failed_extrac
     
     ##### STEP 1: Sign in #####
 
-    log = log + "\n\n ---------- {0} server ---------------\nSigning in as {1}".format(server,username)
+    log += "\n\n ---------- {0} server ---------------\nSigning in as {1}".format(server,username)
     try:
         auth_token, site_id, user_id = sign_in(session, server, username, password)
-        log = log + " ---> succeded"
+        log += " ---> succeded"
     except Exception as err:
-        log = log + "\n\nERROR: could not sign in server {0}".format(server)
+        log += "\n\nERROR: could not sign in server {0}".format(server)
         log_file(log)
 
+    try:
+        load_user_names(session, server, auth_token, user_id, site_id)
+    except Exception as err:
+        log += "\n\nWARNING: could not load the users of server {0}, user names will be queried one by one".format(server)
+
     page_size=100 # maximum number of items per page
     page_num=1
 
     try:
-        all_projects = get_all(session, server, auth_token, user_id, site_id, page_size, page_num, 'project')
-        all_workbooks = get_all(session, server, auth_token, user_id, site_id, page_size, page_num, 'workbook')
-        all_datasources = get_all(session, server, auth_token, user_id, site_id, page_size, page_num, 'datasource')
+        inventory = get_inventory(session, server, auth_token, user_id, site_id, page_size, page_num, ('project', 'workbook', 'datasource'), PAGE_WORKERS, server_config.get('snapshot_max_age', 0))
+        all_projects = inventory['project']
+        all_workbooks = inventory['workbook']
+        all_datasources = inventory['datasource']
+        project_index = index_projects(all_projects)
     except Exception as err:
-        log = log + '\n\n ERROR: could not query objects in the server, some problem occurred'
+        log += '\n\n ERROR: could not query objects in the server, some problem occurred'
         log_file(log)
     
+    # owners and Project Leaders are queried concurrently first, the loop below then reads them from the caches
+    owner_ids = set()
+    pivot_projects = set()
+    for lfe in list_failed_extract:
+        objects = all_workbooks if lfe['object'].lower() == 'workbook' else all_datasources
+        try:
+            owner_ids.update(find_owners(objects, lfe['title']))
+            item = [obj for obj in objects if lfe['title'] in obj.get('name')][0]
+            pivot_projects.add(find_top_project(project_index, item.find('.//t:project', namespaces=xmlns).get('id')).get('name'))
+        except Exception as err:
+            continue
+    run_calls([(user_id2name, (session, server, auth_token, site_id, oi)) for oi in owner_ids] +
+              [(_prefetch_project_leader, (pp, all_projects, server, site_id, auth_token, session, groups_index)) for pp in pivot_projects])
+
     for lfe in list_failed_extract:
         if lfe['object'].lower() == 'workbook':
             try:
@@ -638,7 +1557,7 @@ def extract_refresh_delete(username, password, server_config, list_failed_extrac
                 for oi in owners_id:
                     owners_names.append(user_id2name(session, server, auth_token, site_id, oi))
             except Exception as err:
-                log = log + '\n\nERROR: problem in searching for owners for workbook {0}'.format(lfe['title'])
+                log += '\n\nERROR: problem in searching for owners for workbook {0}'.format(lfe['title'])
                 log_file(log)
         elif lfe['object'].lower() == 'datasource':
             try:
@@ -648,40 +1567,39 @@ def extract_refresh_delete(username, password, server_config, list_failed_extrac
                 for oi in owners_id:
                     owners_names.append(user_id2name(session, server, auth_token, site_id, oi))
             except Exception as err:
-                log = log + '\n\nERROR: problem in searching for owners for datasource {0}'.format(lfe['title'])
+                log += '\n\nERROR: problem in searching for owners for datasource {0}'.format(lfe['title'])
                 log_file(log)
 
-        log = log + '\n\nFollowing owners found for {0} {1}: {2}'.format(lfe['object'].lower(), lfe['title'], ', '.join(owners_names))
+        log += '\n\nFollowing owners found for {0} {1}: {2}'.format(lfe['object'].lower(), lfe['title'], ', '.join(owners_names))
         
         try:
-            pivot_pro = [pr for pr in all_projects if item.find('.//t:project', namespaces=xmlns).get('id') == pr.get('id')]
-            while pivot_pro[0].get('parentProjectId') != None:
-                pivot_pro = [pr for pr in all_projects if pr.get('id') == pivot_pro[0].get('parentProjectId')]
-            pivot_pro = pivot_pro[0].get('name')
+            pivot_pro = find_top_project(project_index, item.find('.//t:project', namespaces=xmlns).get('id')).get('name')
         except Exception as err:
-            log = log + '\n\nERROR: could not find main project for {0} {1}'.format(lfe['object'].lower(), lfe['title'])
+            log += '\n\nERROR: could not find main project for {0} {1}'.format(lfe['object'].lower(), lfe['title'])
             log_file(log)
 
-        log = log + '\nsearching Project Leaders in main project {0}'.format(pivot_pro)
+        log += '\nsearching Project Leaders in main project {0}'.format(pivot_pro)
 
         try:
-            l_users, l_groups = get_project_leader(pivot_pro, all_projects, server, site_id, auth_token, session, df_groups, log)
+            l_users, l_groups = get_project_leader(pivot_pro, all_projects, server, site_id, auth_token, session, groups_index, log)
         except Exception as err:
-            log = log + '\n\nERROR: could not find PLs in project {0}'.format(pivot_pro)
+            log += '\n\nERROR: could not find PLs in project {0}'.format(pivot_pro)
             log_file(log)
         
-        log = log + '\nFollowing PLs found for project {0}: {1}\n------ Creating email for {2} {3}'.format(pivot_pro, ', '.join([lu['name'] for lu in l_users]),lfe['object'].lower(), lfe['title'])
+        log += '\nFollowing PLs found for project {0}: {1}\n------ Creating email for {2} {3}'.format(pivot_pro, ', '.join([lu['name'] for lu in l_users]),lfe['object'].lower(), lfe['title'])
         
         try:
             print(owners_names,[lu['name'] for lu in l_users])
-            extract_refresh_email(owners_names, [lu['name'] for lu in l_users], server, lfe)
+            extract_refresh_email(owners_names, [lu['name'] for lu in l_users], server, lfe, server_config['info'])
         except Exception as err:
-            log = log + '\n\nERROR: could prepare the email for failed extract refresh {0}'.format(lfe['title'])
+            log += '\n\nERROR: could prepare the email for failed extract refresh {0}'.format(lfe['title'])
             log_file(log)
     ##### STEP 2: delete failed extract refresh #####
     
     #log = delete_extract_refresh(session, server, auth_token, site_id, list_failed_extract, all_projects, all_workbooks, all_datasources, sched_df, log)
     #log = delete_extract_refresh(session, server, auth_token, site_id, list_failed_extract, log)
+    log += project_leaders_summary(server)
+
     ##### STEP 3: Sign out #####
         
     print("\n7. Signing out and invalidating the authentication token")
@@ -690,53 +1608,152 @@ def extract_refresh_delete(username, password, server_config, list_failed_extrac
     
     return log
 
-def extract_refresh_email(emails, CCs, server, extract_refresh_failed):
-    
+def _recipient(name):
+    """
+    Returns the email recipient of a Tableau user name (without the t- or eu prefix).
+    """
+    name = name.lower()
+    if 't-' in name:
+        return name[4:]
+    elif name[0:2] == 'eu' and len(name) > 8:
+        return name[2:]
+    return name
+
+
+def queue_digest(recipients, finding, leaders=()):
+    """
+    Adds a finding to the digest of every recipient, all the digests are emailed at once by send_digests.
+
+    'recipients'    Tableau user names of the people to inform (owners, subscribers...)
+    'finding'       dictionary describing the finding, its 'server' key groups the findings in the email
+    'leaders'       Tableau user names of the project leaders informed as such (not already in 'recipients')
+    Every recipient receives a copy of the finding with its 'role': 'owner' or 'leader'.
+    """
+    owners = set(_recipient(r) for r in recipients)
+    with digests_lock:
+        for recipient in sorted(owners):
+            digests.setdefault(recipient, []).append(dict(finding, role='owner'))
+        for recipient in sorted(set(_recipient(r) for r in leaders) - owners):
+            digests.setdefault(recipient, []).append(dict(finding, role='leader'))
+    return
+
+
+@phase('send_digests')
+def send_digests():
+    """
+    Creates one Outlook email per recipient listing every finding queued for them (over all the servers
+    of the run), instead of one email per object. The digests are emptied.
+    Returns the log text of the emails created.
+    """
+    with digests_lock:
+        pending = dict(digests)
+        digests.clear()
+    text = "\n\n-------- Emails (one per recipient) ---------"
+    if not pending:
+        return text + "\nNo email to prepare."
     outlook = client.Dispatch("Outlook.Application")
-    message  = outlook.CreateItem(0)
-    
-    for i in range(len(emails)):
-        if 't-' in emails[i].lower():
-            emails[i] = emails[i].lower()[4:len(emails[i])]
-        elif emails[i].lower()[0:2] == 'eu' and len(emails[i]) > 8:
-            emails[i] = emails[i].lower()[2:len(emails[i])]
-        else:
-            emails[i] = emails[i].lower()
-    
-    for ii in range(len(CCs)):
-        if 't-' in CCs[ii].lower():
-            CCs[ii] = CCs[ii].lower()[4:len(CCs[ii])]
-        elif CCs[ii].lower()[0:2] == 'eu' and len(CCs[ii]) > 8:
-            CCs[ii] = CCs[ii].lower()[2:len(CCs[ii])]
-        else:
-            CCs[ii] = CCs[ii].lower()
-    CCs = list(set(CCs).difference(emails)) 
+    for recipient, findings in sorted(pending.items()):
+        try:
+            message = outlook.CreateItem(0)
+            message.To = recipient
+            message.BCC = ""
+            message.Subject = "FOR YOUR INFORMATION : Refresh extracts failed on Tableau Server"
+            message.HTMLBody = _digest_body(findings)
+            message.Display()
+            text += "\n- {0}: {1} item(s)".format(recipient, len(findings))
+        except Exception as err:
+            text += "\n\n WARNING: problem in creating the email for {0}! create manually! \n".format(recipient)
+    return text
 
-    message.To = '; '.join(list(set(emails)))
-    message.CC = '; '.join(list(set(CCs)))
-    message.BCC = ""
-    message.Subject = "FOR YOUR INFORMATION : Refresh extracts failed on Tableau Server"
-    
+
+def _by_server(findings):
+    """
+    Returns the findings grouped by server, in the order they were found.
+    """
+    servers = {}
+    for finding in findings:
+        servers.setdefault(finding['server'], []).append(finding)
+    return servers.items()
+
+
+def _server_label(server, info=''):
+    """
+    Returns the name of the server shown in the emails: its 'info' in server_dict, else the name
+    of the ECB/ESCB server at this address, else the address.
+    """
+    if info:
+        return 'Tableau Server {0}'.format(info)
+    labels = {'https://a-tableau.ecb.de': 'Tableau ECB Acceptance Server',
+              'https://a-tableau.escb.eu': 'Tableau ESCB Acceptance Server',
+              'https://tableau.ecb.de': 'Tableau ECB Production Server',
+              'https://tableau.escb.eu': 'Tableau ESCB Production Server'}
+    return labels.get(server.rstrip('/'), 'Tableau Server {0}'.format(server.rstrip('/')))
+
+
+def extract_refresh_email(emails, CCs, server, extract_refresh_failed, info=''):
+    """
+    Queues a failed extract refresh for the email of its owners and project leaders (see send_digests).
+
+    'emails'                   user names of the owners of the workbook/datasource
+    'CCs'                      user names of the project leaders
+    'server'                   specified server address
+    'extract_refresh_failed'   failed extract ('object', 'id', 'title')
+    'info'                     name of the server in server_dict, shown in the email
+    """
+    queue_digest(emails, {'server': server, 'info': info,
+                          'object': extract_refresh_failed['object'].lower(),
+                          'id': extract_refresh_failed['id'],
+                          'title': extract_refresh_failed['title']}, leaders=CCs)
+    return
+
+
+def _digest_items(findings):
+    """
+    Returns the HTML list of failed extracts of a digest, grouped by server.
+    """
+    Body = ''
+    for server, extracts in _by_server(findings):
+        Body = Body + """
+{0} <a href='{1}'>{2}</a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', server, _server_label(server, extracts[0].get('info', '')))
+        for extract in extracts:
+            Body = Body + """
+{0}{0}<a href='{1}/#/{2}s/{3}'>{4}</a> <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', server, extract['object'], extract['id'], extract['title'])
+    return Body
+
+
+def _digest_body(findings):
+    """
+    Returns the HTML body of the email of one person, listing the failed extracts they own and,
+    apart, the failed extracts of the projects they lead.
+    """
+    owned = [finding for finding in findings if finding['role'] == 'owner']
+    led = [finding for finding in findings if finding['role'] == 'leader']
     Body = """
 &nbsp_____________________________________________________________________________________________<br>
-{0}{0}{0}{0}{0}{0} <img src="{5}" alt=Move workbook back to project><br>
+{0}{0}{0}{0}{0}{0} <img src="{1}" alt=Move workbook back to project><br>
 &nbsp_____________________________________________________________________________________________<br>
 <br>
 {0} Dear Colleague(s),<br>
-<br>
+<br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', os.getcwd()+"\\Tableau.jpg")
+    if owned:
+        Body = Body + """
 {0} We have seen that below extract(s) is/are scheduled scheduled to be refreshed daily, but failed lately. <br>
-<br>
-{0}<a href='{1}/#/{2}s/{3}'>{4}</a> <br>
+<br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp') + _digest_items(owned) + """
 <br>
 {0} Since the refresh of an extract is a very heavy process for Tableau and the refresh stopped working, <br>
 <br>
 {0} please be informed that your extract(s) is/are  unscheduled automatically. <br>
 <br>
 {0} As usual, you can reschedule them again once the issues are solved. <br>
-<br>
+<br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
+    if led:
+        Body = Body + """
+{0} As Project Leader, please be informed that the refresh of below extract(s) of your project(s) failed lately. <br>
+{0} The extract(s) is/are unscheduled automatically and their owners have been informed: <br>
+<br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp') + _digest_items(led) + """
+<br>"""
+    Body = Body + """
 {0} Best regards, <br>
-{0} Tableau Support team <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', server, extract_refresh_failed['object'].lower(), extract_refresh_failed['id'],extract_refresh_failed['title'],os.getcwd()+"\\Tableau.jpg")
-
-    message.HTMLBody = Body
-    message.Display()
+{0} Tableau Support team <br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
+    return Body
 
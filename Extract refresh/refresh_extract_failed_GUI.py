@@ -12,11 +12,82 @@ from functools import partial
 import refresh_extract_failed as ref
 from datetime import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+server_dict = {'server1': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server2': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server3': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server4': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12}}
+
+def process_server(x, username, password, readonly_pw, run_log):
+    """
+    Processes one server, in its own worker thread (see validateLogin).
+
+    'x'             index of the server (0 for server1 ... 3 for server4)
+    'username'      admin username of the server
+    'password'      admin password of the server
+    'readonly_pw'   password of the postgreSQL readonly user
+    'run_log'       log of the run, the server is logged in a child of it
+    Returns the log of the server.
+    """
+    server = server_dict['server{0}'.format(x + 1)]
+    # the repository is queried before the process itself calls setup(): the connection pool size is set there
+    ref.setup()
+    log = run_log.child(server['server'])
+    failed_list = []
+    try:
+        log += '\n\n#############{0}###############\n\n-----------connecting to postgreSQL (host {1})-----------'.format(server['info'],server['postgreSQL'])
+        try:
+            if args.history or args.incremental:
+                # items whose refresh has been failing for 5 days or more, from the history of the background tasks
+                streaks = {}
+                for data in ref.five_days_errors(readonly_pw, server['postgreSQL'], 4, args.incremental):
+                    last = data.iloc[-1]
+                    streaks[(last['items'].strip().lower(), int(last['items_id']))] = int(last['cum_delta'])
+                failing_ids = {obj: [obj_id for obj_type, obj_id in streaks if obj_type == obj] for obj in ('workbook', 'datasource')}
+                failed_list_final = ref.postgresql(readonly_pw, server['postgreSQL'],"select t.id, t.obj_type, t.obj_id, t.luid, w.name as obj_name from tasks t inner join workbooks w on t.obj_id = w.id where t.type IN ('IncrementExtractTask','RefreshExtractTask') and t.obj_type = 'Workbook' and t.obj_id = ANY(%s::integer[]) UNION select t.id, t.obj_type, t.obj_id, t.luid, d.name as obj_name from tasks t inner join datasources d on t.obj_id = d.id where t.type IN ('IncrementExtractTask','RefreshExtractTask') and t.obj_type = 'Datasource' and t.obj_id = ANY(%s::integer[]);", (failing_ids['workbook'], failing_ids['datasource']))
+            else:
+                streaks = {}
+                failed_list_final = ref.postgresql(readonly_pw, server['postgreSQL'],"select t.id, t.obj_type, t.obj_id, t.luid, w.name as obj_name from tasks t inner join workbooks w on t.obj_id = w.id where t.type IN ('IncrementExtractTask','RefreshExtractTask')  and t.consecutive_failure_count > 4 and t.obj_type = 'Workbook' UNION select t.id, t.obj_type, t.obj_id, t.luid, d.name as obj_name from tasks t inner join datasources d on t.obj_id = d.id where t.type IN ('IncrementExtractTask','RefreshExtractTask') and t.consecutive_failure_count > 4 and t.obj_type = 'Datasource';")
+            failed_list_pre = []
+            if len(failed_list_final) == 0:
+                log += '\n\nNo extract refresh task failed for 5 days or more'
+                failed_list = []
+            else:
+                for task in failed_list_final.to_dict('records'):
+                    info = {'object':task['obj_type'], 'title':task['obj_name'], 'id':task['obj_id'], 'task_id':task['luid'],
+                            'streak_days':streaks.get((task['obj_type'].lower(), int(task['obj_id'])))}
+                    failed_list_pre.append(info)
+
+                workbooks = ref.existing_objects(readonly_pw, server['postgreSQL'], 'workbooks', 'id', [fl['id'] for fl in failed_list_pre if fl['object'].lower() == 'workbook'], ['id'])
+                datasources = ref.existing_objects(readonly_pw, server['postgreSQL'], 'datasources', 'id', [fl['id'] for fl in failed_list_pre if fl['object'].lower() == 'datasource'], ['id', 'repository_url'])
+                failed_list = []
+
+                for fl in failed_list_pre:
+                    fl['check_id'] = fl['id']
+                    if fl['object'].lower() == 'workbook':
+                        found = fl['id'] in workbooks
+                    elif fl['object'].lower() == 'datasource':
+                        found = fl['id'] in datasources
+                        if found and 'embedded' not in datasources[fl['id']]['repository_url']:
+                            fl['id'] = datasources[fl['id']]['repository_url']
+                    if found:
+                        failed_list.append(fl)
+                groups_index = ref.index_groups(ref.postgresql(readonly_pw, server['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id'))
+            
+        except Exception as err:
+            log += '\n\nERROR: could not connect to {0}'.format(server['info'])
+            ref.log_file(log)
+
+        if len(failed_list) != 0:
+            log += '\n\nExtract refresh task is failing for the following objects for 5 consecutive days or more:\n{}'.format('\n'.join(['- ' + fl['title'] + ' (' + fl['object'] + ('' if fl['streak_days'] is None else ', ' + str(fl['streak_days']) + ' days') + ')' for fl in failed_list]))
+            print(failed_list)
+            log = ref.extract_refresh_delete(username, password, server, failed_list, groups_index, log)
+        return log
+    except Exception as err:
+        log += '\n\nERROR: the process stopped for {0}: {1}'.format(server['info'], err)
+        return log
 
-server_dict = {'server1': {'server':'', 'postgreSQL' : '','info':''},
-                'server2': {'server':'', 'postgreSQL' : '','info':''},
-                'server3': {'server':'', 'postgreSQL' : '','info':''},
-                'server4': {'server':'', 'postgreSQL' : '','info':''}}
 
 def validateLogin(ECBA_username, 
                   ESCBA_username, 
@@ -74,7 +145,8 @@ def validateLogin(ECBA_username,
     Tab_pw = [ECBA_pw, ESCBA_pw, ECBP_pw, ESCBP_pw]
     readonly_passwords = [read_ECBA_pw, read_ESCBA_pw, read_ECBP_pw, read_ESCBP_pw]
     
-    log = """
+    log = ref.RunLog()
+    log += """
 ##################################
 # Failed Extract Regresh process #
 ##################################
@@ -83,66 +155,21 @@ Server selected: {0}""".format(', '.join(args.servers))
     
     tkWindow.destroy()
 
-    for x in range(len(Tab_users)):
-        if Tab_users[x] != None:
-            
-            if x == 0:
-                server = server_dict['server1']
-                readonly_pw = readonly_passwords[0]
-            elif x == 1:
-                server = server_dict['server2']  
-                readonly_pw = readonly_passwords[1]
-            elif x == 2:
-                server = server_dict['server3']
-                readonly_pw = readonly_passwords[2]
-            else:
-                server = server_dict['server4']
-                readonly_pw = readonly_passwords[3]
-            
-            log = log + '\n\n#############{0}###############\n\n-----------connecting to postgreSQL (host {1})-----------'.format(server['info'],server['postgreSQL'])
-            try:
-                failed_list_final = ref.postgresql(readonly_pw, server['postgreSQL'],"select t.*, w.name  from tasks t inner join workbooks w on t.obj_id = w.id where t.type IN ('IncrementExtractTask','RefreshExtractTask')  and t.consecutive_failure_count > 4 and t.obj_type = 'Workbook' UNION select t.*, d.name  from tasks t inner join datasources d on t.obj_id = d.id where t.type IN ('IncrementExtractTask','RefreshExtractTask') and t.consecutive_failure_count > 4 and t.obj_type = 'Datasource';")
-                failed_list_pre = []
-                if list(failed_list_final[0])[0] == None and len(failed_list_final) == 1:
-                    log = log + '\n\nNo extract refresh task failed for 5 days or more'
-                    failed_list = []
-                else:
-                    for i in range(len(failed_list_final)):
-                        info = {'object':failed_list_final.iloc[i][8], 'title':failed_list_final.iloc[i][21], 'id':failed_list_final.iloc[i][4], 'task_id':failed_list_final.iloc[i][9]}
-                        failed_list_pre.append(info)
-
-                    workbooks = ref.postgresql(readonly_pw, server['postgreSQL'],'select * from workbooks')
-                    datasources =  ref.postgresql(readonly_pw, server['postgreSQL'],'select * from datasources')
-                    failed_list = []
-
-                    for fl in failed_list_pre:
-                        fl['check_id'] = fl['id']
-                        if fl['object'].lower() == 'workbook':
-                            index = [i for i in range(len(list(workbooks[1]))) if fl['id'] == list(workbooks[0])[i]]
-                        elif fl['object'].lower() == 'datasource':
-                            index = [i for i in range(len(list(datasources[1]))) if fl['id'] == list(datasources[0])[i]]
-                            check = datasources[(datasources[1] == fl['title'])].iloc[0]
-                            if 'embedded' not in check[2]:
-                                fl['id'] = check[2]
-                        if len(index) == 1:
-                            failed_list.append(fl)
-                    df_groups = ref.postgresql(readonly_pw, server['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id')
-            
-            except Exception as err:
-                log = log + '\n\nERROR: could not connect to {0}'.format(server['info'])
-                ref.log_file(log)
-
-            if len(failed_list) != 0:
-                log = log + '\n\nExtract refresh task is failing for the following objects for 5 consecutive days or more:\n{}'.format('\n'.join(['- ' + fl['title'] + ' (' + fl['object'] + ')' for fl in failed_list]))
-                print(failed_list)
-                log = ref.extract_refresh_delete(Tab_users[x], Tab_pw[x], server, failed_list, df_groups, log)
-
+    selected = [x for x in range(len(Tab_users)) if Tab_users[x] != None]
+    #Every selected server is processed in its own worker, the logs are merged in the order of the servers
+    with ThreadPoolExecutor(max_workers=max(len(selected), 1)) as executor:
+        results = list(executor.map(lambda x: process_server(x, Tab_users[x], Tab_pw[x], readonly_passwords[x], log), selected))
+    for server_log in results:
+        log += server_log
 
-    log = log + '\n\nEXTRACT REFRESH PROCESS COMPLETE!'
-    logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-    file = open(logfile_name, "w") 
-    file.write(log)
-    file.close()
+    #Every person receives one email listing their findings on all the selected servers
+    log += ref.send_digests()
+    log += ref.metrics_summary()
+    log += ref.connection_pools_summary()
+    log += '\n\nMetrics written to {0}'.format(ref.write_metrics(log.path.replace('run_', 'metrics_')[:-len('.jsonl')] + '.json'))
+    ref.close_connection_pools()
+    log += '\n\nEXTRACT REFRESH PROCESS COMPLETE!'
+    logfile_name = log.render()
     os.system(logfile_name.replace('/', '\\'))
     return 
 
@@ -156,6 +183,10 @@ if __name__ == "__main__":
             The process identify the extract refresh tasks that failed for 5 consecutive days and uschedule them.')
     parser.add_argument('servers', metavar='server', type=str, nargs='+', choices=['ecbprod', 'ecbacc', 'iamprod', 'iamacc', 'none'], default='none',
                     help="Server(s) in scope. Please choose from 'ecbprod', 'ecbacc', 'iamprod', 'iamacc', separated by spaces.")
+    parser.add_argument('--history', action='store_true',
+                    help="Select the failing extracts from the history of the background tasks (failure streaks in days) instead of the consecutive failure count of the tasks.")
+    parser.add_argument('--incremental', action='store_true',
+                    help="Same as --history, only reading the background tasks recorded since the last incremental run: the failure streaks are resumed from the watermark of each repository.")
     args = parser.parse_args()
     
     if args.servers == 'none':
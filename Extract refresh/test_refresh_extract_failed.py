@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the reading of the extract refresh history (five_days_errors) and of the background jobs (query_jobs).
+
+to launch: -> python -m unittest test_refresh_extract_failed (from the Extract refresh folder)
+"""
+
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+try:
+    import win32com.client
+except ImportError:
+    # Outlook is only driven on Windows, these tests do not prepare any email
+    sys.modules['win32com'] = types.ModuleType('win32com')
+    sys.modules['win32com.client'] = sys.modules['win32com'].client = types.ModuleType('win32com.client')
+
+import refresh_extract_failed as ref
+
+#Items of the history: (type, id, first failing day), None = never failing.
+#Workbook 1 and Datasource 1 share their id, as workbooks and datasources do in the repository.
+ITEMS = [('Workbook', 1, 1), ('Datasource', 1, None), ('Workbook', 2, 9)]
+
+
+def background_tasks(days, first_id=1):
+    """
+    Returns one refresh of every item of ITEMS per day of 'days', as rows of _background_tasks.
+    """
+    rows = []
+    for day in days:
+        for obj_type, obj_id, failing_from in ITEMS:
+            completed_at = datetime(2024, 1, 1, 6, 0, 0) + timedelta(days=day - 1)
+            failed = failing_from is not None and day >= failing_from
+            rows.append({'id': first_id + len(rows), 'args': '---\n- {0}\n- {1}\n- {0} {1}'.format(obj_type, obj_id),
+                         'title': '{0} {1}'.format(obj_type, obj_id), 'created_at': completed_at - timedelta(minutes=5),
+                         'started_at': completed_at - timedelta(minutes=4), 'completed_at': completed_at,
+                         'job_type': 'RefreshExtracts', 'job_name': 'Refresh Extracts',
+                         'notes': 'failed' if failed else None, 'finish_code': 1 if failed else 0})
+    return rows
+
+
+class Repository:
+    """
+    Stand-in of postgresql for _background_tasks: applies the filter of the incremental query
+    (id > last_id or id in pending) and records the number of rows returned by every query.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.read = []
+
+    def __call__(self, password, host, query, params=None):
+        df = pd.DataFrame(self.rows)
+        if params is not None:
+            last_id, pending = params
+            df = df[(df['id'] > last_id) | df['id'].isin(pending)]
+        self.read.append(len(df))
+        df = df.reset_index(drop=True)
+        df['Server'] = host
+        return df
+
+
+def streaks(five_days_error):
+    """
+    Returns the length of the current failure streak of every item returned by five_days_errors.
+    """
+    return {(data['items'].iloc[-1].strip(), int(data['items_id'].iloc[-1])): int(data['cum_delta'].iloc[-1]) for data in five_days_error}
+
+
+class FailureStreaksTest(unittest.TestCase):
+
+    def test_only_success_ends_streak(self):
+        # failed, failed, cancelled, failed, still running: a streak of 4 days
+        tasks = pd.DataFrame(background_tasks(range(1, 6)))
+        tasks = tasks[tasks['title'] == 'Workbook 1'].reset_index(drop=True)
+        tasks['items'], tasks['items_id'] = 'Workbook', '1'
+        tasks.loc[2, 'finish_code'] = 2
+        tasks.loc[4, ['completed_at', 'finish_code']] = None, None
+        df = ref.failure_streaks(tasks)
+
+        self.assertEqual(list(df['cum_delta']), [1, 2, 3, 4])
+        self.assertEqual(list(df['runs']), [1, 2, 3, 4])
+
+    def test_success_resets_streak(self):
+        tasks = pd.DataFrame(background_tasks(range(1, 5)))
+        tasks = tasks[tasks['title'] == 'Workbook 1'].reset_index(drop=True)
+        tasks['items'], tasks['items_id'] = 'Workbook', '1'
+        tasks.loc[1, 'finish_code'] = 0
+        df = ref.failure_streaks(tasks)
+
+        self.assertEqual(list(df['cum_delta']), [1, 0, 1, 2])
+
+
+class IncrementalHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        ref.setup()
+        self.postgresql = ref.postgresql
+        self.watermark_dir = ref.WATERMARK_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ref.postgresql = self.postgresql
+        shutil.rmtree(self.watermark_dir, ignore_errors=True)
+
+    def test_second_run_reads_only_new_tasks(self):
+        first_days = background_tasks(range(1, 11))
+        new_days = background_tasks(range(11, 15), first_id=len(first_days) + 1)
+        ref.postgresql = repository = Repository(first_days)
+        ref.five_days_errors('readonly', 'repository', 4, incremental=True)
+        repository.rows = first_days + new_days
+        second = ref.five_days_errors('readonly', 'repository', 4, incremental=True)
+
+        self.assertEqual(repository.read, [len(first_days), len(new_days)])
+        # the streaks resumed from the watermark are the ones of a full read of the history
+        ref.postgresql = Repository(first_days + new_days)
+        self.assertEqual(streaks(second), streaks(ref.five_days_errors('readonly', 'repository', 4)))
+        self.assertEqual(streaks(second), {('Workbook', 1): 14, ('Workbook', 2): 6})
+
+    def test_running_task_is_read_again(self):
+        rows = background_tasks(range(1, 6))
+        rows[-1]['completed_at'] = None
+        ref.postgresql = repository = Repository(rows)
+        ref.five_days_errors('readonly', 'repository', 4, incremental=True)
+        rows[-1]['completed_at'] = rows[-2]['completed_at']
+        ref.five_days_errors('readonly', 'repository', 4, incremental=True)
+
+        self.assertEqual(repository.read, [len(rows), 1])
+
+    def test_full_and_incremental_agree_on_running_task(self):
+        rows = background_tasks(range(1, 11))
+        running = dict(background_tasks([11], first_id=len(rows) + 1)[0], completed_at=None, finish_code=None, notes=None)
+        ref.postgresql = Repository(rows + [running])
+        full = ref.five_days_errors('readonly', 'repository', 4)
+        incremental = ref.five_days_errors('readonly', 'repository', 4, incremental=True)
+
+        self.assertEqual(streaks(full), {('Workbook', 1): 10})
+        self.assertEqual(streaks(incremental), streaks(full))
+
+
+class JobsSession:
+    """
+    Stand-in of the session of a server for the /jobs listing: serves 'total' failed refresh jobs
+    in pages of the requested size and records the url of every request.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.urls = []
+
+    def get(self, url, headers=None, verify=None):
+        self.urls.append(url)
+        query = parse_qs(urlsplit(url).query)
+        page_size, page_num = int(query['pageSize'][0]), int(query['pageNumber'][0])
+        jobs = ''.join(['<backgroundJob id="job-{0}" status="Failed" createdAt="2024-01-0{1}T06:00:00Z" startedAt="2024-01-0{1}T06:01:00Z" '
+                        'endedAt="2024-01-0{1}T06:02:00Z" priority="50" jobType="refresh_extracts"/>'.format(job, 1 + job % 9)
+                        for job in range((page_num - 1) * page_size, min(page_num * page_size, self.total))])
+        content = ('<?xml version="1.0" encoding="UTF-8"?><tsResponse xmlns="http://tableau.com/api">'
+                   '<pagination pageNumber="{0}" pageSize="{1}" totalAvailable="{2}"/><backgroundJobs>{3}</backgroundJobs></tsResponse>').format(page_num, page_size, self.total, jobs)
+        return types.SimpleNamespace(status_code=200, content=content.encode('utf-8'), text=content, headers={})
+
+
+class JobsReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        ref.setup()
+        ref.RESPONSE_FORMAT = 'xml'
+
+    def test_pages_and_server_filter(self):
+        session = JobsSession(250)
+        jobs = ref.query_jobs(session, 'https://tableau', 'token', 'site', 100, 1, job_type=['refresh_extracts', 'increment_extracts'],
+                              status='Failed', created_after=datetime(2024, 1, 1), created_before=datetime(2024, 1, 10, 12, 30))
+
+        self.assertEqual(len(session.urls), 3)
+        for page_num, url in enumerate(session.urls, 1):
+            query = parse_qs(urlsplit(url).query)
+            self.assertEqual(urlsplit(url).path, '/api/{0}/sites/site/jobs'.format(ref.VERSION))
+            self.assertEqual(query['filter'], ['jobType:in:[refresh_extracts,increment_extracts],status:eq:Failed,'
+                                               'createdAt:gte:2024-01-01T00:00:00Z,createdAt:lte:2024-01-10T12:30:00Z'])
+            self.assertEqual((query['pageSize'], query['pageNumber']), (['100'], [str(page_num)]))
+        self.assertEqual(len(jobs), 250)
+        self.assertEqual(list(jobs['id'][:2]), ['job-0', 'job-1'])
+        self.assertEqual(list(jobs.columns), ['id', 'status', 'createdAt', 'startedAt', 'endedAt', 'type'])
+        self.assertTrue(isinstance(jobs['createdAt'].dtype, pd.DatetimeTZDtype) and str(jobs['createdAt'].dt.tz) == 'UTC')
+        self.assertEqual(str(jobs['status'].dtype), 'category')
+        self.assertEqual(str(jobs['type'].dtype), 'category')
+
+    def test_no_filter(self):
+        session = JobsSession(0)
+        jobs = ref.query_jobs(session, 'https://tableau', 'token', 'site', 100, 1)
+
+        self.assertEqual(session.urls, ['https://tableau/api/{0}/sites/site/jobs?pageSize=100&pageNumber=1'.format(ref.VERSION)])
+        self.assertEqual(len(jobs), 0)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        ref.setup()
+        self.snapshot_dir = ref.SNAPSHOT_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+    def test_snapshot_per_site_and_user(self):
+        workbooks = [ref.ET.Element('{http://tableau.com/api}workbook', id='wb-1', name='Sales')]
+        ref.save_snapshot('https://tableau', 'site-1', 'user-1', 'workbook', workbooks)
+
+        self.assertEqual([wb.get('id') for wb in ref.load_snapshot('https://tableau', 'site-1', 'user-1', 'workbook', 1)], ['wb-1'])
+        self.assertIsNone(ref.load_snapshot('https://tableau', 'site-2', 'user-1', 'workbook', 1))
+        self.assertIsNone(ref.load_snapshot('https://tableau', 'site-1', 'user-2', 'workbook', 1))
+        self.assertIsNone(ref.load_snapshot('https://other', 'site-1', 'user-1', 'workbook', 1))
+
+
+class CheckStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        ref.setup()
+
+    def tearDown(self):
+        ref.setup()
+
+    def response(self, status_code, text):
+        def json():
+            raise ValueError('not JSON')
+        return types.SimpleNamespace(status_code=status_code, text=text, json=json)
+
+    def test_html_error_page(self):
+        # a page that is not XML, and one that is: neither is an error of the REST API
+        for text in ('<html><body>Bad gateway<br></body></html>', '<html><body>Bad gateway</body></html>'):
+            for response_format in ('xml', 'json'):
+                ref.RESPONSE_FORMAT = response_format
+                with self.assertRaisesRegex(ref.ApiCallError, '^HTTP 502: <html><body>Bad gateway'):
+                    ref._check_status(self.response(502, text), 200)
+
+    def test_rest_api_error(self):
+        ref.RESPONSE_FORMAT = 'xml'
+        text = ('<tsResponse xmlns="http://tableau.com/api"><error code="401002"><summary>Unauthorized Access</summary>'
+                '<detail>Invalid authentication credentials were provided.</detail></error></tsResponse>')
+        with self.assertRaisesRegex(ref.ApiCallError, '^401002: Unauthorized Access - Invalid authentication'):
+            ref._check_status(self.response(401, text), 200)
+
+
+class PermissionsSession:
+    """
+    Stand-in of the session of a server for the permissions of a project: one user is Project Leader.
+    """
+    def get(self, url, data=None, headers=None, verify=None):
+        content = ('<tsResponse xmlns="http://tableau.com/api"><permissions><granteeCapabilities><user id="leader-1"/>'
+                   '<capabilities><capability name="ProjectLeader" mode="Allow"/></capabilities></granteeCapabilities></permissions></tsResponse>')
+        return types.SimpleNamespace(status_code=200, content=content.encode('utf-8'), text=content, headers={})
+
+
+class ProjectLeaderPrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        ref.setup()
+        ref.RESPONSE_FORMAT = 'xml'
+        ref.project_leaders.clear()
+        self.user_id2name, self.log_file = ref.user_id2name, ref.log_file
+        self.logged = []
+        ref.log_file = self.logged.append
+        self.projects = [{'name': 'Finance', 'id': 'project-1'}]
+
+    def tearDown(self):
+        ref.user_id2name, ref.log_file = self.user_id2name, self.log_file
+        ref.project_leaders.clear()
+
+    def test_prefetch_fills_cache(self):
+        ref.user_id2name = lambda session, server, auth_token, site_id, user_id: 'leader'
+        ref.run_calls([(ref._prefetch_project_leader, ('Finance', self.projects, 'server', 'site', 'token', PermissionsSession(), {}))])
+
+        self.assertEqual(ref.project_leaders['server'], {'project-1': ([{'name': 'leader', 'id': 'leader-1'}], [])})
+
+    def test_prefetch_error_is_logged_by_caller(self):
+        def user_id2name(session, server, auth_token, site_id, user_id):
+            raise ref.ApiCallError('403004: Forbidden')
+        ref.user_id2name = user_id2name
+        ref.run_calls([(ref._prefetch_project_leader, ('Finance', self.projects, 'server', 'site', 'token', PermissionsSession(), {}))])
+
+        self.assertEqual((self.logged, ref.project_leaders['server']), ([], {}))
+        ref.get_project_leader('Finance', self.projects, 'server', 'site', 'token', PermissionsSession(), {}, '')
+        self.assertEqual(len(self.logged), 1)
+        self.assertIn("not authorized to query user 'leader-1'", self.logged[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
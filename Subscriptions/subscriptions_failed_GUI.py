@@ -12,11 +12,86 @@ from functools import partial
 import subscriptions_failed as sf
 from datetime import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+server_dict = {'server1': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server2': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server3': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12},
+                'server4': {'server':'', 'postgreSQL' : '','info':'', 'snapshot_max_age': 12}}
+
+def process_server(x, username, password, readonly_pw, run_log):
+    """
+    Processes one server, in its own worker thread (see validateLogin).
+
+    'x'             index of the server (0 for server1 ... 3 for server4)
+    'username'      admin username of the server
+    'password'      admin password of the server
+    'readonly_pw'   password of the postgreSQL readonly user
+    'run_log'       log of the run, the server is logged in a child of it
+    Returns the log of the server.
+    """
+    server = server_dict['server{0}'.format(x + 1)]
+    # the repository is queried before the process itself calls setup(): the connection pool size is set there
+    sf.setup()
+    log = run_log.child(server['server'])
+    failed_list = []
+    try:
+        log += '\n\n#############{0}###############\n\n-----------connecting to postgreSQL (host {1})-----------'.format(server['info'],server['postgreSQL'])
+        try:
+            if x == 0 or x == 2:
+                query = "select t.id, t.luid as subscription_luid, s.target_type, w.name as obj_title, w.id as obj_id, u.name as user_name, wo.name as workbook_name, wo.luid as workbook_luid, w.luid as obj_luid, w.repository_url as obj_url from tasks t inner join subscriptions s on t.obj_id = s.id inner join views w on s.target_id = w.id inner join _users u on s.user_id = u.id inner join workbooks wo on w.workbook_id = wo.id where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'View' UNION select t.id, t.luid, s.target_type, w.name,w.id,u.name, w.name, w.luid, w.luid, w.repository_url from tasks t inner join subscriptions s on t.obj_id = s.id inner join workbooks w on s.target_id = w.id inner join _users u on s.user_id = u.id where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'Workbook';"
+            else:
+                query = "select t.id, t.luid as subscription_luid, s.target_type, w.name as obj_title, w.id as obj_id,  case WHEN left(u.name,2) = 'EU' THEN u.name WHEN left(u.name,4) = 'T-EU' THEN u.name ELSE _uu.name end as user_name, wo.name as workbook_name, wo.luid as workbook_luid, w.luid as obj_luid, w.repository_url as obj_url from tasks t  inner join subscriptions s on t.obj_id = s.id  inner join views w on s.target_id = w.id  inner join _users u on s.user_id = u.id  inner join _users _uu on w.owner_id = _uu.id  inner join workbooks wo on w.workbook_id = wo.id  where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'View'  UNION  select t.id, t.luid, s.target_type, w.name,w.id, case WHEN left(u.name,2) = 'EU' THEN u.name WHEN left(u.name,4) = 'T-EU' THEN u.name ELSE _uu.name end, w.name, w.luid, w.luid, w.repository_url  from tasks t  inner join subscriptions s on t.obj_id = s.id  inner join workbooks w on s.target_id = w.id  inner join _users u on s.user_id = u.id  inner join _users _uu on w.owner_id = _uu.id  where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'Workbook';"
+                
+            failed_subscriptions = sf.postgresql(readonly_pw, server['postgreSQL'], query)
+            failed_sub = []
+
+            if len(failed_subscriptions) == 0:
+                log += '\n\nNo subscription task schedule failed for 5 consecutive times or more'
+                failed_list = []
+            else: 
+                for subscription in failed_subscriptions.to_dict('records'):
+                    if subscription['workbook_name'] == subscription['obj_title']:
+                        obj_type = 'workbook'
+                    else:
+                        obj_type = 'view'
+                    info = {'subscription_luid': subscription['subscription_luid'],
+                            'type': obj_type,
+                            'user': subscription['user_name'],
+                            'obj_title': subscription['obj_title'],
+                            'obj_id': subscription['obj_id'],
+                            'obj_luid': subscription['obj_luid'],
+                            'obj_url':subscription['obj_url'],
+                            'workbook_name': subscription['workbook_name'],
+                            'workbook_luid': subscription['workbook_luid'],
+                            'server' : subscription['Server']}
+                    failed_sub.append(info)
+
+                workbooks = sf.existing_objects(readonly_pw, server['postgreSQL'], 'workbooks', 'luid', [fs['obj_luid'] for fs in failed_sub if fs['type'] == 'workbook'], ['luid'], 'uuid')
+                views = sf.existing_objects(readonly_pw, server['postgreSQL'], 'views', 'luid', [fs['obj_luid'] for fs in failed_sub if fs['type'] == 'view'], ['luid'], 'uuid')
+
+                failed_list = []
+                for fs in failed_sub:
+                    if fs['type'] == 'workbook':
+                        found = str(fs['obj_luid']) in workbooks
+                    elif fs['type'] == 'view':
+                        found = str(fs['obj_luid']) in views
+                    if found:
+                        failed_list.append(fs)
+                groups_index = sf.index_groups(sf.postgresql(readonly_pw, server['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id'))
+            
+        except Exception as err:
+            log += '\n\nERROR: could not connect to {0}'.format(server['info'])
+            sf.log_file(log)
+
+        if len(failed_list) != 0:
+            log += '\n\nFailed Subscriptions task is failing for the following objects for 5 consecutive days or more:\n{}'.format('\n'.join(['- ' + fl['obj_title'] + ' (' + fl['type'] + ')' for fl in failed_list]))
+            log = sf.failed_subscriptions_delete(username, password, server, failed_list, groups_index, log)
+        return log
+    except Exception as err:
+        log += '\n\nERROR: the process stopped for {0}: {1}'.format(server['info'], err)
+        return log
 
-server_dict = {'server1': {'server':'', 'postgreSQL' : '','info':''},
-                'server2': {'server':'', 'postgreSQL' : '','info':''},
-                'server3': {'server':'', 'postgreSQL' : '','info':''},
-                'server4': {'server':'', 'postgreSQL' : '','info':''}}
 
 def validateLogin(ECBA_username, 
                   ESCBA_username, 
@@ -74,7 +149,8 @@ def validateLogin(ECBA_username,
     Tab_pw = [ECBA_pw, ESCBA_pw, ECBP_pw, ESCBP_pw]
     readonly_passwords = [read_ECBA_pw, read_ESCBA_pw, read_ECBP_pw, read_ESCBP_pw]
     
-    log = """
+    log = sf.RunLog()
+    log += """
 ################################
 # Failed Subscriptions process #
 ################################
@@ -83,82 +159,21 @@ Server selected: {0}""".format(', '.join(args.servers))
     
     tkWindow.destroy()
 
-    for x in range(len(Tab_users)):
-        if Tab_users[x] != None:
-            
-            if x == 0:
-                server = server_dict['server1']
-                readonly_pw = readonly_passwords[0]
-            elif x == 1:
-                server = server_dict['server2']  
-                readonly_pw = readonly_passwords[1]
-            elif x == 2:
-                server = server_dict['server3']
-                readonly_pw = readonly_passwords[2]
-            else:
-                server = server_dict['server4']
-                readonly_pw = readonly_passwords[3]
-            
-            log = log + '\n\n#############{0}###############\n\n-----------connecting to postgreSQL (host {1})-----------'.format(server['info'],server['postgreSQL'])
-            try:
-                if x == 0 or x == 2:
-                    query = "select t.*, s.target_type, w.name, w.id, u.name, wo.name, wo.luid, w.luid, w.repository_url from tasks t inner join subscriptions s on t.obj_id = s.id inner join views w on s.target_id = w.id inner join _users u on s.user_id = u.id inner join workbooks wo on w.workbook_id = wo.id where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'View' UNION select t.*, s.target_type, w.name,w.id,u.name, w.name, w.luid, w.luid, w.repository_url from tasks t inner join subscriptions s on t.obj_id = s.id inner join workbooks w on s.target_id = w.id inner join _users u on s.user_id = u.id where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'Workbook';"
-                else:
-                    query = "select t.*, s.target_type, w.name, w.id,  case WHEN left(u.name,2) = 'EU' THEN u.name WHEN left(u.name,4) = 'T-EU' THEN u.name ELSE _uu.name end, wo.name, wo.luid, w.luid, w.repository_url from tasks t  inner join subscriptions s on t.obj_id = s.id  inner join views w on s.target_id = w.id  inner join _users u on s.user_id = u.id  inner join _users _uu on w.owner_id = _uu.id  inner join workbooks wo on w.workbook_id = wo.id  where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'View'  UNION  select t.*, s.target_type, w.name,w.id, case WHEN left(u.name,2) = 'EU' THEN u.name WHEN left(u.name,4) = 'T-EU' THEN u.name ELSE _uu.name end, w.name, w.luid, w.luid, w.repository_url  from tasks t  inner join subscriptions s on t.obj_id = s.id  inner join workbooks w on s.target_id = w.id  inner join _users u on s.user_id = u.id  inner join _users _uu on w.owner_id = _uu.id  where t.type = 'SingleSubscriptionTask' and t.consecutive_failure_count > 4 and s.target_type = 'Workbook';"
-                
-                failed_subscriptions = sf.postgresql(readonly_pw, server['postgreSQL'], query)
-                failed_sub = []
-
-                if list(failed_subscriptions[0])[0] == None and len(failed_subscriptions) == 1:
-                    log = log + '\n\nNo subscription task schedule failed for 5 consecutive times or more'
-                    failed_list = []
-                else: 
-                    for i in range(len(failed_subscriptions)):
-                        if failed_subscriptions.iloc[i][25] == failed_subscriptions.iloc[i][22]:
-                            obj_type = 'workbook'
-                        else:
-                            obj_type = 'view'
-                        info = {'subscription_luid': failed_subscriptions.iloc[i][9],
-                                'type': obj_type,
-                                'user': failed_subscriptions.iloc[i][24],
-                                'obj_title': failed_subscriptions.iloc[i][22],
-                                'obj_id': failed_subscriptions.iloc[i][23],
-                                'obj_luid': failed_subscriptions.iloc[i][27],
-                                'obj_url':failed_subscriptions.iloc[i][28],
-                                'workbook_name': failed_subscriptions.iloc[i][25],
-                                'workbook_luid': failed_subscriptions.iloc[i][26],
-                                'server' : failed_subscriptions.iloc[i]['Server']}
-                        failed_sub.append(info)
-
-                    workbooks = sf.postgresql(readonly_pw, server['postgreSQL'], 'select luid from workbooks')
-                    workbooks_luid = list(workbooks[0])
-                    views =  sf.postgresql(readonly_pw, server['postgreSQL'], 'select luid from views')
-                    views_luid = list(views[0])
-
-                    failed_list = []
-                    for fs in range(len(failed_sub)):
-                        if failed_sub[fs]['type'].lower() == 'workbook':
-                            check = [w for w in workbooks_luid if failed_sub[fs]['obj_luid'] == w]
-                            failed_sub[fs]['']
-                        elif failed_sub[fs]['type'].lower() == 'view':
-                            check = [v for v in views_luid if failed_sub[fs]['obj_luid'] == v]
-                        if len(check) == 1:
-                            failed_list.append(failed_sub[fs])
-                    df_groups = sf.postgresql(readonly_pw, server['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id')
-            
-            except Exception as err:
-                log = log + '\n\nERROR: could not connect to {0}'.format(server['info'])
-                sf.log_file(log)
-
-            if len(failed_list) != 0:
-                log = log + '\n\nFailed Subscriptions task is failing for the following objects for 5 consecutive days or more:\n{}'.format('\n'.join(['- ' + fl['obj_title'] + ' (' + fl['type'] + ')' for fl in failed_list]))
-                log = sf.failed_subscriptions_delete(Tab_users[x], Tab_pw[x], server, failed_list, df_groups, log)
+    selected = [x for x in range(len(Tab_users)) if Tab_users[x] != None]
+    #Every selected server is processed in its own worker, the logs are merged in the order of the servers
+    with ThreadPoolExecutor(max_workers=max(len(selected), 1)) as executor:
+        results = list(executor.map(lambda x: process_server(x, Tab_users[x], Tab_pw[x], readonly_passwords[x], log), selected))
+    for server_log in results:
+        log += server_log
 
-    log = log + '\n\nFAILED SUBCRIPTIONS PROCESS COMPLETE!'
-    logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-    file = open(logfile_name, "w") 
-    file.write(log)
-    file.close()
+    #Every person receives one email listing their findings on all the selected servers
+    log += sf.send_digests()
+    log += sf.metrics_summary()
+    log += sf.connection_pools_summary()
+    log += '\n\nMetrics written to {0}'.format(sf.write_metrics(log.path.replace('run_', 'metrics_')[:-len('.jsonl')] + '.json'))
+    sf.close_connection_pools()
+    log += '\n\nFAILED SUBCRIPTIONS PROCESS COMPLETE!'
+    logfile_name = log.render()
     os.system(logfile_name.replace('/', '\\'))
     return 
 
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the bulk deletion of users (bulk_delete), against a stand-in session of the server.
+
+to launch: -> python -m unittest test_unlicensed_users (from the Unlicense users folder)
+"""
+
+import sys
+import threading
+import types
+import unittest
+
+import requests
+
+try:
+    import win32com.client
+except ImportError:
+    # Outlook is only driven on Windows, these tests do not prepare any email
+    sys.modules['win32com'] = types.ModuleType('win32com')
+    sys.modules['win32com.client'] = sys.modules['win32com'].client = types.ModuleType('win32com.client')
+
+import unlicensed_users as uu
+
+NOT_FOUND = ('<tsResponse xmlns="http://tableau.com/api"><error code="404002"><summary>Resource Not Found</summary>'
+             '<detail>User could not be found.</detail></error></tsResponse>')
+
+
+class DeleteSession:
+    """
+    Stand-in of the session of a server for DELETE requests: answers every url with its own list of
+    responses, one per request (a status code, a (status code, Retry-After) pair or an exception).
+    """
+    def __init__(self, answers):
+        self.answers = {url: list(responses) for url, responses in answers.items()}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def delete(self, url, headers=None, verify=None):
+        with self.lock:
+            self.requests.append(url)
+            answer = self.answers[url].pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        status_code, retry_after = answer if isinstance(answer, tuple) else (answer, None)
+        text = NOT_FOUND if status_code == 404 else ''
+        return types.SimpleNamespace(status_code=status_code, text=text, headers={} if retry_after is None else {'Retry-After': retry_after})
+
+
+class BulkDeleteTest(unittest.TestCase):
+
+    def setUp(self):
+        uu.setup()
+        uu.RESPONSE_FORMAT = 'xml'
+        # no waiting between the retries
+        uu.DELETE_BACKOFF = 0
+
+    def tearDown(self):
+        uu.setup()
+
+    def test_retries_and_summary(self):
+        answers = {'users/throttled': [(429, '0'), 204],
+                   'users/unavailable': [503, 503, 204],
+                   'users/missing': [404],
+                   'users/down': [500, 500, 500, 500],
+                   'users/reset': [requests.exceptions.ConnectionError('connection reset'), 204]}
+        session = DeleteSession(answers)
+        outcomes = uu.bulk_delete(session, list(answers), 'token', rate=0, retries=3, concurrency=2)
+
+        self.assertEqual([outcome['url'] for outcome in outcomes], list(answers))
+        self.assertEqual([outcome['deleted'] for outcome in outcomes], [True, True, False, False, True])
+        self.assertEqual([outcome['attempts'] for outcome in outcomes], [2, 3, 1, 4, 2])
+        self.assertEqual([outcome['status'] for outcome in outcomes], [204, 204, 404, 500, 204])
+        self.assertIn('404002: Resource Not Found', outcomes[2]['error'])
+        self.assertEqual(len(session.requests), 12)
+        self.assertEqual(uu.bulk_delete_summary(outcomes), '\n\nBulk delete: 3 of 5 deleted, 7 request(s) retried')
+
+    def test_nothing_to_delete(self):
+        self.assertEqual(uu.bulk_delete(DeleteSession({}), [], 'token'), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,24 +1,144 @@
 import requests # Contains methods used to make HTTP requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import random
 import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+import io
 import math
 import pandas as pd
 import win32com.client as client
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+import re
+import json
 import psycopg2
+import psycopg2.pool
+import threading
+import bisect
+from contextlib import contextmanager
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 
 def setup():
-    global verifySsl, VERSION, xmlns
+    global verifySsl, VERSION, xmlns, RESPONSE_FORMAT, PAGE_WORKERS, SNAPSHOT_DIR, POOL_SIZE, ASYNC_CONCURRENCY, DELETE_RATE, DELETE_RETRIES, DELETE_BACKOFF, HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF, LATENCY_BUCKETS
     
     verifySsl = False
     #Tableau Server version nr.
     VERSION = '3.4'
     xmlns = {'t': 'http://tableau.com/api'}
+    #Format of the REST responses: 'xml' or 'json'
+    RESPONSE_FORMAT = os.environ.get('TABLEAU_RESPONSE_FORMAT', 'xml').lower()
+    #Number of pages requested at the same time when listing objects
+    PAGE_WORKERS = 4
+    #Folder of the object listings shared by the housekeeping processes
+    SNAPSHOT_DIR = os.environ.get('TABLEAU_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'snapshots'))
+    #Maximum number of connections kept open to each postgreSQL repository
+    POOL_SIZE = 4
+    #Connections kept alive to each Tableau server by the session of new_session
+    HTTP_POOL_SIZE = 16
+    #Number of retries of a GET request (connection error, 429 or 5xx), waiting about HTTP_BACKOFF * 2^attempt seconds in between
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF = 0.5
+    #Upper bounds in seconds of the latency histograms of metrics_summary (the last bucket counts the slower calls)
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    #Maximum number of REST calls in flight at the same time in run_calls
+    ASYNC_CONCURRENCY = 8
+    #Maximum number of DELETE requests started per second by bulk_delete (0 = no limit)
+    DELETE_RATE = 5
+    #Number of retries of a DELETE request answered with 429 or 5xx, waiting DELETE_BACKOFF * 2^attempt seconds in between
+    DELETE_RETRIES = 3
+    DELETE_BACKOFF = 1.0
+
+
+#Names of the users per server (user id -> name), filled by load_user_names and user_id2name
+user_names = {}
+#Project leaders per server (project id -> (users, groups)) and cache hit/miss counters, filled by get_project_leader
+project_leaders = {}
+project_leaders_stats = {}
+#Connection pools to the postgreSQL repositories (host -> pool) and their usage, shared by every query of the run
+connection_pools = {}
+connection_pools_stats = {}
+connection_pools_lock = threading.Lock()
+#Time of the REST requests per endpoint ('GET /sites/{id}/workbooks' -> count, total and max seconds, histogram), filled by _record_timing
+http_timings = {}
+http_timings_lock = threading.Lock()
+#Time of the phases of the processes (function or step -> count, total and max seconds, histogram), filled by phase
+phase_timings = {}
+phase_timings_lock = threading.Lock()
+#Time of the repository queries per table read (table -> count, rows, total and max seconds, histogram), filled by postgresql_batches
+query_timings = {}
+query_timings_lock = threading.Lock()
+#Findings waiting to be emailed (recipient -> findings with the role of the recipient), filled by queue_digest and emptied by send_digests
+digests = {}
+digests_lock = threading.Lock()
 
 
 #Configurations for different Tableau servers
 
+class RunLog:
+    """
+    Log of a run, written to disk as it grows.
+
+    Every text added with += is one record (time, server, level, text) of the JSON Lines file
+    logs/run_<start>.jsonl, appended in batches of 'buffer_size' records. The readable report,
+    the text of all the records, is rendered once at the end by render().
+    """
+    def __init__(self, server=None, path=None, buffer_size=50, lock=None):
+        self.server = server
+        self.path = path or datetime.now().strftime("logs/run_%m%d_%H%M%S.jsonl")
+        self.buffer_size = buffer_size
+        self.lock = lock or threading.Lock()
+        self.texts = []
+        self.buffer = []
+
+    def __iadd__(self, text):
+        if isinstance(text, RunLog):
+            # log of a server processed by a worker: its records are already in the file
+            text.flush()
+            self.texts.extend(text.texts)
+            return self
+        if text == '':
+            return self
+        self.texts.append(text)
+        level = 'error' if 'ERROR' in text else 'warning' if 'WARNING' in text else 'info'
+        self.buffer.append({'time': datetime.now().isoformat(), 'server': self.server, 'level': level, 'text': text})
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return self
+
+    def __str__(self):
+        return ''.join(self.texts)
+
+    def child(self, server):
+        """
+        Returns the log of one server of the run, written to the same file.
+        """
+        return RunLog(server, self.path, self.buffer_size, self.lock)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(''.join(json.dumps(record) + '\n' for record in self.buffer))
+        self.buffer = []
+
+    def render(self, logfile_name=None):
+        """
+        Writes the readable report of the run (logs/log_<start>.txt by default) and returns its path.
+        """
+        self.flush()
+        if logfile_name == None:
+            logfile_name = self.path.replace('run_', 'log_')[:-len('.jsonl')] + '.txt'
+        with open(logfile_name, 'w', encoding='utf-8') as file:
+            file.write(str(self))
+        return logfile_name
+
+
 class ApiCallError(Exception):
     pass
 
@@ -26,16 +146,8 @@ class ApiCallError(Exception):
 class UserDefinedFieldError(Exception):
     pass
 
-
-def _encode_for_display(text):
-    """
-    Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
-
-    Returns an ASCII-encoded version of the text.
-    Unicode characters are converted to ASCII placeholders (for example, "?").
-    """
-    return text.encode('ascii', errors="backslashreplace").decode('utf-8')
+class ProcessStopped(Exception):
+    pass
 
 
 def _check_status(server_response, success_code):
@@ -47,7 +159,20 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        if RESPONSE_FORMAT == 'json':
+            try:
+                error = server_response.json().get('error', {})
+            except (ValueError, AttributeError):
+                # not an error of the REST API (e.g. the HTML page of a proxy): report the status and the body
+                raise ApiCallError('HTTP {0}: {1}'.format(server_response.status_code, server_response.text[:500]))
+            raise ApiCallError('{0}: {1} - {2}'.format(error.get('code', 'unknown code'), error.get('summary', 'unknown summary'), error.get('detail', 'unknown detail')))
+        try:
+            parsed_response = ET.fromstring(server_response.text)
+        except ET.ParseError:
+            parsed_response = None
+        if parsed_response is None or parsed_response.find('t:error', namespaces=xmlns) is None:
+            # not an error of the REST API (e.g. the HTML page of a proxy): report the status and the body
+            raise ApiCallError('HTTP {0}: {1}'.format(server_response.status_code, server_response.text[:500]))
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -63,6 +188,169 @@ def _check_status(server_response, success_code):
     return
 
 
+def _headers(auth_token=None):
+    """
+    Returns the headers of a REST call: the authentication token, and the Accept header in JSON mode.
+    """
+    headers = {}
+    if auth_token != None:
+        headers['x-tableau-auth'] = auth_token
+    if RESPONSE_FORMAT == 'json':
+        headers['Accept'] = 'application/json'
+    return headers
+
+
+def _json_to_element(tag, value):
+    """
+    Converts an object of a JSON response into the element of the XML response it stands for:
+    values become attributes, objects become child elements and lists become repeated child elements.
+    """
+    element = ET.Element('{{{0}}}{1}'.format(xmlns['t'], tag))
+    for key, val in value.items():
+        for v in (val if isinstance(val, list) else [val]):
+            if isinstance(v, dict):
+                element.append(_json_to_element(key, v))
+            elif isinstance(val, list):
+                ET.SubElement(element, '{{{0}}}{1}'.format(xmlns['t'], key)).text = str(v)
+            elif isinstance(v, bool):
+                element.set(key, str(v).lower())
+            else:
+                element.set(key, str(v))
+    return element
+
+
+def _parse_response(server_response):
+    """
+    Parses the response of a REST call, XML or JSON (see RESPONSE_FORMAT), into an XML element,
+    so that the objects are read the same way in both modes.
+    """
+    if RESPONSE_FORMAT == 'json':
+        return _json_to_element('tsResponse', server_response.json())
+    return ET.fromstring(server_response.content)
+
+
+class JitterRetry(Retry):
+    """
+    Retry policy of urllib3 adding a random jitter to the backoff, so that the workers of a run do not all retry at the same time.
+    """
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, backoff)
+
+
+def _endpoint(request):
+    """
+    Returns the endpoint of a request: method and path, without the api version, the ids and the query.
+    """
+    path = urlsplit(request.url).path
+    path = re.sub(r'^/api/[0-9.]+', '', path)
+    path = re.sub(r'/[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|/[0-9]+(?=/|$)', '/{id}', path)
+    return '{0} {1}'.format(request.method, path)
+
+
+def _add_timing(timings, lock, name, elapsed, **counters):
+    """
+    Adds one call to the timings of 'name': count, total and max seconds, calls per bucket of LATENCY_BUCKETS
+    and the 'counters' (e.g. rows=10) summed over the calls.
+    """
+    with lock:
+        timing = timings.setdefault(name, dict({'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}, **{counter: 0 for counter in counters}))
+        timing['count'] += 1
+        timing['total'] += elapsed
+        timing['max'] = max(timing['max'], elapsed)
+        timing['buckets'][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        for counter, value in counters.items():
+            timing[counter] += value
+    return
+
+
+@contextmanager
+def phase(name):
+    """
+    Span of a phase of the process, its time is added to phase_timings (see metrics_summary).
+    Used around a step ("with phase('...'):") or as decorator of a function ("@phase('get_all')").
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_timing(phase_timings, phase_timings_lock, name, time.perf_counter() - start)
+
+
+def _record_timing(server_response, *args, **kwargs):
+    """
+    Response hook of the sessions, records the time of the request in http_timings.
+    """
+    _add_timing(http_timings, http_timings_lock, _endpoint(server_response.request), server_response.elapsed.total_seconds())
+    return server_response
+
+
+def new_session():
+    """
+    Creates the session used for all the REST calls to a server: up to HTTP_POOL_SIZE keep-alive connections
+    (one TLS handshake per connection instead of one per call), gzip responses, GET requests retried with
+    backoff and jitter, and the time of every request recorded per endpoint (see metrics_summary).
+    """
+    session = requests.Session()
+    session.trust_env = False
+    retry = JitterRetry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.hooks['response'].append(_record_timing)
+    return session
+
+
+def _timings_table(title, timings, lock, counters=()):
+    """
+    Returns the log lines of a table of timings, longest total first: count, 'counters', total, average
+    and max seconds, and the number of calls per bucket of LATENCY_BUCKETS.
+    """
+    with lock:
+        rows = sorted([(name, dict(timing, buckets=list(timing['buckets']))) for name, timing in timings.items()], key=lambda row: -row[1]['total'])
+    header = ['count'] + list(counters) + ['total', 'average', 'max'] + ['<={0}s'.format(bound) for bound in LATENCY_BUCKETS] + ['>{0}s'.format(LATENCY_BUCKETS[-1])]
+    width = max([len(title)] + [len(name) for name, timing in rows])
+    text = '\n\n{0:<{1}} '.format(title, width) + ' '.join(['{0:>8}'.format(column) for column in header])
+    for name, timing in rows:
+        values = [timing['count']] + [timing[counter] for counter in counters]
+        values += ['{0:.3f}s'.format(seconds) for seconds in (timing['total'], timing['total'] / timing['count'], timing['max'])] + timing['buckets']
+        text += '\n{0:<{1}} '.format(name, width) + ' '.join(['{0:>8}'.format(value) for value in values])
+    return text
+
+
+def metrics_summary():
+    """
+    Returns the summary tables written at the end of the log: the phases of the processes (the spans of
+    the servers processed at the same time add up), the REST requests per endpoint and the repository queries per table.
+    """
+    return (_timings_table('Phases', phase_timings, phase_timings_lock)
+            + _timings_table('REST requests', http_timings, http_timings_lock)
+            + _timings_table('Repository queries', query_timings, query_timings_lock, ('rows',)))
+
+
+def write_metrics(path=None):
+    """
+    Writes the metrics of the run (see metrics_summary, plus the connection pools) as a JSON file and returns its path.
+
+    'path'          logs/metrics_<time>.json by default
+    """
+    if path == None:
+        path = datetime.now().strftime("logs/metrics_%m%d_%H%M%S.json")
+    metrics = {'latency_buckets': list(LATENCY_BUCKETS)}
+    for name, timings, lock in (('phases', phase_timings, phase_timings_lock), ('http', http_timings, http_timings_lock), ('queries', query_timings, query_timings_lock)):
+        with lock:
+            metrics[name] = json.loads(json.dumps(timings))
+    with connection_pools_lock:
+        metrics['connection_pools'] = {host: {'queries': stats['queries'], 'connections': len(stats['connections'])} for host, stats in connection_pools_stats.items()}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(metrics, file, indent=2)
+    return path
+
+
+@phase('sign_in')
 def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
@@ -85,15 +373,12 @@ def sign_in(session, server, username, password, site=""):
     xml_request = ET.tostring(xml_request)
 
     # Make the request to server
-    server_response = session.post(url, data=xml_request, verify=verifySsl) 
+    server_response = session.post(url, data=xml_request, headers=_headers(), verify=verifySsl) 
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
     # Reads and parses the response
     try:
-        parsed_response = ET.fromstring(server_response)
+        parsed_response = _parse_response(server_response)
     except Exception as err:
         print("There was an error parsing the server response. This error may be linked to incorrect credentials.")
         raise
@@ -105,33 +390,84 @@ def sign_in(session, server, username, password, site=""):
     return token, site_id, user_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server, auth_token):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session of the server
     'server'        specified server address
     'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token}, verify=False)
+    server_response = session.post(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 204)
     return
 
 
+@phase('query_views')
 def query_views(session, server, auth_token, site_id, workbook_id):
  
     url = server + "/api/{0}/sites/{1}/workbooks/{2}/views".format(VERSION, site_id, workbook_id)
     
-    server_response = session.get(url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
+    server_response = session.get(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = _parse_response(server_response)
     
     views = xml_response.findall('.//t:view', namespaces=xmlns)
     
     return views
 
 
-def get_all(session, server, auth_token, user_id, site_id, page_size, page_num, obj):
+def _parse_items(content, obj):
+    """
+    Parses a listing page incrementally, straight from the bytes of the response.
+
+    'content'       raw body of the server response
+    'obj'           object listed: workbook, datasource, project, view, user
+    Returns the items of the listing, each one detached from the page as soon as it is read,
+    and the total number of items available.
+    """
+    item_tag = '{{{0}}}{1}'.format(xmlns['t'], obj)
+    list_tag = item_tag + 's'
+    pagination_tag = '{{{0}}}pagination'.format(xmlns['t'])
+    items = []
+    total_items = None
+    parents = []
+    for event, element in ET.iterparse(io.BytesIO(content), events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag == item_tag and len(parents) > 0 and parents[-1].tag == list_tag:
+            items.append(element)
+            parents[-1].remove(element)
+        elif element.tag == pagination_tag:
+            total_items = int(element.get('totalAvailable'))
+    return items, total_items
+
+
+def _get_page(session, url, auth_token, page_size, page_num, obj):
+    """
+    Gets one page of objects from ECB/ESCB Tableau server.
+
+    'url'           listing address of the object, without paging parameters (filters allowed)
+    'auth_token'    authentication token that grants user access to API calls
+    'obj'           object to be retrieved: workbook, datasource, project, view
+    Returns the items in the page and the total number of items available.
+    """
+    paged_url = url + ("&" if "?" in url else "?") + "pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+    server_response = session.get(paged_url, headers=_headers(auth_token), verify=verifySsl)
+    _check_status(server_response, 200)
+    if RESPONSE_FORMAT == 'json':
+        xml_response = _parse_response(server_response)
+        items = xml_response.findall('t:{0}s/t:{0}'.format(obj), namespaces=xmlns)
+        return items, int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
+    return _parse_items(server_response.content, obj)
+
+
+@phase('get_all')
+def get_all(session, server, auth_token, user_id, site_id, page_size, page_num, obj, max_workers=1):
     """
     Gets all_objects from ECB/ESCB Tableau server.
 
@@ -140,6 +476,7 @@ def get_all(session, server, auth_token, user_id, site_id, page_size, page_num,
     'user_id'       ID of user with access to workbook
     'site_id'       ID of the site that the user is signed into
     'obj'           object to be retrieved: workbook, datasource, project, view
+    'max_workers'   number of pages requested at the same time (1 = one page after the other)
     """
     
     if obj == 'workbook':
@@ -147,43 +484,115 @@ def get_all(session, server, auth_token, user_id, site_id, page_size, page_num,
     else:
         url = server + "/api/{0}/sites/{1}/".format(VERSION, site_id) + obj + 's'
 
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-
-    server_response = session.get(url,data=None,  headers={'x-tableau-auth': auth_token}, verify=verifySsl) #, verify=verifySsl
-    _check_status(server_response, 200) #Function defined above
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    
-    items = xml_response.findall('.//t:' + obj, namespaces=xmlns) #Search XML for workbook data
-    
-    # Used to determine if more requests are required to find all workbooks on server
-    total_items = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
+    # The first page tells how many requests are required to find all objects on server
+    items, total_items = _get_page(session, url, auth_token, page_size, page_num, obj)
     max_page = int(math.ceil(total_items / page_size))
-    
-    # Continue querying if more workbooks exist on the server
-    for page in range(2, max_page + 1):
-        page_num+=1
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-
-        server_response = session.get(paged_url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
-        _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        #Search XML server response (xml_response) for relevant data - workbooks
-        items.extend(xml_response.findall('.//t:' + obj, namespaces=xmlns))
+    pages = range(page_num + 1, page_num + max_page)
+
+    if max_workers > 1 and len(pages) > 1:
+        # map() returns the pages in the order they were requested, so the items
+        # are reassembled exactly as in the sequential crawl
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda page: _get_page(session, url, auth_token, page_size, page, obj)[0], pages))
+    else:
+        results = [_get_page(session, url, auth_token, page_size, page, obj)[0] for page in pages]
+
+    for page_items in results:
+        items.extend(page_items)
     
     return items
 
 
-def get_objects_owners(session, server, site_id, user_id, auth_token):
+@phase('get_inventory')
+def get_inventory(session, server, auth_token, user_id, site_id, page_size, page_num, objs, max_workers=1, snapshot_max_age=0):
+    """
+    Gets the listings of several objects from ECB/ESCB Tableau server at the same time.
+
+    'objs'              objects to be retrieved, e.g. ('project', 'workbook', 'datasource')
+    'max_workers'       number of pages requested at the same time for each listing
+    'snapshot_max_age'  age in hours under which a listing saved by a previous process is reused
+                        (0 = always query the server)
+    Returns a dictionary with the list of items for every object.
+    """
+    inventory = {}
+    if snapshot_max_age > 0:
+        for obj in objs:
+            items = load_snapshot(server, site_id, user_id, obj, snapshot_max_age)
+            if items is not None:
+                inventory[obj] = items
+    missing = [obj for obj in objs if obj not in inventory]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {obj: executor.submit(get_all, session, server, auth_token, user_id, site_id, page_size, page_num, obj, max_workers) for obj in missing}
+        for obj, future in futures.items():
+            inventory[obj] = future.result()
+            if snapshot_max_age > 0:
+                save_snapshot(server, site_id, user_id, obj, inventory[obj])
+    return inventory
+
+
+def _snapshot_file(server, site_id, user_id, obj):
+    """
+    Returns the path of the snapshot file of an object listing, one file per server, site, user and object:
+    the listings hold what the signed in user sees on the site (the workbooks are even listed per user).
+    """
+    key = re.sub('[^0-9A-Za-z]+', '_', '{0}_{1}_{2}'.format(server, site_id, user_id)).strip('_')
+    return os.path.join(SNAPSHOT_DIR, '{0}_{1}s.xml'.format(key, obj))
+
+
+def save_snapshot(server, site_id, user_id, obj, items):
+    """
+    Stores an object listing on local disk, so that the other housekeeping processes
+    can reuse it instead of crawling the server again.
+
+    'server'        specified server address
+    'site_id'       ID of the site that the user is signed into
+    'user_id'       ID of the signed in user
+    'obj'           object of the listing: workbook, datasource, project, view
+    'items'         XML elements returned by get_all
+    """
+    snapshot = ET.Element('snapshot', server=server, site=site_id, user=user_id, obj=obj, created=datetime.now().isoformat())
+    snapshot.extend(items)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    snapshot_file = _snapshot_file(server, site_id, user_id, obj)
+    # Write to a temporary file first, so a process reading the snapshot never sees half of it
+    ET.ElementTree(snapshot).write(snapshot_file + '.tmp', encoding='utf-8')
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+    return
+
+
+def load_snapshot(server, site_id, user_id, obj, max_age):
+    """
+    Loads an object listing stored by save_snapshot.
+
+    'server'        specified server address
+    'site_id'       ID of the site that the user is signed into
+    'user_id'       ID of the signed in user
+    'obj'           object of the listing: workbook, datasource, project, view
+    'max_age'       maximum age of the snapshot in hours
+    Returns the XML elements of the listing, or None if no snapshot younger than max_age exists.
+    """
+    snapshot_file = _snapshot_file(server, site_id, user_id, obj)
+    if not os.path.exists(snapshot_file):
+        return None
+
+    snapshot = ET.parse(snapshot_file).getroot()
+    created = datetime.fromisoformat(snapshot.get('created'))
+    if (snapshot.get('server'), snapshot.get('site'), snapshot.get('user')) != (server, site_id, user_id) or datetime.now() - created > timedelta(hours=max_age):
+        return None
+    return list(snapshot)
+
 
-    all_projects = get_all(session, server, auth_token, user_id, site_id, 100, 1, 'project')
-    all_workbooks = get_all(session, server, auth_token, user_id, site_id, 100, 1, 'workbook')
-    all_datasources = get_all(session, server, auth_token, user_id, site_id, 100, 1, 'datasource')
+@phase('get_objects_owners')
+def get_objects_owners(session, server, site_id, user_id, auth_token, all_projects, all_workbooks, all_datasources, site_views):
 
+    views_by_workbook = index_views(site_views)
     all_views = []
     for workbook in all_workbooks:
         if workbook.get('id') != None:
-            views_in_workbook = query_views(session, server, auth_token, site_id, workbook.get('id'))
-            for viw in views_in_workbook:
+            for viw in views_by_workbook.get(workbook.get('id'), []):
                 view = {'connection': viw,'workbook': workbook.get('name')}
                 all_views.append(view)
     
@@ -224,54 +633,286 @@ def get_objects_owners(session, server, site_id, user_id, auth_token):
     return projects, workbooks, datasources, views
 
 
-def postgresql(password, host, query):
-    """ Querying projects with missing Project Leaders"""
-    
+def get_connection(password, host):
+    """
+    Returns a connection to the Tableau repository of a host, reusing a connection of
+    the pool of the host when one is free, so that every query does not open a new one.
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    """
+    with connection_pools_lock:
+        if host not in connection_pools:
+            connection_pools[host] = psycopg2.pool.ThreadedConnectionPool(1, POOL_SIZE, database='workgroup', user='readonly', password=password, host=host, port=8060)
+            connection_pools_stats[host] = {'queries': 0, 'connections': set()}
+        pool = connection_pools[host]
+    connection = pool.getconn()
+    with connection_pools_lock:
+        connection_pools_stats[host]['queries'] += 1
+        connection_pools_stats[host]['connections'].add(id(connection))
+    return connection
+
+
+def release_connection(host, connection):
+    """
+    Gives a connection back to the pool of its host.
+    """
+    try:
+        # close the read-only transaction opened by the query
+        connection.rollback()
+        connection_pools[host].putconn(connection)
+    except (Exception, psycopg2.DatabaseError) as error:
+        connection_pools[host].putconn(connection, close=True)
+    return
+
+
+def close_connection_pools():
+    """
+    Closes every pooled connection, at the end of the run.
+    """
+    with connection_pools_lock:
+        for pool in connection_pools.values():
+            pool.closeall()
+        connection_pools.clear()
+    return
+
+
+def connection_pools_summary():
+    """
+    Returns the log lines with the number of queries and connections used per host.
+    """
+    text = ''
+    for host, stats in connection_pools_stats.items():
+        connections = len(stats['connections'])
+        text = text + '\npostgreSQL {0}: {1} queries on {2} connection(s), {3} reused'.format(host, stats['queries'], connections, stats['queries'] - connections)
+    return text
+
+
+def postgresql_batches(password, host, query, params=None, batch_size=5000):
+    """
+    Reads the result of a query on the Tableau repository batch by batch, through a
+    server-side cursor, so that large tables are never loaded in memory at once.
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    'query'         SQL query, with %s placeholders for 'params'
+    'batch_size'    number of rows fetched from the server at a time
+    Yields one DataFrame per batch, with the column names of the query and the "Server" column
+    (a single empty DataFrame if the query returns no row).
+    """
+    connection = get_connection(password, host)
+    # time spent waiting for the repository only, not for the caller reading the batches
+    elapsed = 0.0
+    rows_read = 0
     try:
-        connection = psycopg2.connect(database='workgroup', user='readonly', password=password, host=host, port=8060)
-        cur = connection.cursor()
-        cur.execute(query)
-        row = cur.fetchone()
-        df = [row]
-     
-        while row is not None:
-            df.append(row)
-            row = cur.fetchone()
+        # a named cursor is declared on the server, rows are only sent when fetched
+        cur = connection.cursor(name='housekeeping')
+        start = time.perf_counter()
+        cur.execute(query.strip().rstrip(';'), params)
+        rows = cur.fetchmany(batch_size)
+        elapsed += time.perf_counter() - start
+        columns = [column[0] for column in cur.description]
+        first = True
+        while rows or first:
+            rows_read += len(rows)
+            df = pd.DataFrame(rows, columns=columns)
+            df["Server"] = host
+            yield df
+            first = False
+            start = time.perf_counter()
+            rows = cur.fetchmany(batch_size)
+            elapsed += time.perf_counter() - start
         cur.close()
-        
+    finally:
+        release_connection(host, connection)
+        _add_timing(query_timings, query_timings_lock, _query_table(query), elapsed, rows=rows_read)
+
+
+def _query_table(query):
+    """
+    Returns the name a query is timed under in query_timings: the first table it reads.
+    """
+    match = re.search(r'\bfrom\s+([\w."]+)', query, re.IGNORECASE)
+    return match.group(1) if match else query.strip()[:40]
+
+
+def postgresql(password, host, query, params=None):
+    """
+    Queries the Tableau repository (workgroup database)
+
+    'password'      password of the readonly user
+    'host'          postgreSQL host of the Tableau server
+    'query'         SQL query, with %s placeholders for 'params'
+    Returns a DataFrame with the column names of the query and the "Server" column.
+    """
+    try:
+        df = pd.concat(list(postgresql_batches(password, host, query, params)), ignore_index=True)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    
-    finally:
-        if connection is not None:
-            connection.close()
-    df = pd.DataFrame(df)
-    df["Server"] = host
+        raise
     df = df.drop_duplicates()
     return df
 
 
-def find_and_remove(session, server,auth_token,site_id,user_id,postgre_data,postgre_unlicensed,df_groups,log=''):
+async def _call(semaphore, function, args):
+    async with semaphore:
+        # the REST calls use requests, which blocks: each call runs in a worker thread of the event loop
+        return await asyncio.to_thread(function, *args)
+
+
+async def gather_calls(calls, concurrency):
+    """
+    Runs REST calls concurrently, with at most 'concurrency' calls in flight at the same time.
+
+    'calls'         list of (function, args), e.g. (user_id2name, (session, server, auth_token, site_id, user_id))
+    'concurrency'   maximum number of calls running at the same time
+    Returns the results in the order of 'calls', with the exception in place of the result of a failed call.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_call(semaphore, function, args) for function, args in calls], return_exceptions=True)
+
+
+def run_calls(calls, concurrency=None):
+    """
+    Blocking entry point of gather_calls, for the processes (ASYNC_CONCURRENCY calls at a time by default).
+    """
+    if len(calls) == 0:
+        return []
+    return asyncio.run(gather_calls(calls, concurrency or ASYNC_CONCURRENCY))
+
+
+class RateLimiter:
+    """
+    Spaces the calls made by several threads, so that at most 'rate' calls start every second (no limit if 'rate' is 0).
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_call)
+            self.next_call = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _delete_with_retries(session, url, auth_token, limiter, retries, backoff):
+    """
+    Sends one DELETE request, retried with exponential backoff (or after the Retry-After delay of the server)
+    when the server answers 429 or 5xx or the connection fails.
+    Returns the outcome: {'url', 'status', 'attempts', 'deleted', 'error'}
+    """
+    outcome = {'url': url, 'status': None, 'attempts': 0, 'deleted': False, 'error': None}
+    for attempt in range(retries + 1):
+        limiter.wait()
+        outcome['attempts'] += 1
+        delay = backoff * 2 ** attempt
+        try:
+            server_response = session.delete(url, headers=_headers(auth_token), verify=verifySsl)
+        except requests.exceptions.RequestException as err:
+            outcome['error'] = str(err)
+        else:
+            outcome['status'] = server_response.status_code
+            if server_response.status_code in (200, 204):
+                outcome['deleted'] = True
+                outcome['error'] = None
+                return outcome
+            try:
+                _check_status(server_response, 204)
+            except Exception as err:
+                outcome['error'] = str(err) or 'HTTP {0}'.format(server_response.status_code)
+            if server_response.status_code != 429 and server_response.status_code < 500:
+                return outcome
+            retry_after = server_response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = int(retry_after)
+        if attempt < retries:
+            time.sleep(delay)
+    return outcome
+
+
+@phase('bulk_delete')
+def bulk_delete(session, urls, auth_token, rate=None, retries=None, concurrency=None):
+    """
+    Deletes several REST resources (tasks, subscriptions, users...) concurrently, in one pass.
+
+    'session'       session of the server
+    'urls'          urls of the resources to delete
+    'auth_token'    authentication token of the session
+    'rate'          maximum number of DELETE requests started per second (DELETE_RATE by default, 0 = no limit)
+    'retries'       number of retries of a request answered with 429 or 5xx (DELETE_RETRIES by default)
+    'concurrency'   maximum number of requests in flight (ASYNC_CONCURRENCY by default)
+    Returns the outcome of every url, in the order of 'urls' (see _delete_with_retries).
+    """
+    limiter = RateLimiter(DELETE_RATE if rate is None else rate)
+    retries = DELETE_RETRIES if retries is None else retries
+    results = run_calls([(_delete_with_retries, (session, url, auth_token, limiter, retries, DELETE_BACKOFF)) for url in urls], concurrency)
+    return [result if not isinstance(result, Exception) else {'url': url, 'status': None, 'attempts': 0, 'deleted': False, 'error': str(result)}
+            for url, result in zip(urls, results)]
+
+
+def bulk_delete_summary(outcomes):
+    """
+    Returns the log line counting the resources deleted by bulk_delete and the requests retried.
+    """
+    deleted = len([outcome for outcome in outcomes if outcome['deleted']])
+    retried = sum([outcome['attempts'] - 1 for outcome in outcomes if outcome['attempts'] > 1])
+    return '\n\nBulk delete: {0} of {1} deleted, {2} request(s) retried'.format(deleted, len(outcomes), retried)
+
+
+def delete_users(session, server, auth_token, site_id, users, log = ''):
+    """
+    Deletes the unlicensed users that no longer own any content, all of them at once (see bulk_delete).
+
+    'users'     unlicensed users to delete ('name', 'user_id')
+    """
+    delete_urls = [server + "/api/{0}/sites/{1}/users/{2}".format(VERSION, site_id, user['user_id']) for user in users]
+    outcomes = bulk_delete(session, delete_urls, auth_token)
+    for user, outcome in zip(users, outcomes):
+        log += '\n\n -   Unlicensed user {0}'.format(user['name'])
+        if outcome['deleted']:
+            log += ' ---> USER DELETED!'
+        else:
+            log += '\n\nERROR: could not delete unlicensed user {0} after {1} attempt(s): {2}'.format(user['name'], outcome['attempts'], outcome['error'])
+    log += bulk_delete_summary(outcomes)
+    return log
+
+
+@phase('find_and_remove')
+def find_and_remove(session, server,auth_token,site_id,user_id,postgre_data,postgre_unlicensed,groups_index,log='',snapshot_max_age=0,server_info=''):
     """
     we loop for each users of the server and if their site role is "unlicesed" then we remove it from the server 
     """
     try:
-        projects, workbooks, datasources, views = get_objects_owners(session, server, site_id, user_id, auth_token)
+        inventory = get_inventory(session, server, auth_token, user_id, site_id, 100, 1, ('project', 'workbook', 'datasource', 'view'), PAGE_WORKERS, snapshot_max_age)
+        all_projects = inventory['project']
+        all_workbooks = inventory['workbook']
+        all_datasources = inventory['datasource']
+        site_views = inventory['view']
+        project_index = index_projects(all_projects)
+        workbooks_by_name = {}
+        for wk in all_workbooks:
+            workbooks_by_name.setdefault(wk.get('name'), wk)
+        datasources_by_name = {}
+        for ds in all_datasources:
+            datasources_by_name.setdefault(ds.get('name'), ds)
     except Exception as err:
-        log = log + '\n\nERROR: could not retrieve objects owners, please check your admin credentials and retry!'
+        log += '\n\nERROR: could not retrieve objects in server {0}, please check your admin credentials and retry!'.format(server)
         log_file(log)
 
     try:
-        all_projects = get_all(session, server, auth_token, user_id, site_id, 100, 1, 'project')
-        all_workbooks = get_all(session, server, auth_token, user_id, site_id, 100, 1, 'workbook')
-        all_datasources = get_all(session, server, auth_token, user_id, site_id, 100, 1, 'datasource')
+        projects, workbooks, datasources, views = get_objects_owners(session, server, site_id, user_id, auth_token, all_projects, all_workbooks, all_datasources, site_views)
     except Exception as err:
-        log = log + '\n\nERROR: could not retrieve objects in server {0}, please check your admin credentials and retry!'.format(server)
+        log += '\n\nERROR: could not retrieve objects owners, please check your admin credentials and retry!'
         log_file(log)
 
     unlicensed_users = []
-    for pu in range(len(postgre_unlicensed)):
-        unli_us = {'name' : list(postgre_unlicensed[1])[pu], 'user_id' : list(postgre_unlicensed[0])[pu]}
+    users_to_delete = []
+    for pu in postgre_unlicensed.to_dict('records'):
+        unli_us = {'name' : pu['name'], 'user_id' : pu['luid']}
         unli_us['projects_name'] = []
         unli_us['projects_id'] = []
         unli_us['projects_parent'] = {'name':[] , 'PL': []}
@@ -305,75 +946,66 @@ def find_and_remove(session, server,auth_token,site_id,user_id,postgre_data,post
     unlius_emails = []
     for unlius in unlicensed_users:
         if len(unlius['projects_name']) + len(unlius['workbooks_name']) + len(unlius['datasources_name']) != 0:
-            log = log + '\n\n -   unlicensed user ' + unlius['name'] + ' is still owner of the follwing:\n'
+            log += '\n\n -   unlicensed user ' + unlius['name'] + ' is still owner of the follwing:\n'
             if len(unlius['projects_name']) != 0:
-                log = log + '\nPROJECTS:\n-' + '\n-'.join(list([i for i in unlius['projects_name']]))
+                log += '\nPROJECTS:\n-' + '\n-'.join(list([i for i in unlius['projects_name']]))
                 if type(log) == tuple:
                     log = ' '.join(log)
             if len(unlius['workbooks_name']) != 0:
-                log = log + '\n\nWORKBOOKS:\n-' + '\n-'.join(list([i for i in unlius['workbooks_name']])) 
+                log += '\n\nWORKBOOKS:\n-' + '\n-'.join(list([i for i in unlius['workbooks_name']])) 
                 if type(log) == tuple:
                     log = ' '.join(log)
             if len(unlius['datasources_name']) != 0:
-                log = log + '\n\nDATASOURCES:\n-' + '\n-'.join(list([i for i in unlius['datasources_name']]))           
+                log += '\n\nDATASOURCES:\n-' + '\n-'.join(list([i for i in unlius['datasources_name']]))           
                 if type(log) == tuple:
                     log = ' '.join(log)
-            log = log + '\n\nsearching for project leaders:\n'
+            log += '\n\nsearching for project leaders:\n'
             
             for proj in unlius['projects_name']:
                 try:
-                    pivot = [pr for pr in all_projects if pr.get('name') == proj]
-                    while pivot[0].get('parentProjectId') != None:
-                        pivot = [pr for pr in all_projects if pr.get('id') == pivot[0].get('parentProjectId')]
-                    pivot = pivot[0].get('name')
+                    pivot = find_top_project(project_index, project_index['by_name'][proj].get('id')).get('name')
                     unlius['projects_parent']['name'].append(pivot)
-                    pro_lead_users, pro_lead_groups = get_project_leader(pivot, all_projects, server, site_id, auth_token, session, df_groups, log)
+                    pro_lead_users, pro_lead_groups = get_project_leader(pivot, all_projects, server, site_id, auth_token, session, groups_index, log)
                     if len(pro_lead_users) == 0:
-                        log = log + '\nno PL found for project {0}'.format(proj)
+                        log += '\nno PL found for project {0}'.format(proj)
                     else:
-                        log = log + '\nfollowing PL(s) found for project {0}: {1}'.format(proj, ''.join(['\n-' + plu['name'] for plu in pro_lead_users]))
+                        log += '\nfollowing PL(s) found for project {0}: {1}'.format(proj, ''.join(['\n-' + plu['name'] for plu in pro_lead_users]))
                     unlius['projects_parent']['PL'].append(pro_lead_users)
 
                 except Exception as err:
-                    log  = log + '\n\nERROR: could not retrieve projects leaders and project groups for project {0} in {1} server, check your admin credentials and retry'.format(proj,server)
+                    log += '\n\nERROR: could not retrieve projects leaders and project groups for project {0} in {1} server, check your admin credentials and retry'.format(proj,server)
                     log_file(log)
                     
             for work in unlius['workbooks_name']:
                 try:
-                    workbook = [wk for wk in all_workbooks if wk.get('name') == work][0]
-                    pivot_wor = [pr for pr in all_projects if workbook.find('.//t:project', namespaces=xmlns).get('id') == pr.get('id')]
-                    while pivot_wor[0].get('parentProjectId') != None:
-                        pivot_wor = [pr for pr in all_projects if pr.get('id') == pivot_wor[0].get('parentProjectId')]
-                    pivot_wor = pivot_wor[0].get('name')
+                    workbook = workbooks_by_name[work]
+                    pivot_wor = find_top_project(project_index, workbook.find('.//t:project', namespaces=xmlns).get('id')).get('name')
                     unlius['workbooks_project']['name'].append(pivot_wor)
-                    wor_lead_users, wor_lead_groups = get_project_leader(pivot_wor, all_projects, server, site_id, auth_token, session, df_groups, log)
+                    wor_lead_users, wor_lead_groups = get_project_leader(pivot_wor, all_projects, server, site_id, auth_token, session, groups_index, log)
                     if len(wor_lead_users) == 0:
-                        log = log + '\nno PL found for workbook {0} in main project {1}'.format(work, pivot_wor)
+                        log += '\nno PL found for workbook {0} in main project {1}'.format(work, pivot_wor)
                     else:
-                        log = log + '\nfollowing PL(s) found for workbook {0} in main project {1}: {2}'.format(work, pivot_wor, ''.join(['\n-' + wlu['name'] for wlu in wor_lead_users]))
+                        log += '\nfollowing PL(s) found for workbook {0} in main project {1}: {2}'.format(work, pivot_wor, ''.join(['\n-' + wlu['name'] for wlu in wor_lead_users]))
                     unlius['workbooks_project']['PL'].append(wor_lead_users)
 
                 except Exception as err:
-                    log  = log + '\n\nERROR: could not retrieve projects leaders and project groups for workbook {0} in {1} server, check your admin credentials and retry'.format(work,server)
+                    log += '\n\nERROR: could not retrieve projects leaders and project groups for workbook {0} in {1} server, check your admin credentials and retry'.format(work,server)
                     log_file(log)
                                      
             for data in unlius['datasources_name']:
                 try:
-                    datasource = [ds for ds in all_datasources if ds.get('name') == data][0]
-                    pivot_dat = [pr for pr in all_projects if datasource.find('.//t:project', namespaces=xmlns).get('id') == pr.get('id')]
-                    while pivot_dat[0].get('parentProjectId') != None:
-                        pivot_dat = [pr for pr in all_projects if pr.get('id') == pivot_dat[0].get('parentProjectId')]
-                    pivot_dat = pivot_dat[0].get('name')
+                    datasource = datasources_by_name[data]
+                    pivot_dat = find_top_project(project_index, datasource.find('.//t:project', namespaces=xmlns).get('id')).get('name')
                     unlius['datasources_project']['name'].append(pivot_dat)
-                    dat_lead_users, dat_lead_groups = get_project_leader(pivot_dat, all_projects, server, site_id, auth_token, session, df_groups, log)
+                    dat_lead_users, dat_lead_groups = get_project_leader(pivot_dat, all_projects, server, site_id, auth_token, session, groups_index, log)
                     if len(dat_lead_users) == 0:
-                        log = log + '\nno PL found for datasource {0} in main project {1}'.format(data, pivot_dat)
+                        log += '\nno PL found for datasource {0} in main project {1}'.format(data, pivot_dat)
                     else:
-                        log = log + '\nfollowing PL(s) found for datasource {0} in main project {1}: {2}'.format(data, pivot_dat, ''.join(['\n-' + dlu['name'] for dlu in dat_lead_users]))
+                        log += '\nfollowing PL(s) found for datasource {0} in main project {1}: {2}'.format(data, pivot_dat, ''.join(['\n-' + dlu['name'] for dlu in dat_lead_users]))
                     unlius['datasources_project']['PL'].append(dat_lead_users)
 
                 except Exception as err:
-                    log  = log + '\n\nERROR: could not retrieve projects leaders and project groups for project {0} in {1} server, check your admin credentials and retry'.format(data,server)
+                    log += '\n\nERROR: could not retrieve projects leaders and project groups for project {0} in {1} server, check your admin credentials and retry'.format(data,server)
                     log_file(log)
 
             unique_projects = list(set(unlius['projects_parent']['name'] + unlius['workbooks_project']['name'] + unlius['datasources_project']['name']))
@@ -394,7 +1026,7 @@ def find_and_remove(session, server,auth_token,site_id,user_id,postgre_data,post
                 emails = PL_per_obj[0]
                 for PL in PL_per_obj:
                     if PL != emails:
-                        log = log + '\n\nWARNING: something went wrong when reshaffeling the objects and different PLs have been found for same project. Please check the email'                       
+                        log += '\n\nWARNING: something went wrong when reshaffeling the objects and different PLs have been found for same project. Please check the email'                       
                 PLs = [em['name'] for em in emails]
 
                 email_info['project_name'].append(up)
@@ -407,14 +1039,14 @@ def find_and_remove(session, server,auth_token,site_id,user_id,postgre_data,post
                 if len(PLs) != 0:
                     emm.append("unlicensed_users_email(['{0}'], '{1}', '{2}', '{3}', '{4}', {{'projects':['{5}'], 'workbooks:['{6}'],'datasources':['{7}']}}".format("', '".join(PLs), server, unlius['name'], up, '000', "', '".join(all_obj['projects']),"', '".join(all_obj['workbooks']),"', '".join(all_obj['datasources'])))
                     try:
-                        project_number = str(int(postgre_data[postgre_data[1] == up][0]))  
-                        log = log + '\n\nPREPARING EMAIL (unlicensed user {0}, project {1}. \nThe email is sent to following PL(s): {2}'.format(unlius['name'],up, ', '.join(list(PLs)))
-                        unlicensed_users_email(PLs, server, unlius['name'], up, project_number, all_obj)
+                        project_number = str(int(postgre_data[postgre_data['name'] == up]['id'].item()))  
+                        log += '\n\nPREPARING EMAIL (unlicensed user {0}, project {1}. \nThe email is sent to following PL(s): {2}'.format(unlius['name'],up, ', '.join(list(PLs)))
+                        unlicensed_users_email(PLs, server, unlius['name'], up, project_number, all_obj, server_info)
                  
                     except Exception as err:
                         project_number = '000'
                         text = '\n\n WARNING No project_number found for project {0} in server {2}, so the email link to that project for user {1} must be corrected manually (now reports "000")'.format(up, unlius['name'],server)
-                        unlicensed_users_email(PLs, server, unlius['name'], up, project_number, all_obj)
+                        unlicensed_users_email(PLs, server, unlius['name'], up, project_number, all_obj, server_info)
                  
                 else:
                     text = '\n\n WARNING: No PL found for project {0} in server {2}, so no email was prepared (check manually). Unlicensed user {1} still owns objects in the project'.format(up, unlius['name'],server)
@@ -422,31 +1054,35 @@ def find_and_remove(session, server,auth_token,site_id,user_id,postgre_data,post
 
             unlius_emails.append(email_info)
         else:
-            log = log + '\n\n -   Unlicensed user {0} is going to be deleted'.format(unlius['name'])
-            """                   
-            delete_url=server + "/api/{0}/sites/{1}/users/{2}".format(VERSION, site_id, user.get('id'))
-            try:
-                server_response = requests.delete(delete_url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
-                log = log + ' ---> USER DELETED!'
-            except Exception as err:
-                log = log + '\n\nERROR: could not delete unlicensed user {0}. Please check your admin credentials and retry!'.format(unlius['name'])
-                log_file(log)
-            """
-            
+            log += '\n\n -   Unlicensed user {0} is going to be deleted'.format(unlius['name'])
+            users_to_delete.append(unlius)
+
+    #log = delete_users(session, server, auth_token, site_id, users_to_delete, log)
+
     return unlicensed_users, unlius_emails, log, NoPLtext, emm
 
 
 def log_file(log):
-    logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-    file = open(logfile_name, "w") 
-    file.write(log)
-    file.close()
+    """
+    Writes the log, opens it and stops the process after an error.
+    The log of a server processed by a worker (see RunLog.child) is not written here, as the servers run
+    at the same time: ProcessStopped ends the server, its log is merged with the others and written once by the GUI.
+    """
+    if isinstance(log, RunLog) and log.server is not None:
+        raise ProcessStopped('see the errors above')
+    if isinstance(log, RunLog):
+        logfile_name = log.render()
+    else:
+        logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
+        file = open(logfile_name, "w", encoding="utf-8") 
+        file.write(log)
+        file.close()
     os.system(logfile_name.replace('/', '\\'))
     error()
     return
 
 
-def get_users_in_group(df_groups, group_id):
+def get_users_in_group(groups_index, group_id):
     """
     Get all the users in the group using group id
  
@@ -462,25 +1098,114 @@ def get_users_in_group(df_groups, group_id):
     users = xml_response.findall('.//t:user', namespaces=xmlns)
     return users
     """
-    df = df_groups[(df_groups[0] == group_id)][[1,2]]
-    df = [{'name' : list(df[1])[i].lower(), 'id' : list(df[2])[i]} for i in range(len(df))]
-    for d in range(len(df)):
-        if 't-' in df[d]['name']:
-            df[d]['name'] = df[d]['name'][4:(len(df[d]['name'])-1)]
-    return df
+    return [dict(member) for member in groups_index.get(group_id, ())]
+
+
+def index_groups(df_groups):
+    """
+    Indexes the group members read from postgreSQL, once per run
 
+    'df_groups'     result of the group_users query (group id, user name, user id)
+    Returns a dictionary group id -> tuple of members {'name', 'id'}, with the user names
+    already lower case and without the 't-' prefix.
+    """
+    members = {}
+    for group_id, name, user_id in zip(df_groups['Groupid'], df_groups['Username'], df_groups['Userid']):
+        if not isinstance(group_id, str) or not isinstance(name, str):
+            continue
+        name = name.lower()
+        if 't-' in name:
+            name = name[4:(len(name)-1)]
+        members.setdefault(group_id, []).append({'name': name, 'id': user_id})
+    return {group_id: tuple(group_members) for group_id, group_members in members.items()}
+
+
+def index_views(all_views):
+    """
+    Indexes the views of the site-level listing by the id of their workbook.
+
+    'all_views'     views from get_all(..., 'view'), each one with its workbook and owner inlined
+    Returns a dictionary {workbook id: [views]}, the views in the order of the listing.
+    """
+    views_by_workbook = {}
+    for view in all_views:
+        workbook = view.find('t:workbook', namespaces=xmlns)
+        if workbook != None:
+            views_by_workbook.setdefault(workbook.get('id'), []).append(view)
+    return views_by_workbook
+
+
+def index_projects(all_projects):
+    """
+    Indexes the project hierarchy once per run, so that the top-level project of
+    any project is found without scanning the project list again.
+
+    'all_projects'  project elements returned by get_all
+    Returns a dictionary with the maps id -> project, name -> project and id -> top-level project
+    (None if the hierarchy of the project cannot be resolved).
+    """
+    by_id = {pr.get('id'): pr for pr in all_projects}
+    by_name = {}
+    for pr in all_projects:
+        by_name.setdefault(pr.get('name'), pr)
+
+    top = {}
+    for project_id in by_id:
+        # walk up until a project whose top-level project is already known,
+        # then store the result for every project met on the way
+        path = []
+        pivot = project_id
+        while pivot not in top:
+            if pivot not in by_id or pivot in path:
+                top[pivot] = None
+                break
+            path.append(pivot)
+            parent_id = by_id[pivot].get('parentProjectId')
+            if parent_id == None:
+                top[pivot] = by_id[pivot]
+                break
+            pivot = parent_id
+        for pid in path:
+            top[pid] = top[pivot]
+
+    return {'by_id': by_id, 'by_name': by_name, 'top': top}
+
+
+def find_top_project(project_index, project_id):
+    """
+    Returns the top-level project element of a project.
+
+    'project_index' dictionary returned by index_projects
+    'project_id'    ID of the project
+    Throws a KeyError if the hierarchy of the project cannot be resolved.
+    """
+    top_project = project_index['top'].get(project_id)
+    if top_project is None:
+        raise KeyError(project_id)
+    return top_project
 
-def get_project_leader(project_name, all_projects, server, site_id, auth_token, session, df_groups, log):
+
+@phase('get_project_leader')
+def get_project_leader(project_name, all_projects, server, site_id, auth_token, session, groups_index, log):
     
     pfound =[project for project in all_projects if project.get('name') == project_name]
     project_id = pfound[0].get('id')
+
+    # The leaders of a project are queried once per run, then served from project_leaders
+    cache = project_leaders.setdefault(server, {})
+    stats = project_leaders_stats.setdefault(server, {'hits': 0, 'misses': 0})
+    if project_id in cache:
+        stats['hits'] += 1
+        l_users, l_groups = cache[project_id]
+        return [dict(lu) for lu in l_users], list(l_groups)
+    stats['misses'] += 1
     
     url=server + "/api/" + VERSION + "/sites/" + site_id + "/projects/" + project_id + "/permissions"
 
-    server_response = session.get(url, data=None , headers={'x-tableau-auth': auth_token}, verify=verifySsl) 
+    server_response = session.get(url, data=None , headers=_headers(auth_token), verify=verifySsl) 
     _check_status(server_response, 200)
     
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = _parse_response(server_response)
     
     permissions = xml_response.findall('.//t:granteeCapabilities', namespaces=xmlns)
     leads_users = []
@@ -504,11 +1229,11 @@ def get_project_leader(project_name, all_projects, server, site_id, auth_token,
     for lgroup in leads_groups:
         try:
             l_groups.append({'id': lgroup.get('id')})
-            uing = get_users_in_group(df_groups, lgroup.get('id'))
+            uing = get_users_in_group(groups_index, lgroup.get('id'))
             leads_users = leads_users + uing
         
         except Exception as err:
-            log = log + "\n\nERROR: your user is not authorized to query group '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!".format(lgroup.get('id'), server)
+            log += "\n\nERROR: your user is not authorized to query group '{0}' in server {1}, so no email was sent.\n Admin privilegies are required!".format(lgroup.get('id'), server)
             l_groups.append(None)
             log_file(log)
 
@@ -520,15 +1245,55 @@ def get_project_leader(project_name, all_projects, server, site_id, auth_token,
                 l_user = user_id2name(session, server, auth_token, site_id, luser.get('id'))
                 l_users.append({'name': l_user, 'id': luser.get('id')})
         except Exception as err:
-            log = log + "\n\nERROR: your user is not authorized to query user '{0}' in server {1}, so no email was sent.\nAdmin privilegies are required!".format(luser.get('id'),server)
+            log += "\n\nERROR: your user is not authorized to query user '{0}' in server {1}, so no email was sent.\nAdmin privilegies are required!".format(luser.get('id'),server)
             l_users.append(None)
             log_file(log)
 
     l_users = [i for i in l_users if i != None]
     l_users = [dict(y) for y in set(tuple(x.items()) for x in l_users)]
-    return l_users, l_groups
+    cache[project_id] = (l_users, l_groups)
+    return [dict(lu) for lu in l_users], list(l_groups)
+
+
+def invalidate_project_leaders(server, project_id=None):
+    """
+    Forgets the project leaders stored by get_project_leader, so that they are queried again.
+
+    'server'        specified server address
+    'project_id'    ID of the project to forget (None = every project of the server)
+    """
+    if project_id is None:
+        project_leaders.pop(server, None)
+    else:
+        project_leaders.get(server, {}).pop(project_id, None)
+    return
+
+
+def project_leaders_summary(server):
+    """
+    Returns the log line with the hits and misses of the project leader cache of the server.
+    """
+    stats = project_leaders_stats.get(server, {'hits': 0, 'misses': 0})
+    return '\n\nProject leader cache: {0} hits, {1} misses'.format(stats['hits'], stats['misses'])
+
+
+@phase('load_user_names')
+def load_user_names(session, server, auth_token, user_id, site_id, page_size=100):
+    """
+    Loads the names of all the users of the site with the paginated users listing,
+    so that user_id2name does not need one request per user.
+
+    'server'        specified server address
+    'auth_token'    authentication token that grants user access to API calls
+    'user_id'       ID of the signed in user
+    'site_id'       ID of the site that the user is signed into
+    """
+    users = get_all(session, server, auth_token, user_id, site_id, page_size, 1, 'user', PAGE_WORKERS)
+    user_names[server] = {user.get('id'): user.get('name') for user in users}
+    return
 
 
+@phase('user_id2name')
 def user_id2name(session, server, auth_token, site_id, target_user_id):
     """
     Maps user ID to the respective user name on the server
@@ -544,14 +1309,20 @@ def user_id2name(session, server, auth_token, site_id, target_user_id):
     if (not isinstance(target_user_id, str)):
         return (None, None)
     
+    # Users loaded in bulk by load_user_names (or already queried) are answered from memory
+    names = user_names.setdefault(server, {})
+    if target_user_id in names:
+        return names[target_user_id]
+
     url = server + "/api/{0}/sites/{1}/users/{2}?fields=name".format(VERSION, site_id, target_user_id)
     
-    server_response = session.get(url, headers={'x-tableau-auth': auth_token}, verify=verifySsl)
+    server_response = session.get(url, headers=_headers(auth_token), verify=verifySsl)
     _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))    
+    xml_response = _parse_response(server_response)    
     
     #Creating tuple of name and e-mail from dictionary
     name = xml_response[0].get('name')       
+    names[target_user_id] = name
     return name
 
 
@@ -563,44 +1334,130 @@ def user_to_email(users_list, datauser):
     return emails_list
 
 
-def unlicensed_users_email(emails, server, user_name, proj_name, proj_num, proj_objects):
-    
+def _recipient(name):
+    """
+    Returns the email recipient of a Tableau user name (without the t- or eu prefix).
+    """
+    name = name.lower()
+    if 't-' in name:
+        return name[4:]
+    elif name[0:2] == 'eu' and len(name) > 8:
+        return name[2:]
+    return name
+
+
+def queue_digest(recipients, finding, leaders=()):
+    """
+    Adds a finding to the digest of every recipient, all the digests are emailed at once by send_digests.
+
+    'recipients'    Tableau user names of the people to inform (owners, subscribers...)
+    'finding'       dictionary describing the finding, its 'server' key groups the findings in the email
+    'leaders'       Tableau user names of the project leaders informed as such (not already in 'recipients')
+    Every recipient receives a copy of the finding with its 'role': 'owner' or 'leader'.
+    """
+    owners = set(_recipient(r) for r in recipients)
+    with digests_lock:
+        for recipient in sorted(owners):
+            digests.setdefault(recipient, []).append(dict(finding, role='owner'))
+        for recipient in sorted(set(_recipient(r) for r in leaders) - owners):
+            digests.setdefault(recipient, []).append(dict(finding, role='leader'))
+    return
+
+
+@phase('send_digests')
+def send_digests():
+    """
+    Creates one Outlook email per recipient listing every finding queued for them (over all the servers
+    of the run), instead of one email per object. The digests are emptied.
+    Returns the log text of the emails created.
+    """
+    with digests_lock:
+        pending = dict(digests)
+        digests.clear()
+    text = "\n\n-------- Emails (one per recipient) ---------"
+    if not pending:
+        return text + "\nNo email to prepare."
     outlook = client.Dispatch("Outlook.Application")
-    send_account = None
-    
-    for i in range(len(emails)):
-        if 't-' in emails[i].lower():
-            emails[i] = emails[i].lower()[4:len(emails[i])]
-        elif emails[i].lower()[0:2] == 'eu' and len(emails[i]) > 8:
-            emails[i] = emails[i].lower()[2:len(emails[i])]
-        else:
-            emails[i] = emails[i].lower()
-			
-    message  = outlook.CreateItem(0)
-    message.To = '; '.join(list(set(emails)))
-    message.BCC = ""
-    message.Subject = "FOR YOUR ACTION : Removing unlicensed users from Tableau Server"
-    
+    for recipient, findings in sorted(pending.items()):
+        try:
+            message = outlook.CreateItem(0)
+            message.To = recipient
+            message.BCC = ""
+            message.Subject = "FOR YOUR ACTION : Removing unlicensed users from Tableau Server"
+            message.HTMLBody = _digest_body(findings)
+            message.Display()
+            text += "\n- {0}: {1} item(s)".format(recipient, len(findings))
+        except Exception as err:
+            text += "\n\n WARNING: problem in creating the email for {0}! create manually! \n".format(recipient)
+    return text
+
+
+def _by_server(findings):
+    """
+    Returns the findings grouped by server, in the order they were found.
+    """
+    servers = {}
+    for finding in findings:
+        servers.setdefault(finding['server'], []).append(finding)
+    return servers.items()
+
+
+def _server_label(server, info=''):
+    """
+    Returns the name of the server shown in the emails: its 'info' in server_dict, else the name
+    of the ECB/ESCB server at this address, else the address.
+    """
+    if info:
+        return 'Tableau Server {0}'.format(info)
+    labels = {'https://a-tableau.ecb.de': 'Tableau ECB Acceptance Server',
+              'https://a-tableau.escb.eu': 'Tableau ESCB Acceptance Server',
+              'https://tableau.ecb.de': 'Tableau ECB Production Server',
+              'https://tableau.escb.eu': 'Tableau ESCB Production Server'}
+    return labels.get(server.rstrip('/'), 'Tableau Server {0}'.format(server.rstrip('/')))
+
+
+def unlicensed_users_email(emails, server, user_name, proj_name, proj_num, proj_objects, info=''):
+    """
+    Queues the objects an unlicensed user still owns in a project for the email of its project leaders (see send_digests).
+
+    'emails'         user names of the project leaders
+    'server'         specified server address
+    'user_name'      name of the unlicensed user
+    'proj_name'      name of the project
+    'proj_num'       repository id of the project (link of the email)
+    'proj_objects'   names of the 'projects', 'workbooks' and 'datasources' owned by the user
+    'info'           name of the server in server_dict, shown in the email
+    """
+    queue_digest([], {'server': server, 'info': info, 'user': user_name, 'project': proj_name, 'id': proj_num, 'objects': proj_objects}, leaders=emails)
+    return
+
+
+def _digest_body(findings):
+    """
+    Returns the HTML body of the email of one project leader, listing every unlicensed user owning content in their projects.
+    """
     Body = """
 &nbsp_____________________________________________________________________________________________<br>
-{0}{0}{0}{0}{0}{0} <img src="{2}" alt=Move workbook back to project><br>
+{0}{0}{0}{0}{0}{0} <img src="{1}" alt=Move workbook back to project><br>
 &nbsp_____________________________________________________________________________________________<br>
 <br>
 {0} Dear Project Leader(s),<br>
 <br>
-{0} In accordance with our policy to keep the Tableau servers “clean”, we noticed that the user <b>*{1}*</b> <br>
-{0} is no longer active and will be removed from the servers. <br>
-{0} However, the user still owns content published on : <br><br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', user_name, os.getcwd()+"\\Tableau.jpg")
-
-    Body = Body + """{0} <a href='{3}'>Tableau Server</a> in the project <a href='{3}/{2}'>{1}</a> <br>{0}{0} The unlicensed user is still owner of the following: """.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', proj_name, proj_num, server)
-
-    if proj_objects['projects'] != []:
-        Body = Body + '<br> {0}{0}{0} -(SUB)PROJECTS: <br> {0}{0}{0}{0} {1}'.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp','<br> {0}{0}{0}{0} '.join(proj_objects['projects'])).format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
-    if proj_objects['workbooks'] != []:
-        Body = Body + '<br> {0}{0}{0} -WORKBOOKS: <br> {0}{0}{0}{0} {1}'.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp','<br> {0}{0}{0}{0} '.join(proj_objects['workbooks'])).format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
-    if proj_objects['datasources'] != []:
-        Body = Body + '<br> {0}{0}{0} -DATASOURCES: <br> {0}{0}{0}{0} {1}'.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp','<br> {0}{0}{0}{0} '.join(proj_objects['datasources'])).format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
-        
+{0} In accordance with our policy to keep the Tableau servers “clean”, we noticed that the user(s) below <br>
+{0} is/are no longer active and will be removed from the servers. <br>
+{0} However, they still own content published on : <br><br>""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', os.getcwd()+"\\Tableau.jpg")
+
+    for server, owners in _by_server(findings):
+        for owner in owners:
+            proj_objects = owner['objects']
+            Body = Body + """<br>{0} User <b>*{1}*</b> on <a href='{4}'>{5}</a> in the project <a href='{4}/{3}'>{2}</a> <br>{0}{0} The unlicensed user is still owner of the following: """.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp', owner['user'], owner['project'], owner['id'], server, _server_label(server, owner.get('info', '')))
+            if proj_objects['projects'] != []:
+                Body = Body + '<br> {0}{0}{0} -(SUB)PROJECTS: <br> {0}{0}{0}{0} {1}'.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp','<br> {0}{0}{0}{0} '.join(proj_objects['projects'])).format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
+            if proj_objects['workbooks'] != []:
+                Body = Body + '<br> {0}{0}{0} -WORKBOOKS: <br> {0}{0}{0}{0} {1}'.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp','<br> {0}{0}{0}{0} '.join(proj_objects['workbooks'])).format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
+            if proj_objects['datasources'] != []:
+                Body = Body + '<br> {0}{0}{0} -DATASOURCES: <br> {0}{0}{0}{0} {1}'.format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp','<br> {0}{0}{0}{0} '.join(proj_objects['datasources'])).format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
+            Body = Body + '<br>'
     Body = Body + """<br><br>
 {0} <b>Please make sure to change the ownership of the above items.</b> To do so: go to your project, click on the <br>
 {0} 3 dots (…) next to the workbook(s) in question and choose “Change Owner” from the drop-down menu, and assign a <br>
@@ -620,10 +1477,10 @@ def unlicensed_users_email(emails, server, user_name, proj_name, proj_num, proj_
 {0} Kind regards,<br>
 {0} Tableau Support""".format('&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp&nbsp')
     
-    message.HTMLBody = Body
-    message.Display()
+    return Body
 
 	
+@phase('main')
 def main(server_config, username, password, readonly_pw, log = ''):
 	
     """
@@ -633,7 +1490,7 @@ def main(server_config, username, password, readonly_pw, log = ''):
     'password'        Tableau ECB/ESCB password (Admin)
     'server_config'   from config()
     """
-    log = log + """
+    log += """
 
 -------------------------------------------------------
 ----- Connecting to """ + server_config['postgreSQL'] + """ ------
@@ -643,16 +1500,17 @@ def main(server_config, username, password, readonly_pw, log = ''):
     try:
         postgre_data = postgresql(readonly_pw, server_config['postgreSQL'],'select * from projects')
         postgre_unlicensed = postgresql(readonly_pw, server_config['postgreSQL'],"select u.luid, su.name, _users.licensing_role_name from users u inner join system_users su on u.system_user_id = su.id inner join _users on u.id = _users.id where _users.licensing_role_name like 'Unlicensed'")
-        index = [i for i in range(len(list(postgre_unlicensed[1]))) if list(postgre_unlicensed[1])[i] is None]
-        postgre_unlicensed = postgre_unlicensed.drop(postgre_unlicensed.index[index])
-        df_groups = postgresql(readonly_pw, server_config['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id')
+        postgre_unlicensed = postgre_unlicensed[postgre_unlicensed['name'].notnull()]
+        groups_index = index_groups(postgresql(readonly_pw, server_config['postgreSQL'],'select g.luid as "Groupid",su.email as "Username", u.luid as "Userid" from group_users gu inner join groups g on g.id=gu.group_id inner join users u on u.id=gu.user_id inner join system_users su on su.id=u.system_user_id'))
 
     except Exception as err:
-        log = log + "\n\nERROR: could not connect to the postgreSQL server, verify readonly password and retry."
+        log += "\n\nERROR: could not connect to the postgreSQL server, verify readonly password and retry."
         log_file(log)
 
     setup()
     server = server_config['server']
+    invalidate_project_leaders(server)
+    project_leaders_stats[server] = {'hits': 0, 'misses': 0}
     print("Processing server: {0}".format(server))
     # Create session object for use throughout script
     # Session object also disallows for system-wide environment variables (e.g. http_proxy) that may interfere with connection
@@ -662,8 +1520,7 @@ def main(server_config, username, password, readonly_pw, log = ''):
     'app':'TABLEAU',
     'password':password,
     'submit':'Login'}
-    session = requests.Session()
-    session.trust_env = False
+    session = new_session()
     if 'escb.eu' in server:
         #the IAM portal sometimes does not respond, so the connection attempt will be executed 5 times until it fails
         iam_auth_counter = 0
@@ -677,7 +1534,7 @@ def main(server_config, username, password, readonly_pw, log = ''):
 	
 	##### STEP 1: Sign in #####
 
-    log = log + """
+    log += """
 
 ----------------------------------------------------------------------
 ----- signin in """ + server_config['server'] +" as " + username + """ ------
@@ -686,19 +1543,26 @@ def main(server_config, username, password, readonly_pw, log = ''):
 """
     try:
         auth_token, site_id, user_id = sign_in(session, server, username, password)
-        log = log + " ---> succeded"
+        log += " ---> succeded"
     except Exception as err:
-        log = log + "\n\nERROR: could not sign in server {0}".format(server)
+        log += "\n\nERROR: could not sign in server {0}".format(server)
         log_file(log)
+
+    try:
+        load_user_names(session, server, auth_token, user_id, site_id)
+    except Exception as err:
+        log += "\n\nWARNING: could not load the users of server {0}, user names will be queried one by one".format(server)
     
-    log = log + '\n connection verified \n '
+    log += '\n connection verified \n '
     
     ### STEP 2: find users and remove unlicesed ones ###
     print("\n2. find and remove unlicensed users")
-    unlicensed_users, unlius_emails, log, NoPLtext, emm = find_and_remove(session, server,auth_token,site_id,user_id, postgre_data, postgre_unlicensed, df_groups, log)
+    unlicensed_users, unlius_emails, log, NoPLtext, emm = find_and_remove(session, server,auth_token,site_id,user_id, postgre_data, postgre_unlicensed, groups_index, log, server_config.get('snapshot_max_age', 0), server_config['info'])
+    log += project_leaders_summary(server)
 	
 	##### STEP 3: Sign out #####
     print("\n3. Signing out and invalidating the authentication token")
     ##sign_out(server, auth_token)
+    session.close()
     
     return unlicensed_users, unlius_emails, log, NoPLtext, emm
@@ -12,16 +12,40 @@ from functools import partial
 import unlicensed_users as uu
 from datetime import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 #Configurations for different ECB Tableau servers
 
-server_dict = {'server1': {'server':'', 'postgreSQL' : ''},
-                'server2': {'server':'', 'postgreSQL' : ''},
-                'server3': {'server':'', 'postgreSQL' : ''},
-                'server4': {'server':'', 'postgreSQL' : ''},
+server_dict = {'server1': {'server':'', 'postgreSQL' : '', 'snapshot_max_age': 12},
+                'server2': {'server':'', 'postgreSQL' : '', 'snapshot_max_age': 12},
+                'server3': {'server':'', 'postgreSQL' : '', 'snapshot_max_age': 12},
+                'server4': {'server':'', 'postgreSQL' : '', 'snapshot_max_age': 12}}
 
 
 
+def process_server(x, username, password, readonly_pw, run_log):
+    """
+    Processes one server, in its own worker thread (see validateLogin).
+
+    'x'             index of the server (0 for server1 ... 3 for server4)
+    'username'      admin username of the server
+    'password'      admin password of the server
+    'readonly_pw'   password of the postgreSQL readonly user
+    'run_log'       log of the run, the server is logged in a child of it
+    Returns the log of the server and the lines listing the objects without Project Leader.
+    """
+    server = server_dict['server{0}'.format(x + 1)]
+    # the repository is queried before the process itself calls setup(): the connection pool size is set there
+    uu.setup()
+    log = run_log.child(server['server'])
+    try:
+        unlicensed_users, unlius_emails, log, NoPLtext, emm = uu.main(server, username, password, readonly_pw, log = log)
+        return log, NoPLtext
+    except Exception as err:
+        log += '\n\nERROR: the process stopped for {0}: {1}'.format(server['server'], err)
+        return log, []
+
+
 def validateLogin(ECBA_username, 
                   ESCBA_username, 
                   ECBP_username, 
@@ -78,7 +102,8 @@ def validateLogin(ECBA_username,
     Tab_pw = [ECBA_pw, ESCBA_pw, ECBP_pw, ESCBP_pw]
     readonly_passwords = [read_ECBA_pw, read_ESCBA_pw, read_ECBP_pw, read_ESCBP_pw]
     
-    log = """
+    log = uu.RunLog()
+    log += """
 ##########################
 # Unlicensed users process #
 ##########################
@@ -86,32 +111,23 @@ def validateLogin(ECBA_username,
 Server selected: {0}""".format(', '.join(args.servers))
     
     tkWindow.destroy()
+    selected = [x for x in range(len(Tab_users)) if Tab_users[x] != None]
+    #Every selected server is processed in its own worker, the logs are merged in the order of the servers
+    with ThreadPoolExecutor(max_workers=max(len(selected), 1)) as executor:
+        results = list(executor.map(lambda x: process_server(x, Tab_users[x], Tab_pw[x], readonly_passwords[x], log), selected))
     noPL = []
-    for x in range(len(Tab_users)):
-        if Tab_users[x] != None:
-            
-            if x == 0:
-                server = server_dict['server1']
-                readonly_pw = readonly_passwords[0]
-            elif x == 1:
-                server = server_dict['server2']  
-                readonly_pw = readonly_passwords[1]
-            elif x == 2:
-                server = server_dict['server3']
-                readonly_pw = readonly_passwords[2]
-            else:
-                server = server_dict['server4']
-                readonly_pw = readonly_passwords[3]
-            
-            unlicensed_users, unlius_emails, log, NoPLtext, emm = uu.main(server, Tab_users[x], Tab_pw[x], readonly_pw, log = '')
-    
-    noPL = noPL + NoPLtext
-    log = log + '\n\n {0}'.format('\n'.join(NoPLtext))
-    log = log + '\n\nUNLICENSED USERS PROCESS COMPLETE!'
-    logfile_name = datetime.now().strftime("logs/log_%m%d_%H%M%S.txt")
-    file = open(logfile_name, "w") 
-    file.write(log)
-    file.close()
+    for server_log, NoPLtext in results:
+        log += server_log
+        noPL = noPL + NoPLtext
+    log += '\n\n {0}'.format('\n'.join(noPL))
+    #Every person receives one email listing their findings on all the selected servers
+    log += uu.send_digests()
+    log += uu.metrics_summary()
+    log += uu.connection_pools_summary()
+    log += '\n\nMetrics written to {0}'.format(uu.write_metrics(log.path.replace('run_', 'metrics_')[:-len('.jsonl')] + '.json'))
+    uu.close_connection_pools()
+    log += '\n\nUNLICENSED USERS PROCESS COMPLETE!'
+    logfile_name = log.render()
     os.system(logfile_name.replace('/', '\\'))
     return 
 